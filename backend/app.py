@@ -17,7 +17,7 @@ from routes.google_fit_auth import google_fit_auth_bp
 from routes.google_fit_sync import google_fit_sync_bp
 
 app = Flask(__name__)
-CORS(app) # Enable CORS for React frontend
+CORS(app, expose_headers=['X-Next-Cursor']) # Enable CORS for React frontend
 
 # Configure session for OAuth
 app.secret_key = os.getenv('SECRET_KEY', 'neurapulse-secret-key-change-in-production')
@@ -57,12 +57,20 @@ def health_check():
 if __name__ == '__main__':
     from rag_utils import initialize_rag
     from services.reminder_scheduler import init_scheduler
+    from services.fit_sync_queue import init_sync_queue
+    from services.db_indexes import ensure_indexes
+    
+    print("Ensuring MongoDB indexes...")
+    ensure_indexes()
     
     print("Initializing RAG Vector Store...")
     initialize_rag()
     
     print("Starting Email Reminder Scheduler...")
     init_scheduler()
+
+    print("Starting Google Fit Sync Queue...")
+    init_sync_queue()
     
     app.run(debug=True, port=5000)
 
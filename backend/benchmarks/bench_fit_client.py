@@ -0,0 +1,69 @@
+"""
+Benchmark: per-call overhead of the Google Fit API client.
+
+Runs GoogleFitService.get_heart_rate_data() against the local Fitness API stub
+(benchmarks/fit_api_stub.py) with a client built per call, as the service used
+to, and with the cached client (parsed static discovery document plus a pooled
+per-thread connection). Reports time per call and TCP connections opened.
+
+Usage (from backend/):
+    python -m benchmarks.bench_fit_client [--calls 200] [--latency-ms 0]
+"""
+import argparse
+import contextlib
+import io
+import os
+import time
+from datetime import datetime, timedelta
+from benchmarks.fit_api_stub import StubConfig, start_stub
+
+
+def run(service, calls, config):
+    start_time = datetime.now() - timedelta(hours=1)
+    end_time = datetime.now()
+    connections = config.connections
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(calls):
+            started = time.perf_counter()
+            service.get_heart_rate_data(start_time, end_time)
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2], sum(timings) / len(timings), config.connections - connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=0, help='simulated server latency per request')
+    args = parser.parse_args()
+
+    server, base_url, config = start_stub(config=StubConfig(latency_ms=args.latency_ms))
+    # Must be set before the service module is imported
+    os.environ['GOOGLE_FIT_API_ENDPOINT'] = base_url
+    from googleapiclient.discovery import build
+    from services.google_fit_service import GoogleFitService
+
+    class PerCallClientService(GoogleFitService):
+        """The previous behaviour: a fresh discovery build and connection for every call."""
+
+        def get_fitness_service(self):
+            self.refresh_token_if_needed()
+            return build('fitness', 'v1', credentials=self.credentials,
+                         client_options={'api_endpoint': base_url + 'fitness/v1/users/'},
+                         cache_discovery=False)
+
+    variants = {
+        'build per call': PerCallClientService(access_token='bench-token'),
+        'cached client': GoogleFitService(access_token='bench-token'),
+    }
+    print(f"{args.calls} heart-rate calls against {base_url}\n")
+    print(f"{'client':<18}{'median ms':>12}{'mean ms':>12}{'connections':>14}")
+    for name, service in variants.items():
+        median, mean, connections = run(service, args.calls, config)
+        print(f"{name:<18}{median * 1000:>12.2f}{mean * 1000:>12.2f}{connections:>14}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
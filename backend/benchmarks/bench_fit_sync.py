@@ -0,0 +1,138 @@
+"""
+Benchmark: Google Fit sync throughput against the local Fitness API stub.
+
+Runs a full FitSyncEngine.sync() for each window with the Fitness API served by
+benchmarks/fit_api_stub.py and writes going to MongoDB (MONGO_URI, in a separate
+"<database>_bench" database that is dropped afterwards). For each window reports:
+    points/s     - points fetched and stored per second of wall time
+    docs/point   - documents written to MongoDB (readings, rollups, sleep logs,
+                   tokens, data versions) per point fetched: the write amplification
+    bytes/point  - bytes of write commands sent to MongoDB per point fetched
+    peak memory  - tracemalloc peak during the sync (measured in a second,
+                   untimed pass, since tracing slows the sync down)
+
+Requires a running MongoDB; no Google credentials are needed.
+
+Usage (from backend/):
+    python -m benchmarks.bench_fit_sync [--days 1 7 90 365] [--hr-interval 60] [--latency-ms 0]
+                                        [--error-rate 0] [--storage-mode flat] [--keep]
+"""
+import argparse
+import contextlib
+import io
+import os
+import threading
+import time
+import tracemalloc
+import bson
+from pymongo import MongoClient, monitoring
+from benchmarks.fit_api_stub import StubConfig, start_stub
+
+WRITE_COMMANDS = {'insert': 'documents', 'update': 'updates', 'delete': 'deletes'}
+
+
+class WriteCounter(monitoring.CommandListener):
+    """Counts write commands, the documents they carry and their size."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = self.documents = self.bytes = self.reads = 0
+
+    def started(self, event):
+        field = WRITE_COMMANDS.get(event.command_name)
+        with self.lock:
+            if field:
+                self.commands += 1
+                self.documents += len(event.command.get(field, ()))
+                self.bytes += len(bson.encode(event.command))
+            elif event.command_name == 'findAndModify':
+                self.commands += 1
+                self.documents += 1
+                self.bytes += len(bson.encode(event.command))
+            elif event.command_name in ('find', 'aggregate', 'getMore'):
+                self.reads += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def sync_window(engine, service, db, user_id, days):
+    db['google_fit_tokens'].update_one({'user_id': user_id},
+                                       {'$set': {'access_token': 'bench-token', 'last_sync': None}},
+                                       upsert=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return engine.sync(user_id, service, days=days, full=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7, 90, 365])
+    parser.add_argument('--hr-interval', type=int, default=60, help='seconds between heart-rate points')
+    parser.add_argument('--latency-ms', type=float, default=0, help='simulated server latency per request')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of API requests that fail')
+    parser.add_argument('--storage-mode', default=os.getenv('SENSOR_STORAGE_MODE', 'flat'))
+    parser.add_argument('--fetch-timeout', type=float, default=600, help='seconds per metric fetch')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database')
+    args = parser.parse_args()
+
+    config = StubConfig(latency_ms=args.latency_ms, hr_interval_seconds=args.hr_interval,
+                        error_rate=args.error_rate, seed=1)
+    server, base_url, config = start_stub(config=config)
+    # Must be set before the service module is imported
+    os.environ['GOOGLE_FIT_API_ENDPOINT'] = base_url
+    from database import MONGO_URI
+    from services.fit_sync_engine import FitSyncEngine
+    from services.google_fit_service import GoogleFitService
+    from services.reading_bus import ReadingBus
+    from services.sensor_store import STORES
+
+    counter = WriteCounter()
+    client = MongoClient(MONGO_URI, event_listeners=[counter])
+    db_name = f"{client.get_database().name}_bench"
+    client.drop_database(db_name)
+    db = client[db_name]
+    # The bus's data versions go to the bench database too, and are counted as writes
+    store = STORES[args.storage_mode](db, bus=ReadingBus(db=db))
+    engine = FitSyncEngine(store=store, db=db, fetch_timeout=args.fetch_timeout)
+    service = GoogleFitService(access_token='bench-token')
+
+    print(f"Full syncs against {base_url} ({args.storage_mode} storage, heart rate every "
+          f"{args.hr_interval}s, {args.latency_ms:g} ms latency, {args.error_rate:.0%} errors)\n")
+    print(f"{'window':>8}{'points':>10}{'seconds':>10}{'points/s':>11}{'docs/point':>12}"
+          f"{'bytes/point':>13}{'peak MiB':>10}{'errors':>8}")
+    try:
+        for days in args.days:
+            counter.reset()
+            started = time.perf_counter()
+            result = sync_window(engine, service, db, f'bench-{days}d', days)
+            elapsed = time.perf_counter() - started
+            points = sum(result['summary'].values())
+            documents, write_bytes = counter.documents, counter.bytes
+
+            tracemalloc.start()
+            sync_window(engine, service, db, f'bench-{days}d-memory', days)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print(f"{days:>7}d{points:>10,}{elapsed:>10.2f}{points / elapsed:>11,.0f}"
+                  f"{documents / max(points, 1):>12.2f}{write_bytes / max(points, 1):>13,.0f}"
+                  f"{peak / 2 ** 20:>10.1f}{len(result['errors']):>8}")
+            for metric, error in result['errors'].items():
+                print(f"{'':>9}{metric}: {error[:100]}")
+    finally:
+        if not args.keep:
+            client.drop_database(db_name)
+        server.shutdown()
+
+    print(f"\nStub served {config.requests} requests ({config.errors} injected errors)")
+
+
+if __name__ == '__main__':
+    main()
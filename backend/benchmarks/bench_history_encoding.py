@@ -0,0 +1,82 @@
+"""
+Benchmark: /api/google-fit/history wire encodings.
+
+Compares encode time and payload size of the row JSON format against the
+columnar JSON and binary encodings on a synthetic heart-rate + steps history.
+
+Usage (from backend/):
+    python -m benchmarks.bench_history_encoding [--days 30] [--interval 10] [--repeat 5]
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from services import history_encoding
+
+
+def synthetic_history(days, interval_seconds):
+    start = datetime(2024, 1, 1)
+    heart_rate = history_encoding.new_series('bpm')
+    bpm = 70.0
+    for i in range(int(days * 86400 / interval_seconds)):
+        bpm = min(180.0, max(45.0, bpm + random.gauss(0, 1.5)))
+        heart_rate['recorded_at'].append(start + timedelta(seconds=i * interval_seconds))
+        heart_rate['value'].append(round(bpm, 1))
+        heart_rate['date'].append('')
+
+    steps = history_encoding.new_series('steps')
+    for day in range(days):
+        recorded_at = start + timedelta(days=day)
+        steps['recorded_at'].append(recorded_at)
+        steps['value'].append(random.randint(2000, 15000))
+        steps['date'].append(recorded_at.date().isoformat())
+
+    return {'heart_rate': heart_rate, 'steps': steps, 'calories': history_encoding.new_series(),
+            'weight': history_encoding.new_series()}
+
+
+def measure(encode, repeat):
+    timings = []
+    payload = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        payload = encode()
+        timings.append(time.perf_counter() - started)
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return sorted(timings)[len(timings) // 2], payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--interval', type=int, default=10, help='seconds between heart-rate samples')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    history = synthetic_history(args.days, args.interval)
+    points = sum(len(series['value']) for series in history.values())
+    print(f"{points} points over {args.days} days\n")
+
+    encoders = {
+        'rows (application/json)': lambda: json.dumps(history_encoding.to_rows(history)),
+        'columnar json': lambda: json.dumps(history_encoding.to_columnar_json(history)),
+        'columnar binary': lambda: history_encoding.to_columnar_binary(history),
+    }
+
+    baseline = None
+    print(f"{'encoding':<26}{'encode ms':>12}{'bytes':>14}{'gzip bytes':>14}{'size vs rows':>14}")
+    for name, encode in encoders.items():
+        seconds, payload = measure(encode, args.repeat)
+        baseline = baseline or len(payload)
+        print(f"{name:<26}{seconds * 1000:>12.1f}{len(payload):>14,}{len(gzip.compress(payload)):>14,}"
+              f"{len(payload) / baseline:>13.1%}")
+
+    decoded = history_encoding.decode_columnar_binary(history_encoding.to_columnar_binary(history))
+    assert len(decoded['heart_rate']['value']) == len(history['heart_rate']['value'])
+
+
+if __name__ == '__main__':
+    main()
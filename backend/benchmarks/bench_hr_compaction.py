@@ -0,0 +1,106 @@
+"""
+Benchmark: storage saved by heart-rate run compaction (SENSOR_STORAGE_MODE=compact).
+
+Builds a synthetic day of heart-rate readings as they arrive from Google Fit and
+a BLE chest strap: a watch sample every minute (asleep and idle), a 1 Hz strap
+stream during a workout and during a focused work block, all integer bpm. Compares
+BSON bytes and document count stored flat against the span records of
+services/sensor_compaction.py, and the error when spans are expanded back.
+
+Usage (from backend/):
+    python -m benchmarks.bench_hr_compaction [--tolerance 0 1 2] [--seed 7]
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+import bson
+from bson.objectid import ObjectId
+from services import sensor_compaction
+
+
+def _walk(bpm, low, high, step_probability, rng):
+    if rng.random() < step_probability:
+        bpm += rng.choice((-1, 1))
+    return min(high, max(low, bpm))
+
+
+def synthetic_day(seed):
+    rng = random.Random(seed)
+    day = datetime(2024, 1, 1)
+    synced_at = day + timedelta(days=1)
+    readings = []
+
+    def add(recorded_at, bpm, source, device_name=None):
+        doc = {'_id': ObjectId(), 'user_id': '65a1f0c2e4b0a1b2c3d4e5f6', 'type': 'heart_rate',
+               'recorded_at': recorded_at, 'value': bpm, 'unit': 'bpm', 'source': source,
+               'synced_at': synced_at}
+        if device_name:
+            doc['device_name'] = device_name
+        readings.append(doc)
+
+    # Watch: one sample a minute; resting at night, drifting more during the day
+    bpm = 56
+    for minute in range(24 * 60):
+        asleep = minute < 7 * 60 or minute >= 23 * 60
+        bpm = _walk(bpm, 48, 64, 0.2, rng) if asleep else _walk(bpm, 60, 95, 0.5, rng)
+        add(day + timedelta(minutes=minute), bpm, 'google_fit')
+
+    # Chest strap at 1 Hz: a 45-minute run, then a 2-hour focused work block
+    sessions = [(timedelta(hours=7, minutes=30), 45 * 60, 120, 165, 0.15),
+                (timedelta(hours=10), 2 * 3600, 62, 80, 0.05)]
+    for offset, seconds, low, high, step_probability in sessions:
+        bpm = low + 10
+        for second in range(seconds):
+            bpm = _walk(bpm, low, high, step_probability, rng)
+            add(day + offset + timedelta(seconds=second), bpm, 'ble', device_name='Polar H10')
+    return readings
+
+
+def expansion_error(readings, records):
+    """(max value error, mean |timestamp error| in seconds) after expanding the records back."""
+    expanded = {}
+    for record in records:
+        record = dict(record, _id=ObjectId())
+        for doc in sensor_compaction.expand(record):
+            expanded.setdefault(doc['source'], []).append(doc)
+    original = {}
+    for doc in readings:
+        original.setdefault(doc['source'], []).append(doc)
+    value_error, time_error, count = 0, 0.0, 0
+    for source, docs in original.items():
+        docs.sort(key=lambda d: d['recorded_at'])
+        restored = sorted(expanded[source], key=lambda d: d['recorded_at'])
+        assert len(docs) == len(restored)
+        for a, b in zip(docs, restored):
+            value_error = max(value_error, abs(a['value'] - b['value']))
+            time_error += abs((a['recorded_at'] - b['recorded_at']).total_seconds())
+            count += 1
+    return value_error, time_error / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tolerance', type=float, nargs='+', default=[0, 1, 2], help='bpm')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    readings = synthetic_day(args.seed)
+    flat_bytes = sum(len(bson.encode(doc)) for doc in readings)
+    print(f"{len(readings):,} heart-rate readings in one day "
+          f"(max gap {sensor_compaction.MAX_GAP.seconds}s, max span {sensor_compaction.MAX_SPAN.seconds}s)\n")
+
+    print(f"{'layout':<20}{'documents':>12}{'BSON bytes':>14}{'size vs flat':>14}"
+          f"{'max bpm err':>13}{'mean time err':>15}")
+    print(f"{'flat':<20}{len(readings):>12,}{flat_bytes:>14,}{1:>13.1%}{0:>13}{'0.0s':>15}")
+    for tolerance in args.tolerance:
+        records = sensor_compaction.compact([dict(doc) for doc in readings], tolerance=tolerance)
+        for record in records:
+            record['_id'] = ObjectId()
+        size = sum(len(bson.encode(record)) for record in records)
+        value_error, time_error = expansion_error(readings, records)
+        print(f"{f'compact ±{tolerance:g} bpm':<20}{len(records):>12,}{size:>14,}{size / flat_bytes:>13.1%}"
+              f"{value_error:>13g}{time_error:>14.1f}s")
+
+
+if __name__ == '__main__':
+    main()
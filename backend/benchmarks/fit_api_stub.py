@@ -0,0 +1,241 @@
+"""
+Local stub of the Google Fit REST API for benchmarks and offline testing.
+
+Serves the endpoints GoogleFitService calls with synthetic data:
+    GET  /fitness/v1/users/me/dataSources/<id>/datasets/<startNanos>-<endNanos>
+    GET  /fitness/v1/users/me/sessions
+    POST /fitness/v1/users/me/dataset:aggregate
+
+Data volume (heart-rate interval, weigh-in interval), latency and injected
+errors (a fraction of requests answered with an API error) are configurable.
+
+Point GoogleFitService at it with GOOGLE_FIT_API_ENDPOINT=http://127.0.0.1:<port>/.
+
+Usage (from backend/):
+    python -m benchmarks.fit_api_stub [--port 8765] [--latency-ms 0] [--hr-interval 60]
+                                      [--error-rate 0] [--error-status 503]
+"""
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DATASET_PATH = re.compile(r'/fitness/v1/users/me/dataSources/(?P<source>[^/]+)/datasets/(?P<start>\d+)-(?P<end>\d+)$')
+SESSIONS_PATH = '/fitness/v1/users/me/sessions'
+AGGREGATE_PATH = '/fitness/v1/users/me/dataset:aggregate'
+
+NANOS_PER_SECOND = 10 ** 9
+DAY_MILLIS = 86400000
+SLEEP_HOURS = 8
+
+# Google API error statuses by HTTP code, for injected errors
+ERROR_STATUSES = {
+    400: 'INVALID_ARGUMENT',
+    401: 'UNAUTHENTICATED',
+    403: 'PERMISSION_DENIED',
+    429: 'RESOURCE_EXHAUSTED',
+    500: 'INTERNAL',
+    503: 'UNAVAILABLE',
+}
+
+
+class StubConfig:
+    """What the stub returns, how slowly and how often it fails."""
+
+    def __init__(self, latency_ms=0, hr_interval_seconds=60, weight_interval_days=1,
+                 error_rate=0.0, error_status=503, seed=None):
+        self.latency_ms = latency_ms
+        self.hr_interval_seconds = hr_interval_seconds
+        self.weight_interval_days = weight_interval_days
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.points = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def should_fail(self):
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+
+def _grid(start, end, step):
+    """Multiples of `step` strictly inside (start, end)."""
+    return range(start - start % step + step, end, step)
+
+
+def _dataset(source, start_nanos, end_nanos, config):
+    points = []
+    if 'heart_rate' in source:
+        step = config.hr_interval_seconds * NANOS_PER_SECOND
+        for t in _grid(start_nanos, end_nanos, step):
+            # Resting in the small hours, higher and more variable in the day
+            minute = t // (60 * NANOS_PER_SECOND)
+            bpm = 58 + 20 * (minute % 1440 >= 420) + (minute * 7) % 13
+            points.append({'startTimeNanos': str(t), 'endTimeNanos': str(t), 'value': [{'fpVal': float(bpm)}]})
+    elif 'weight' in source:
+        step = config.weight_interval_days * 86400 * NANOS_PER_SECOND
+        for i, t in enumerate(_grid(start_nanos, end_nanos, step)):
+            points.append({'startTimeNanos': str(t), 'endTimeNanos': str(t),
+                           'value': [{'fpVal': 72.5 + (i % 5) * 0.1}]})
+    with config.lock:
+        config.points += len(points)
+    return {'dataSourceId': source, 'minStartTimeNs': str(start_nanos),
+            'maxEndTimeNs': str(end_nanos), 'point': points}
+
+
+def _aggregate(body, config):
+    start, end = int(body['startTimeMillis']), int(body['endTimeMillis'])
+    width = int(body.get('bucketByTime', {}).get('durationMillis', DAY_MILLIS))
+    buckets = []
+    for bucket_start in range(start, end, width):
+        datasets = []
+        for aggregate in body.get('aggregateBy', []):
+            name = aggregate.get('dataTypeName', '')
+            if 'step_count' in name:
+                value = {'intVal': 8000}
+            elif 'calories' in name:
+                value = {'fpVal': 2100.0}
+            else:
+                value = {'fpVal': 5400.0}
+            datasets.append({'dataSourceId': f'derived:{name}:stub', 'dataTypeName': name,
+                             'point': [{'startTimeNanos': str(bucket_start * 10 ** 6),
+                                        'endTimeNanos': str(min(bucket_start + width, end) * 10 ** 6),
+                                        'dataTypeName': name, 'value': [value]}]})
+        buckets.append({'startTimeMillis': str(bucket_start),
+                        'endTimeMillis': str(min(bucket_start + width, end)), 'dataset': datasets})
+    with config.lock:
+        config.points += len(buckets)
+    return {'bucket': buckets}
+
+
+def _rfc3339_millis(value):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def _sessions(query, config):
+    """One sleep session per night starting inside [startTime, endTime), 22:00 to 06:00 UTC."""
+    now = int(time.time() * 1000)
+    start = _rfc3339_millis(query['startTime'][0]) if 'startTime' in query else now - 7 * DAY_MILLIS
+    end = _rfc3339_millis(query['endTime'][0]) if 'endTime' in query else now
+    sessions = []
+    for day in range(start - start % DAY_MILLIS, end, DAY_MILLIS):
+        night = day + 22 * 3600 * 1000
+        if start <= night < end:
+            sessions.append({'id': f'stub-sleep-{night}', 'activityType': 72, 'name': 'Sleep',
+                             'startTimeMillis': str(night),
+                             'endTimeMillis': str(night + SLEEP_HOURS * 3600 * 1000)})
+    with config.lock:
+        config.points += len(sessions)
+    return {'session': sessions}
+
+
+def make_handler(config):
+    class FitApiStubHandler(BaseHTTPRequestHandler):
+        # Keep-alive, so clients that pool connections can reuse them
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # Headers and body go out in separate writes; without this, Nagle's algorithm
+            # and delayed ACKs stall every response on a reused connection by ~40 ms
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with config.lock:
+                config.connections += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, payload, status=200):
+            if config.latency_ms:
+                time.sleep(config.latency_ms / 1000)
+            with config.lock:
+                config.requests += 1
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _injected_error(self):
+            """Answer with an API error if this request was picked to fail."""
+            if not config.should_fail():
+                return False
+            with config.lock:
+                config.errors += 1
+            status = config.error_status
+            self._reply({'error': {'code': status, 'message': 'Injected by fit_api_stub',
+                                   'status': ERROR_STATUSES.get(status, 'UNKNOWN')}}, status)
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = url.path
+            match = DATASET_PATH.match(path)
+            if match:
+                if self._injected_error():
+                    return
+                return self._reply(_dataset(match['source'], int(match['start']), int(match['end']), config))
+            if path == SESSIONS_PATH:
+                if self._injected_error():
+                    return
+                return self._reply(_sessions(parse_qs(url.query), config))
+            self._reply({'error': {'code': 404, 'message': f'No stub for {path}'}}, 404)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if path == AGGREGATE_PATH:
+                if self._injected_error():
+                    return
+                return self._reply(_aggregate(body, config))
+            self._reply({'error': {'code': 404, 'message': f'No stub for {path}'}}, 404)
+
+    return FitApiStubHandler
+
+
+def start_stub(port=0, config=None):
+    """Start the stub on a background thread. Returns (server, base_url, config)."""
+    config = config or StubConfig()
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fit-api-stub', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/', config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--hr-interval', type=int, default=60, help='seconds between heart-rate points')
+    parser.add_argument('--weight-interval', type=int, default=1, help='days between weigh-ins')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, choices=sorted(ERROR_STATUSES))
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.hr_interval, args.weight_interval,
+                        args.error_rate, args.error_status, args.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(config))
+    print(f"Fitness API stub listening on http://127.0.0.1:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,435 @@
+"""
+RAG Vector Store
+Embeds the knowledge base under RAG_CORPUS_DIR (default data/: .txt, .md and .pdf
+files, see services/kb_ingestion.py) into a FAISS index used by the chat route.
+Changed files are parsed and chunked in a process pool of RAG_INGEST_WORKERS and
+their chunks stream into the embedding stage. Above RAG_ANN_THRESHOLD chunks the
+exact flat index is replaced by an approximate one: RAG_ANN_TYPE `hnsw` (RAG_HNSW_M,
+RAG_HNSW_EF_CONSTRUCTION, RAG_HNSW_EF_SEARCH) or `ivf` (RAG_IVF_NLIST, RAG_IVF_NPROBE).
+
+The built index and docstore are saved under RAG_INDEX_DIR (default data/rag_index),
+in a directory named after a hash of the corpus files' checksums, the splitter
+parameters, the embedding model and the index settings. Startup memory-maps a saved index whose key matches and only
+re-chunks when something changed. Chunk vectors are cached by content hash in
+<RAG_INDEX_DIR>/embeddings.sqlite3, so a rebuild only embeds new or edited chunks,
+in batches of RAG_EMBED_BATCH_SIZE with up to RAG_EMBED_CONCURRENCY requests in flight.
+
+retrieve_context() keeps LRU caches (RAG_QUERY_CACHE_SIZE entries, RAG_QUERY_CACHE_TTL_SECONDS)
+of normalized query -> query embedding and -> retrieved context; the context cache
+is dropped whenever a new index is loaded or built. The normalized form is only the
+cache key: the embedding model is sent the query as the user wrote it.
+
+Retrieval is hybrid: a TF-IDF index over the same chunks (services/lexical_index.py)
+is fused with the FAISS results by reciprocal rank. RAG_RETRIEVAL_MODE selects
+`hybrid` (default), `vector` or `lexical`. In hybrid mode a query with at most
+RAG_KEYWORD_MAX_TERMS terms is answered lexically, with no network call. Both
+hybrid and vector mode fall back to lexical when the query embedding takes longer
+than RAG_EMBED_TIMEOUT_MS or fails, or when there is no GEMINI_API_KEY (startup
+then serves a saved index's chunks, or chunks the corpus without embedding it).
+
+Usage (from backend/):
+    python rag_utils.py build [--force]    # prebuild the index, e.g. at deploy time
+"""
+import hashlib
+import json
+import math
 import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+import numpy as np
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import TextLoader
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from services.embedding_cache import EmbeddingCache, chunk_hash
+from services.query_cache import LRUCache, normalize_query
+from services.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from services import kb_ingestion
+
+CORPUS_DIR = os.getenv('RAG_CORPUS_DIR', os.path.join(os.path.dirname(__file__), 'data'))
+INDEX_DIR = os.getenv('RAG_INDEX_DIR', os.path.join(os.path.dirname(__file__), 'data', 'rag_index'))
+CHUNK_CACHE_DIR = os.path.join(INDEX_DIR, 'chunks')
+INGEST_WORKERS = int(os.getenv('RAG_INGEST_WORKERS', 0)) or None  # None: one per CPU
+EMBEDDING_MODEL = "models/embedding-001"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+INDEX_NAME = 'index'
+EMBEDDING_CACHE_PATH = os.path.join(INDEX_DIR, 'embeddings.sqlite3')
+EMBED_BATCH_SIZE = int(os.getenv('RAG_EMBED_BATCH_SIZE', 100))
+EMBED_CONCURRENCY = int(os.getenv('RAG_EMBED_CONCURRENCY', 4))
+ANN_THRESHOLD = int(os.getenv('RAG_ANN_THRESHOLD', 50000))
+ANN_TYPE = os.getenv('RAG_ANN_TYPE', 'hnsw')
+HNSW_M = int(os.getenv('RAG_HNSW_M', 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv('RAG_HNSW_EF_CONSTRUCTION', 200))
+HNSW_EF_SEARCH = int(os.getenv('RAG_HNSW_EF_SEARCH', 64))
+IVF_NLIST = int(os.getenv('RAG_IVF_NLIST', 0))  # 0: 4 * sqrt(vectors)
+IVF_NPROBE = int(os.getenv('RAG_IVF_NPROBE', 16))
+QUERY_CACHE_SIZE = int(os.getenv('RAG_QUERY_CACHE_SIZE', 1024))
+QUERY_CACHE_TTL = int(os.getenv('RAG_QUERY_CACHE_TTL_SECONDS', 3600))
+RETRIEVAL_MODE = os.getenv('RAG_RETRIEVAL_MODE', 'hybrid')
+KEYWORD_MAX_TERMS = int(os.getenv('RAG_KEYWORD_MAX_TERMS', 3))
+EMBED_TIMEOUT_MS = int(os.getenv('RAG_EMBED_TIMEOUT_MS', 800))
+TOP_K = 3
+# Candidates taken from each retriever before fusion
+FUSION_CANDIDATES = 4 * TOP_K
+
+# (vector store, TF-IDF over the same chunks by FAISS position, generation), swapped
+# as one tuple so a reader never pairs a new index with an old docstore. The
+# generation is bumped on every swap and is part of the context cache key.
+_indexes = (None, None, 0)
+_indexes_lock = threading.Lock()
+_query_embeddings = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+_query_results = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+# Query embeddings run here so retrieval can give up on them after EMBED_TIMEOUT_MS
+_query_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='rag-query-embed')
+
+
+def _index_key(files):
+    """Hash of everything the index depends on: corpus files, splitter, model and index settings."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        'files': [[relpath, sha256] for relpath, _, sha256 in files],
+        'splitter': RecursiveCharacterTextSplitter.__name__,
+        'chunk_size': CHUNK_SIZE,
+        'chunk_overlap': CHUNK_OVERLAP,
+        'embedding_model': EMBEDDING_MODEL,
+        'ann': [ANN_THRESHOLD, ANN_TYPE, HNSW_M, HNSW_EF_CONSTRUCTION, IVF_NLIST],
+    }, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:32]
 
-# Global Vector Store
-vector_store = None
 
-def initialize_rag():
-    global vector_store
+def _get_embeddings():
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("RAG: GEMINI_API_KEY not found, retrieval will be lexical only.")
+        return None
+    return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=api_key)
+
+
+def _embed_chunks(chunks, embeddings):
+    """
+    (documents, vectors) for a stream of chunks, in order. Chunks are looked up
+    in the cache as they arrive; misses are embedded in batches with at most
+    EMBED_CONCURRENCY requests in flight, and added to the cache.
+    """
+    started = time.perf_counter()
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_MODEL)
+    documents, hashes, vectors = [], [], {}
+    lookup, missing, embedded = {}, {}, set()
+    in_flight = {}  # future -> chunk hashes
+    batches = 0
+
+    def _drain(limit):
+        while len(in_flight) > limit:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Store each batch as it lands so a failed build keeps what it paid for
+                batch = list(zip(in_flight.pop(future), future.result()))
+                cache.put_many(batch)
+                vectors.update(batch)
+
+    def _submit(executor, flush=False):
+        nonlocal batches
+        vectors.update(cache.get_many([key for key in lookup if key not in vectors]))
+        for key, text in lookup.items():
+            if key not in vectors and key not in embedded:
+                missing[key] = text
+                embedded.add(key)
+        lookup.clear()
+        while len(missing) >= EMBED_BATCH_SIZE or (flush and missing):
+            keys = list(missing)[:EMBED_BATCH_SIZE]
+            _drain(EMBED_CONCURRENCY - 1)
+            in_flight[executor.submit(embeddings.embed_documents, [missing.pop(k) for k in keys])] = keys
+            batches += 1
+
     try:
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            print("RAG Error: GEMINI_API_KEY not found.")
-            return
+        with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as executor:
+            try:
+                for chunk in chunks:
+                    key = chunk_hash(chunk.page_content)
+                    documents.append(chunk)
+                    hashes.append(key)
+                    lookup[key] = chunk.page_content
+                    if len(lookup) >= EMBED_BATCH_SIZE:
+                        _submit(executor)
+                _submit(executor, flush=True)
+                _drain(0)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+    finally:
+        cache.close()
+
+    hits = len(hashes) - sum(1 for key in hashes if key in embedded)
+    print(f"RAG: {len(hashes)} chunks, embedding cache hit rate {hits / max(len(hashes), 1):.0%}, "
+          f"embedded {len(embedded)} in {batches} batches ({time.perf_counter() - started:.2f}s)")
+    return documents, [vectors[key] for key in hashes]
+
+
+def _scan_corpus():
+    return kb_ingestion.scan(CORPUS_DIR, INDEX_DIR, exclude=[INDEX_DIR])
+
+
+def _iter_chunks(files):
+    return kb_ingestion.iter_chunks(files, CHUNK_CACHE_DIR, CHUNK_SIZE, CHUNK_OVERLAP, workers=INGEST_WORKERS)
+
+
+def _new_index(matrix):
+    """Exact flat index, or an approximate one (RAG_ANN_TYPE) above RAG_ANN_THRESHOLD vectors."""
+    import faiss
+
+    count, dim = matrix.shape
+    if count < ANN_THRESHOLD:
+        return faiss.IndexFlatL2(dim)
+    if ANN_TYPE == 'ivf':
+        nlist = IVF_NLIST or int(4 * math.sqrt(count))
+        # FAISS warns below ~39 training points per list; more than 256 adds little
+        limit = max(1, count // 39)
+        if nlist > limit:
+            print(f"RAG: RAG_IVF_NLIST {nlist} too large for {count} vectors, using {limit} lists.")
+            nlist = limit
+        index = faiss.index_factory(dim, f"IVF{nlist},Flat")
+        sample = np.random.default_rng(0).permutation(count)[:256 * nlist]
+        index.train(matrix[np.sort(sample)])
+    else:
+        index = faiss.index_factory(dim, f"HNSW{HNSW_M},Flat")
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
+
+
+def _tune_index(index):
+    """Apply the search-time parameters, which can change without a rebuild."""
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, 'nprobe'):
+        index.nprobe = IVF_NPROBE
+    return index
+
+
+def _build_store(embeddings, chunks):
+    """Assemble the index from cached and newly embedded vectors."""
+    documents, vectors = _embed_chunks(chunks, embeddings)
+    if not documents:
+        raise ValueError(f"no text found under {CORPUS_DIR}")
+    matrix = np.asarray(vectors, dtype=np.float32)
+    index = _tune_index(_new_index(matrix))
+    index.add(matrix)
+    ids = [str(uuid.uuid4()) for _ in documents]
+    return FAISS(embeddings, index, InMemoryDocstore(dict(zip(ids, documents))), dict(enumerate(ids)))
+
+
+def _save_store(store, key, files):
+    """Write the index atomically: into a temporary directory, then renamed into place."""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    target = os.path.join(INDEX_DIR, key)
+    staging = tempfile.mkdtemp(prefix=f'.{key}-', dir=INDEX_DIR)
+    try:
+        store.save_local(staging, INDEX_NAME)
+        with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'files': len(files), 'chunks': store.index.ntotal,
+                       'index_type': type(store.index).__name__, 'chunk_size': CHUNK_SIZE,
+                       'chunk_overlap': CHUNK_OVERLAP, 'embedding_model': EMBEDDING_MODEL}, f)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(staging, target)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+    # Older keys belong to corpora or settings no longer in use
+    for name in os.listdir(INDEX_DIR):
+        path = os.path.join(INDEX_DIR, name)
+        if name != key and not name.startswith('.') and os.path.exists(os.path.join(path, 'meta.json')):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _load_docstore(key):
+    """(docstore, index_to_docstore_id) saved for `key`, or None."""
+    docstore_path = os.path.join(INDEX_DIR, key, f'{INDEX_NAME}.pkl')
+    if not os.path.exists(docstore_path):
+        return None
+    # Written by _save_store() from our own build, so unpickling it is safe
+    with open(docstore_path, 'rb') as f:
+        return pickle.load(f)
 
-        # Initialize Embeddings
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=api_key)
 
-        # Load Document
-        file_path = os.path.join(os.path.dirname(__file__), 'data', 'medical_guidelines.txt')
-        if not os.path.exists(file_path):
-            print(f"RAG Error: File not found at {file_path}")
+def _load_store(key, embeddings):
+    """Memory-map the saved index for `key`, or None if there is none."""
+    import faiss
+
+    index_path = os.path.join(INDEX_DIR, key, f'{INDEX_NAME}.faiss')
+    saved = _load_docstore(key) if os.path.exists(index_path) else None
+    if saved is None:
+        return None
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # Not every index type can be memory-mapped
+        index = faiss.read_index(index_path)
+    docstore, index_to_docstore_id = saved
+    return FAISS(embeddings, _tune_index(index), docstore, index_to_docstore_id)
+
+
+def _docstore_texts(docstore, index_to_docstore_id):
+    """Chunk texts in FAISS position order."""
+    return [docstore.search(index_to_docstore_id[position]).page_content
+            for position in range(len(index_to_docstore_id))]
+
+
+def _set_indexes(store, lexical):
+    """Swap in new indexes and drop contexts retrieved from the old ones."""
+    global _indexes
+    with _indexes_lock:
+        _indexes = (store, lexical, _indexes[2] + 1)
+    _query_results.clear()
+
+
+def initialize_rag(force_rebuild=False):
+    try:
+        if not os.path.isdir(CORPUS_DIR):
+            print(f"RAG Error: Directory not found at {CORPUS_DIR}")
             return
 
-        loader = TextLoader(file_path, encoding='utf-8')
-        documents = loader.load()
+        embeddings = _get_embeddings()
+        files = _scan_corpus()
+        key = _index_key(files)
+        store, texts = None, None
+        if embeddings is None:
+            # A saved index still has the chunks, without re-reading the corpus
+            saved = _load_docstore(key)
+            if saved is not None:
+                texts = _docstore_texts(*saved)
+        elif not force_rebuild:
+            store = _load_store(key, embeddings)
+            if store is not None:
+                texts = _docstore_texts(store.docstore, store.index_to_docstore_id)
+                print(f"RAG: Loaded vector store {key} from disk.")
 
-        # Split Text
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        chunks = text_splitter.split_documents(documents)
+        if texts is None:
+            if embeddings is not None:
+                try:
+                    store = _build_store(embeddings, _iter_chunks(files))
+                    texts = _docstore_texts(store.docstore, store.index_to_docstore_id)
+                except Exception as e:
+                    print(f"RAG Error: could not build vector store, retrieval will be lexical only: {e}")
+            if store is not None:
+                try:
+                    _save_store(store, key, files)
+                    print(f"RAG: Vector store {key} built and saved "
+                          f"({len(files)} files, {type(store.index).__name__}).")
+                except OSError as e:
+                    print(f"RAG Error: could not save vector store {key}: {e}")
+            if texts is None:
+                texts = [chunk.page_content for chunk in _iter_chunks(files)]
 
-        # Create Vector Store
-        vector_store = FAISS.from_documents(chunks, embeddings)
-        print("RAG: Vector store initialized successfully.")
+        _set_indexes(store, LexicalIndex(texts))
+        print(f"RAG: Lexical index over {len(texts)} chunks ready.")
 
     except Exception as e:
         print(f"RAG Initialization Error: {e}")
 
-def retrieve_context(query):
-    global vector_store
-    if not vector_store:
+
+def _query_embedding(store, query, text):
+    """
+    Embedding of the query as asked, cached under its normalized `text`; None if
+    it failed or missed the latency budget.
+    """
+    # Query embeddings depend only on the model, so they survive index rebuilds
+    key = (EMBEDDING_MODEL, text)
+    embedding = _query_embeddings.get(key)
+    if embedding is not None:
+        return embedding
+
+    def _cache(future):
+        if future.exception() is None:
+            _query_embeddings.put(key, future.result())
+
+    future = _query_executor.submit(store.embedding_function.embed_query, query.strip())
+    # A late embedding still lands in the cache for the next time this is asked
+    future.add_done_callback(_cache)
+    try:
+        return future.result(timeout=EMBED_TIMEOUT_MS / 1000)
+    except FutureTimeoutError:
+        print(f"RAG: query embedding over {EMBED_TIMEOUT_MS}ms, answering lexically.")
+    except Exception as e:
+        print(f"RAG: query embedding failed, answering lexically: {e}")
+    return None
+
+
+def _vector_search(store, embedding, k):
+    vector = np.asarray([embedding], dtype=np.float32)
+    if getattr(store, '_normalize_L2', False):
+        import faiss
+        faiss.normalize_L2(vector)
+    _, positions = store.index.search(vector, min(k, store.index.ntotal))
+    return [int(position) for position in positions[0] if position >= 0]
+
+
+def _search(store, lexical, query, text, k):
+    """(chunk positions, degraded): degraded results fell back to lexical and are not cached."""
+    # Only hybrid mode shortcuts keyword queries; vector mode always embeds
+    keyword_like = RETRIEVAL_MODE == 'hybrid' and len(text.split()) <= KEYWORD_MAX_TERMS
+    if store is None or RETRIEVAL_MODE == 'lexical' or keyword_like:
+        return lexical.search(text, k), False
+
+    embedding = _query_embedding(store, query, text)
+    if embedding is None:
+        return lexical.search(text, k), True
+
+    if RETRIEVAL_MODE == 'vector':
+        return _vector_search(store, embedding, k), False
+    rankings = [_vector_search(store, embedding, FUSION_CANDIDATES), lexical.search(text, FUSION_CANDIDATES)]
+    return reciprocal_rank_fusion(rankings)[:k], False
+
+
+def retrieve_context(query, k=TOP_K):
+    # One read of the shared tuple; a concurrent swap cannot mix indexes mid-query
+    store, lexical, generation = _indexes
+    if lexical is None:
         return ""
-    
+
+    text = normalize_query(query)
+    result_key = (generation, text, k)
+    context = _query_results.get(result_key)
+    if context is not None:
+        return context
+
     try:
-        # Retrieve top 3 relevant chunks
-        docs = vector_store.similarity_search(query, k=3)
-        context = "\n\n".join([doc.page_content for doc in docs])
+        positions, degraded = _search(store, lexical, query, text, k)
+        context = "\n\n".join([lexical.texts[position] for position in positions])
+        if not degraded:
+            _query_results.put(result_key, context)
         return context
     except Exception as e:
         print(f"RAG Retrieval Error: {e}")
         return ""
+
+
+def retrieval_cache_stats():
+    """Hit, miss and eviction counters of the query caches."""
+    store, _, generation = _indexes
+    return {'generation': generation,
+            'mode': RETRIEVAL_MODE if store is not None else 'lexical',
+            'embeddings': _query_embeddings.stats(),
+            'results': _query_results.stats()}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != 'build':
+        print(__doc__)
+        return 1
+    from dotenv import load_dotenv
+    load_dotenv()
+    initialize_rag(force_rebuild='--force' in argv)
+    return 0 if _indexes[0] is not None else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
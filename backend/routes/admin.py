@@ -10,11 +10,14 @@ def get_stats():
     user_count = db.users.count_documents({})
     doctor_count = db.doctors.count_documents({})
     appointment_count = db.appointments.count_documents({})
+
+    from rag_utils import retrieval_cache_stats
     
     return jsonify({
         "users": user_count,
         "doctors": doctor_count,
-        "appointments": appointment_count
+        "appointments": appointment_count,
+        "rag_cache": retrieval_cache_stats()
     })
 
 @admin_bp.route('/users', methods=['GET'])
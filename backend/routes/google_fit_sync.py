@@ -1,52 +1,75 @@
 """
 Google Fit Data Synchronization Routes
 """
-from flask import Blueprint, request, jsonify
+import json
+from flask import Blueprint, Response, request, jsonify
 from database import get_db
-from services.google_fit_service import GoogleFitService
+from services.google_fit_service import load_fit_service
+from services.fit_sync_engine import FitSyncEngine
+from services.fit_sync_queue import get_sync_queue
+from services.sensor_store import get_sensor_store
+from services.reading_bus import get_reading_bus
+from services.sensor_rollups import RESOLUTIONS
+from services import history_encoding
+from services.downsampling import downsample_series
 from datetime import datetime, timedelta
 
 google_fit_sync_bp = Blueprint('google_fit_sync', __name__)
 
+# Metric types stored in sensor_readings by the sync
+HISTORY_TYPES = ['heart_rate', 'steps', 'calories', 'weight']
+HISTORY_BATCH_SIZE = 5000
+BACKFILL_DAYS = 365
+MAX_BACKFILL_DAYS = 5 * 365
+MIN_MAX_POINTS = 3
+
 
 def _get_fit_service(user_id, db):
     """Helper to get GoogleFitService for a user, returns (service, error_response, tokens)"""
-    tokens_collection = db['google_fit_tokens']
-    token_data = tokens_collection.find_one({'user_id': user_id})
-    if not token_data:
+    fit_service, token_data = load_fit_service(user_id, db)
+    if not fit_service:
         return None, jsonify({"error": "Google Fit not connected. Please connect first."}), 400, None
+    return fit_service, None, None, token_data
 
-    fit_service = GoogleFitService(
-        access_token=token_data['access_token'],
-        refresh_token=token_data.get('refresh_token'),
-        token_expiry=token_data.get('token_expiry')
-    )
-
-    # Refresh token if expired and update DB
-    updated_credentials = fit_service.refresh_token_if_needed()
-    if updated_credentials.token and updated_credentials.token != token_data['access_token']:
-        tokens_collection.update_one(
-            {'user_id': user_id},
-            {'$set': {
-                'access_token': updated_credentials.token,
-                'token_expiry': updated_credentials.expiry
-            }}
-        )
 
-    return fit_service, None, None, token_data
+def _sync_request():
+    """Parse a /sync style JSON body into (user_id, days, full)."""
+    data = request.json or {}
+    # Incremental by default; full re-fetches the whole window (e.g. for backfills)
+    full = data.get('full') is True or request.args.get('full') == 'true'
+    return data.get('user_id'), data.get('days', 7), full
+
+
+def _sync_response(result):
+    """The /sync response body for a FitSyncEngine result."""
+    summary, errors = result['summary'], result['errors']
+    return {
+        "success": len(errors) == 0,
+        "message": "Sync completed" + (f" with {len(errors)} error(s)" if errors else " successfully"),
+        "synced_at": datetime.utcnow().isoformat(),
+        "data_summary": {
+            'heart_rate_readings': summary.get('heart_rate', 0),
+            'sleep_sessions': summary.get('sleep', 0),
+            'activity_days': summary.get('activity', 0),
+            'body_measurements': summary.get('body', 0)
+        },
+        "windows": result['windows'],
+        "counts": result['counts'],
+        "errors": errors
+    }
 
 
 @google_fit_sync_bp.route('/sync', methods=['POST'])
 def sync_google_fit_data():
     """
     Manually trigger sync of Google Fit data.
-    Returns per-type status including errors.
+    Only data newer than each metric's last synced point is fetched unless
+    `full` is true (JSON body or ?full=true), which re-fetches the last `days` days.
+    Returns per-type status including errors, and per reading type
+    upserted / modified / error counts.
     """
     try:
-        data = request.json
-        user_id = data.get('user_id')
-        days = data.get('days', 7)
-
+        user_id, days, full = _sync_request()
         if not user_id:
             return jsonify({"error": "user_id required"}), 400
 
@@ -55,155 +78,45 @@ def sync_google_fit_data():
         if err_resp:
             return err_resp, err_code
 
-        tokens_collection = db['google_fit_tokens']
-        sensor_readings = db['sensor_readings']
-        health_logs = db['health_logs']
-
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=days)
-
-        synced_data = {'heart_rate': [], 'sleep': [], 'activity': [], 'body': []}
-        errors = {}
-
-        # --- Heart Rate ---
-        try:
-            heart_rate_data = fit_service.get_heart_rate_data(start_time, end_time)
-            for reading in heart_rate_data:
-                sensor_readings.update_one(
-                    {
-                        'user_id': user_id,
-                        'type': 'heart_rate',
-                        'recorded_at': reading['timestamp']
-                    },
-                    {
-                        '$set': {
-                            'value': reading['bpm'],
-                            'unit': 'bpm',
-                            'source': 'google_fit',
-                            'synced_at': datetime.utcnow()
-                        }
-                    },
-                    upsert=True
-                )
-            synced_data['heart_rate'] = heart_rate_data
-        except Exception as e:
-            errors['heart_rate'] = str(e)
-
-        # --- Sleep ---
-        try:
-            sleep_data = fit_service.get_sleep_data(start_time, end_time)
-            for sleep_session in sleep_data:
-                health_logs.update_one(
-                    {
-                        'user_id': user_id,
-                        'date': sleep_session['date']
-                    },
-                    {
-                        '$set': {
-                            'sleep_hours': sleep_session['duration_hours'],
-                            'sleep_source': 'google_fit',
-                            'sleep_synced_at': datetime.utcnow()
-                        }
-                    },
-                    upsert=True
-                )
-            synced_data['sleep'] = sleep_data
-        except Exception as e:
-            errors['sleep'] = str(e)
-
-        # --- Activity (Steps, Calories) ---
-        try:
-            activity_data = fit_service.get_activity_data(start_time, end_time)
-            for activity in activity_data:
-                # Use the proper datetime object for the recorded_at key (not a date string)
-                recorded_at = activity['datetime']
-
-                if activity['steps'] > 0:
-                    sensor_readings.update_one(
-                        {
-                            'user_id': user_id,
-                            'type': 'steps',
-                            'recorded_at': recorded_at
-                        },
-                        {
-                            '$set': {
-                                'value': activity['steps'],
-                                'unit': 'steps',
-                                'source': 'google_fit',
-                                'date': activity['date'],
-                                'synced_at': datetime.utcnow()
-                            }
-                        },
-                        upsert=True
-                    )
-
-                if activity['calories'] > 0:
-                    sensor_readings.update_one(
-                        {
-                            'user_id': user_id,
-                            'type': 'calories',
-                            'recorded_at': recorded_at
-                        },
-                        {
-                            '$set': {
-                                'value': activity['calories'],
-                                'unit': 'kcal',
-                                'source': 'google_fit',
-                                'date': activity['date'],
-                                'synced_at': datetime.utcnow()
-                            }
-                        },
-                        upsert=True
-                    )
-            synced_data['activity'] = activity_data
-        except Exception as e:
-            errors['activity'] = str(e)
-
-        # --- Body (Weight) ---
-        try:
-            body_data = fit_service.get_body_data(start_time, end_time)
-            for measurement in body_data:
-                sensor_readings.update_one(
-                    {
-                        'user_id': user_id,
-                        'type': 'weight',
-                        'recorded_at': measurement['timestamp']
-                    },
-                    {
-                        '$set': {
-                            'value': measurement['weight_kg'],
-                            'unit': 'kg',
-                            'source': 'google_fit',
-                            'synced_at': datetime.utcnow()
-                        }
-                    },
-                    upsert=True
-                )
-            synced_data['body'] = body_data
-        except Exception as e:
-            errors['body'] = str(e)
-
-        # Update last sync time
-        tokens_collection.update_one(
-            {'user_id': user_id},
-            {'$set': {'last_sync': datetime.utcnow()}}
-        )
+        result = FitSyncEngine(db=db).sync(user_id, fit_service, days=days, full=full)
+        return jsonify(_sync_response(result))
+
+    except Exception as e:
+        print(f"Sync error: {e}")
+        return jsonify({"error": str(e)}), 500
+
 
+@google_fit_sync_bp.route('/backfill', methods=['POST'])
+def backfill_google_fit_data():
+    """
+    Queue a backfill of the last `days` days (default 365), fetched in windows by
+    the sync workers. An interrupted backfill resumes where it stopped.
+    Returns 202 with the job id and the progress of the current backfill, if any.
+    """
+    try:
+        data = request.json or {}
+        user_id = data.get('user_id')
+        days = int(data.get('days', BACKFILL_DAYS))
+        if not user_id:
+            return jsonify({"error": "user_id required"}), 400
+        if not 1 <= days <= MAX_BACKFILL_DAYS:
+            return jsonify({"error": f"days must be between 1 and {MAX_BACKFILL_DAYS}"}), 400
+
+        db = get_db()
+        token_data = db['google_fit_tokens'].find_one({'user_id': user_id}, {'backfill': 1})
+        if not token_data:
+            return jsonify({"error": "Google Fit not connected. Please connect first."}), 400
+
+        job_id = get_sync_queue().enqueue(user_id, reason='backfill', days=days, backfill=True)
+        progress = (token_data.get('backfill') or {}).get('done', {})
         return jsonify({
-            "success": len(errors) == 0,
-            "message": "Sync completed" + (f" with {len(errors)} error(s)" if errors else " successfully"),
-            "synced_at": datetime.utcnow().isoformat(),
-            "data_summary": {
-                'heart_rate_readings': len(synced_data['heart_rate']),
-                'sleep_sessions': len(synced_data['sleep']),
-                'activity_days': len(synced_data['activity']),
-                'body_measurements': len(synced_data['body'])
-            },
-            "errors": errors
-        })
+            "queued": True,
+            "job_id": str(job_id),
+            "progress": {metric: done.isoformat() for metric, done in progress.items()}
+        }), 202
 
     except Exception as e:
-        print(f"Sync error: {e}")
+        print(f"Backfill error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
@@ -211,24 +124,36 @@ def sync_google_fit_data():
 def sync_and_fetch():
     """
     Sync Google Fit data AND return the latest data in one call.
-    More efficient for frontend use.
+    The newest reading of each type written by the sync is returned as is;
+    only types the sync did not write are read from the database.
     """
-    # First do a sync
-    sync_result = sync_google_fit_data()
-    # sync_result is a Response object; check status
-    if hasattr(sync_result, 'status_code') and sync_result.status_code >= 400:
-        return sync_result
+    try:
+        user_id, days, full = _sync_request()
+        if not user_id:
+            return jsonify({"error": "user_id required"}), 400
 
-    # Then fetch latest from DB
-    user_id = request.json.get('user_id') if request.json else None
-    if not user_id:
-        return jsonify({"error": "user_id required"}), 400
+        db = get_db()
+        fit_service, err_resp, err_code, token_data = _get_fit_service(user_id, db)
+        if err_resp:
+            return err_resp, err_code
+
+        result = FitSyncEngine(db=db).sync(user_id, fit_service, days=days, full=full)
 
-    latest = _fetch_latest(user_id)
-    return jsonify({
-        "sync": sync_result.get_json() if hasattr(sync_result, 'get_json') else {},
-        "latest": latest
-    })
+        latest_by_type = {data_type: doc for data_type, doc in result['latest'].items()
+                          if data_type in HISTORY_TYPES}
+        untouched = [data_type for data_type in HISTORY_TYPES if data_type not in latest_by_type]
+        if untouched:
+            stored, _ = get_sensor_store().latest_by_type(user_id, untouched, source='google_fit')
+            latest_by_type.update(stored)
+
+        return jsonify({
+            "sync": _sync_response(result),
+            "latest": _latest_response(latest_by_type)
+        })
+
+    except Exception as e:
+        print(f"Sync error: {e}")
+        return jsonify({"error": str(e)}), 500
 
 
 @google_fit_sync_bp.route('/latest', methods=['GET'])
@@ -236,22 +161,24 @@ def get_latest_data():
     """
     Get latest synced data from database for all metric types.
     Also returns the last_sync timestamp.
+    The ETag is the user's data version (one _id lookup, shared by all
+    processes), so a poll with a matching If-None-Match gets 304 without
+    running the latest-reading queries.
     """
     try:
         user_id = request.args.get('user_id')
         if not user_id:
             return jsonify({"error": "user_id required"}), 400
 
-        latest_data = _fetch_latest(user_id)
-
-        # Also include last_sync time from tokens
-        db = get_db()
-        token_data = db['google_fit_tokens'].find_one({'user_id': user_id})
-        if token_data:
-            last_sync = token_data.get('last_sync')
-            latest_data['last_sync'] = last_sync.isoformat() if last_sync else None
-
-        return jsonify(latest_data)
+        etag = f"{user_id}-{get_reading_bus().data_version(user_id)}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            # Also include last_sync time from tokens (a $unionWith in the same aggregation)
+            response = jsonify(_fetch_latest(user_id, include_last_sync=True))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -261,34 +188,77 @@ def get_latest_data():
 def get_historical_data():
     """
     Get historical sensor data from database for a date range.
-    Params: user_id, days (default 30)
+    Params: user_id, days (default 30), resolution (raw | 1m | 1h | 1d, default raw),
+            max_points (optional; LTTB-downsample each series to at most this many points)
+    Accept: application/json (default), or a columnar encoding from services/history_encoding.py
     """
     try:
         user_id = request.args.get('user_id')
         days = int(request.args.get('days', 30))
+        resolution = request.args.get('resolution', 'raw')
+        max_points = request.args.get('max_points', type=int)
 
         if not user_id:
             return jsonify({"error": "user_id required"}), 400
-
-        history = _fetch_history(user_id, days)
-        return jsonify(history)
+        if max_points is not None and max_points < MIN_MAX_POINTS:
+            return jsonify({"error": f"max_points must be at least {MIN_MAX_POINTS}"}), 400
+        if resolution != 'raw' and resolution not in RESOLUTIONS:
+            return jsonify({"error": f"resolution must be one of raw, {', '.join(RESOLUTIONS)}"}), 400
+
+        history = _fetch_history(user_id, days, resolution)
+        if max_points:
+            history = {metric: downsample_series(series, max_points) for metric, series in history.items()}
+
+        # Content negotiation: chart clients can ask for a compact columnar encoding
+        media_type = request.accept_mimetypes.best_match(history_encoding.MEDIA_TYPES,
+                                                         default=history_encoding.ROWS)
+        if media_type == history_encoding.COLUMNAR_BINARY:
+            response = Response(history_encoding.to_columnar_binary(history), mimetype=media_type)
+        elif media_type == history_encoding.COLUMNAR_JSON:
+            response = Response(json.dumps(history_encoding.to_columnar_json(history)), mimetype=media_type)
+        else:
+            response = jsonify(history_encoding.to_rows(history))
+        response.headers['Vary'] = 'Accept'
+        return response
 
     except Exception as e:
         print(f"History fetch error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-def _fetch_latest(user_id):
-    """Internal helper: fetch latest readings from DB."""
-    db = get_db()
-    sensor_readings = db['sensor_readings']
+def _fetch_latest(user_id, include_last_sync=False):
+    """
+    Internal helper: fetch latest readings from DB.
+    The newest reading per type (one index seek each) and, optionally,
+    the last_sync time from google_fit_tokens, in a single aggregation.
+    """
+    store = get_sensor_store()
+
+    union_with = None
+    if include_last_sync:
+        union_with = {
+            'coll': 'google_fit_tokens',
+            'pipeline': [
+                {'$match': {'user_id': user_id}},
+                {'$project': {'_id': 0, 'last_sync': 1}},
+            ]
+        }
+    latest_by_type, token_rows = store.latest_by_type(user_id, HISTORY_TYPES, source='google_fit',
+                                                      union_with=union_with)
+
+    latest_data = _latest_response(latest_by_type)
+    if token_rows:
+        last_sync = token_rows[0].get('last_sync')
+        latest_data['last_sync'] = last_sync.isoformat() if last_sync else None
+
+    return latest_data
 
+
+def _latest_response(latest_by_type):
+    """Internal helper: the /latest body for {type: newest reading document}."""
     latest_data = {}
-    for data_type in ['heart_rate', 'steps', 'calories', 'weight']:
-        latest = sensor_readings.find_one(
-            {'user_id': user_id, 'type': data_type, 'source': 'google_fit'},
-            sort=[('recorded_at', -1)]
-        )
+    for data_type in HISTORY_TYPES:
+        latest = latest_by_type.get(data_type)
         if latest:
             synced_at = latest.get('synced_at')
             recorded_at = latest.get('recorded_at')
@@ -299,35 +269,51 @@ def _fetch_latest(user_id):
                 'synced_at': synced_at.isoformat() if synced_at else None,
                 'date': latest.get('date', '')
             }
-
     return latest_data
 
 
-def _fetch_history(user_id, days):
-    """Internal helper: fetch historical readings from DB for last n days."""
-    db = get_db()
-    sensor_readings = db['sensor_readings']
+def _fetch_history(user_id, days, resolution='raw'):
+    """
+    Internal helper: fetch historical readings from DB for last n days as
+    per-type column series (see services/history_encoding.py).
+    With a rollup resolution each point is one bucket: value is the bucket
+    average and min/max/count/last columns are included alongside.
+    """
+    store = get_sensor_store()
 
     end_time = datetime.utcnow()
     start_time = end_time - timedelta(days=days)
 
-    history_data = {}
-    for data_type in ['heart_rate', 'steps', 'calories', 'weight']:
-        cursor = sensor_readings.find({
-            'user_id': user_id,
-            'type': data_type,
-            'source': 'google_fit',
-            'recorded_at': {'$gte': start_time}
-        }).sort('recorded_at', 1)
-
-        history_data[data_type] = []
-        for doc in cursor:
-            recorded_at = doc.get('recorded_at')
-            history_data[data_type].append({
-                'value': doc['value'],
-                'unit': doc['unit'],
-                'recorded_at': recorded_at.isoformat() if recorded_at else None,
-                'date': doc.get('date', '')
-            })
+    if resolution != 'raw':
+        return _fetch_rollup_history(store, user_id, start_time, resolution)
+
+    # One query for all types, grouped by type and ordered by recorded_at
+    history_data = {data_type: history_encoding.new_series() for data_type in HISTORY_TYPES}
+    cursor = store.iter_series(user_id, HISTORY_TYPES, source='google_fit', since=start_time,
+                               fields=['value', 'unit', 'date'], batch_size=HISTORY_BATCH_SIZE)
+    for doc in cursor:
+        series = history_data[doc['type']]
+        series['unit'] = series['unit'] or doc['unit']
+        series['recorded_at'].append(doc.get('recorded_at'))
+        series['value'].append(doc['value'])
+        series['date'].append(doc.get('date', ''))
+
+    return history_data
+
 
+def _fetch_rollup_history(store, user_id, start_time, resolution):
+    """Internal helper: history served from the rollup collection, one point per bucket."""
+    history_data = {data_type: history_encoding.new_series(stats=True) for data_type in HISTORY_TYPES}
+    for rollup in store.rollups.iter_rollups(user_id, HISTORY_TYPES, 'google_fit', resolution, since=start_time):
+        count = rollup.get('count', 0)
+        bucket_start = rollup['bucket_start']
+        series = history_data[rollup['type']]
+        series['unit'] = series['unit'] or rollup.get('unit')
+        series['recorded_at'].append(bucket_start)
+        series['value'].append(round(rollup['sum'] / count, 2) if count else rollup.get('last'))
+        series['date'].append(bucket_start.date().isoformat())
+        series['min'].append(rollup.get('min'))
+        series['max'].append(rollup.get('max'))
+        series['last'].append(rollup.get('last'))
+        series['count'].append(count)
     return history_data
@@ -1,10 +1,15 @@
 from flask import Blueprint, request, jsonify
 from database import get_db
+from services.export_stream import EXPORT_FORMATS, export_response
 from bson.objectid import ObjectId
 import datetime
 
 health_bp = Blueprint('health_logs', __name__)
 
+EXPORT_BATCH_SIZE = 500
+EXPORT_FIELDS = ['log_date', 'date', 'mood', 'energy_level', 'sleep_hours', 'sleep_source',
+                 'symptoms', 'medications', 'notes']
+
 @health_bp.route('', methods=['GET'])
 def get_logs():
     user_id = request.args.get('user_id')
@@ -84,3 +89,43 @@ def delete_log(id):
     db = get_db()
     db.health_logs.delete_one({"_id": ObjectId(id)})
     return jsonify({"message": "Deleted"}), 200
+
+@health_bp.route('/export', methods=['GET'])
+def export_logs():
+    """
+    Stream a user's health logs as CSV or NDJSON.
+    Params: user_id, format (csv | ndjson, default csv), since / until (YYYY-MM-DD, inclusive).
+    Logs are ordered by day, whether stored as log_date or (Google Fit sleep) date.
+    """
+    user_id = request.args.get('user_id')
+    fmt = request.args.get('format', 'csv')
+    if not user_id:
+        return jsonify({"error": "user_id required"}), 400
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+
+    # Logs from the form carry `log_date`; Google Fit sleep upserts carry `date`
+    match = {"user_id": user_id}
+    date_range = {}
+    if request.args.get('since'):
+        date_range['$gte'] = request.args['since']
+    if request.args.get('until'):
+        date_range['$lte'] = request.args['until']
+    if date_range:
+        # Each branch can use its (user_id, log_date) / (user_id, date) index
+        match["$or"] = [{"log_date": date_range}, {"date": date_range}]
+
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"_day": {"$ifNull": ["$log_date", "$date"]}}},
+    ]
+    if date_range:
+        pipeline.append({"$match": {"_day": date_range}})
+    pipeline += [
+        {"$sort": {"_day": 1, "_id": 1}},
+        {"$project": dict.fromkeys(EXPORT_FIELDS, 1)},
+    ]
+
+    db = get_db()
+    cursor = db.health_logs.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE)
+    return export_response(cursor, EXPORT_FIELDS, fmt, 'health_logs')
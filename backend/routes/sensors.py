@@ -1,37 +1,340 @@
-from flask import Blueprint, request, jsonify
-from database import get_db
-from bson.objectid import ObjectId
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from services.sensor_store import get_sensor_store, _to_datetime
+from services.export_stream import EXPORT_FORMATS, export_response
+from services.reading_bus import get_reading_bus, SubscriberLimitReached
+import codecs
 import datetime
+import json
+import os
+import re
 
 sensors_bp = Blueprint('sensors', __name__)
 
+REQUIRED_FIELDS = ('user_id', 'reading_type', 'value', 'unit', 'source')
+
+# Batch ingestion limits: readings are written in chunks of BATCH_CHUNK_SIZE and
+# the request body is read READ_CHUNK_BYTES at a time, so memory stays flat.
+BATCH_CHUNK_SIZE = int(os.getenv('SENSOR_BATCH_CHUNK_SIZE', 500))
+READ_CHUNK_BYTES = 64 * 1024
+MAX_ITEM_BYTES = 64 * 1024
+MAX_PAGE_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FIELDS = ['id', 'recorded_at', 'type', 'value', 'unit', 'source', 'device_name', 'date']
+# Idle live streams send a comment frame this often so proxies keep them open
+STREAM_HEARTBEAT_SECONDS = int(os.getenv('SENSOR_STREAM_HEARTBEAT_SECONDS', 15))
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _build_reading(data):
+    """Validate a reading payload and return the document to store. Raises ValueError."""
+    if not isinstance(data, dict):
+        raise ValueError("Reading must be a JSON object")
+    missing = [field for field in REQUIRED_FIELDS if data.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing field(s): {', '.join(missing)}")
+
+    # Stored as a BSON date so range scans and index order match Google Fit readings
+    recorded_at = data.get('recorded_at')
+    if recorded_at:
+        recorded_at = _to_datetime(str(recorded_at))
+        if recorded_at is None:
+            raise ValueError("recorded_at must be an ISO 8601 timestamp")
+    else:
+        recorded_at = datetime.datetime.utcnow()
+
+    return {
+        "user_id": data['user_id'],
+        "reading_type": data['reading_type'],
+        "value": data['value'],
+        "unit": data['unit'],
+        "source": data['source'],
+        "device_name": data.get('device_name'),
+        "recorded_at": recorded_at
+    }
+
+
+def _iter_ndjson(stream):
+    """Yield (item, error) for each non-empty line of an NDJSON body."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        pending += decoder.decode(chunk, final=not chunk)
+        lines = pending.split('\n')
+        pending = lines.pop() if chunk else ''
+        if len(pending) > MAX_ITEM_BYTES:
+            raise ValueError("Reading exceeds maximum item size")
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line), None
+            except ValueError:
+                yield None, "Invalid JSON"
+        if not chunk:
+            return
+
+
+def _iter_json_array(stream):
+    """
+    Yield (item, error) for each element of a JSON array body without
+    buffering more than one element at a time. A malformed element ends the
+    array, since the elements after it cannot be delimited; the ValueError
+    carries the decoder's message and position in the body.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    # `pos` indexes into `buf`; consumed text is trimmed once per chunk read, and
+    # `offset` counts the characters trimmed so far
+    buf, pos, offset = '', 0, 0
+    started, eof = False, False
+    while True:
+        pos = _JSON_WHITESPACE.match(buf, pos).end()
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError("Body must be a JSON array")
+                pos, started = pos + 1, True
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                # Errors within the last few characters (or in an open string) may only
+                # mean the element continues in the next chunk; so may a missing delimiter below
+                if eof or (len(buf) - e.pos > 16 and not e.msg.startswith('Unterminated string')):
+                    raise ValueError(f"Invalid JSON at character {offset + e.pos}: {e.msg}")
+            else:
+                # Only a following delimiter shows the element is complete: "1" may be "1.5"
+                after = _JSON_WHITESPACE.match(buf, end).end()
+                if eof or (after < len(buf) and buf[after] in ',]'):
+                    pos = end
+                    yield item, None
+                    continue
+                if len(buf) - after > 16:
+                    raise ValueError(f"Invalid JSON at character {offset + after}: Expecting ',' delimiter")
+
+        if eof:
+            raise ValueError("Unexpected end of JSON array" if started else "Empty request body")
+        if len(buf) - pos > MAX_ITEM_BYTES:
+            raise ValueError("Reading exceeds maximum item size")
+        offset += pos
+        buf, pos = buf[pos:], 0
+        chunk = stream.read(READ_CHUNK_BYTES)
+        eof = not chunk
+        buf += text.decode(chunk, final=eof)
+
+
+def _serialize_reading(reading):
+    reading['id'] = str(reading.pop('_id'))
+    for field in ('recorded_at', 'end_at'):
+        if isinstance(reading.get(field), datetime.datetime):
+            reading[field] = reading[field].isoformat()
+    return reading
+
+
+def _parse_time_arg(name):
+    """Parse an optional ISO 8601 query parameter to a naive UTC datetime. Raises ValueError."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    parsed = _to_datetime(value)
+    if parsed is None:
+        raise ValueError(f"{name} must be an ISO 8601 timestamp")
+    return parsed
+
+
 @sensors_bp.route('', methods=['GET'])
 def get_readings():
+    """
+    Newest readings first, one page at a time.
+    Params: user_id, limit (default 50, clamped to 1..MAX_PAGE_SIZE), since / until (ISO 8601),
+    cursor (from the X-Next-Cursor header of the previous page),
+    spans (true to return compacted heart-rate runs as {..., end_at, count} records).
+    """
     user_id = request.args.get('user_id')
-    limit = int(request.args.get('limit', 50))
-    
-    db = get_db()
-    readings = list(db.sensor_readings.find({"user_id": user_id}).sort("recorded_at", -1).limit(limit))
+    spans = request.args.get('spans') == 'true'
+    store = get_sensor_store()
+
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    # The stores treat a falsy limit as "no limit"
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    try:
+        since = _parse_time_arg('since')
+        until = _parse_time_arg('until')
+        cursor = request.args.get('cursor')
+        after = store.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    for reading in readings:
-        reading['id'] = str(reading.pop('_id'))
+    docs = list(store.iter_readings(user_id, since=since, until=until, descending=True,
+                                    limit=limit, after=after, expand=not spans))
+    next_cursor = store.encode_cursor(docs[-1]) if len(docs) == limit else None
+    readings = [_serialize_reading(r) for r in docs]
         
-    return jsonify(readings)
+    response = jsonify(readings)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @sensors_bp.route('', methods=['POST'])
 def save_reading():
     data = request.json
-    db = get_db()
     
-    new_reading = {
-        "user_id": data['user_id'],
-        "reading_type": data['reading_type'],
-        "value": data['value'],
-        "unit": data['unit'],
-        "source": data['source'],
-        "device_name": data.get('device_name'),
-        "recorded_at": datetime.datetime.utcnow().isoformat()
-    }
+    try:
+        new_reading = _build_reading(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    res = db.sensor_readings.insert_one(new_reading)
-    return jsonify({"message": "Saved", "id": str(res.inserted_id)}), 201
+    reading_id = get_sensor_store().insert_reading(new_reading)
+    return jsonify({"message": "Saved", "id": reading_id}), 201
+
+@sensors_bp.route('/batch', methods=['POST'])
+def save_readings_batch():
+    """
+    Ingest many readings in one request.
+    Body: a JSON array of readings, or NDJSON (one reading per line) when sent
+    with Content-Type application/x-ndjson. Readings are validated individually
+    and written with unordered insert_many in chunks of BATCH_CHUNK_SIZE.
+    The response is streamed as it is produced:
+        {"results": [{"index", "status": "accepted"|"rejected", "id"|"error"}, ...],
+         "accepted": n, "rejected": n}
+    """
+    mimetype = request.mimetype or ''
+    if mimetype in ('application/x-ndjson', 'application/jsonl', 'application/jsonlines'):
+        items = _iter_ndjson(request.stream)
+    else:
+        items = _iter_json_array(request.stream)
+
+    def generate():
+        store = get_sensor_store()
+        counts = {'accepted': 0, 'rejected': 0}
+        pending = []  # (index, doc)
+        first = True
+
+        def result(index, status, key, value):
+            nonlocal first
+            counts[status] += 1
+            prefix = '' if first else ','
+            first = False
+            return prefix + json.dumps({"index": index, "status": status, key: value})
+
+        def flush():
+            errors = store.insert_readings([doc for _, doc in pending])
+            for position, (index, doc) in enumerate(pending):
+                if position in errors:
+                    yield result(index, 'rejected', 'error', errors[position])
+                else:
+                    yield result(index, 'accepted', 'id', str(doc['_id']))
+            pending.clear()
+
+        yield '{"results": ['
+        error = None
+        # Bump each user's data version once for the upload, not once per chunk
+        with store.bus.batched_versions():
+            try:
+                for index, (item, parse_error) in enumerate(items):
+                    try:
+                        if parse_error:
+                            raise ValueError(parse_error)
+                        pending.append((index, _build_reading(item)))
+                    except ValueError as e:
+                        yield result(index, 'rejected', 'error', str(e))
+                        continue
+                    if len(pending) >= BATCH_CHUNK_SIZE:
+                        yield from flush()
+            except ValueError as e:
+                error = str(e)
+            if pending:
+                yield from flush()
+
+        summary = {"accepted": counts['accepted'], "rejected": counts['rejected']}
+        if error:
+            summary["error"] = error
+        yield '], ' + json.dumps(summary)[1:]
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@sensors_bp.route('/export', methods=['GET'])
+def export_readings():
+    """
+    Stream a user's readings oldest first as CSV or NDJSON.
+    Params: user_id, format (csv | ndjson, default csv), type, since / until (ISO 8601).
+    Responses are gzip-compressed on the fly when the client accepts it.
+    """
+    user_id = request.args.get('user_id')
+    fmt = request.args.get('format', 'csv')
+    reading_type = request.args.get('type')
+
+    if not user_id:
+        return jsonify({"error": "user_id required"}), 400
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        since = _parse_time_arg('since')
+        until = _parse_time_arg('until')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    store = get_sensor_store()
+    docs = store.iter_readings(
+        user_id,
+        types=[reading_type] if reading_type else None,
+        since=since,
+        until=until,
+        fields=['type', 'reading_type', 'value', 'unit', 'source', 'device_name', 'date'],
+        batch_size=EXPORT_BATCH_SIZE
+    )
+    rows = ({**doc, 'id': doc['_id'], 'type': doc.get('type') or doc.get('reading_type')} for doc in docs)
+    return export_response(rows, EXPORT_FIELDS, fmt, 'sensor_readings')
+
+
+@sensors_bp.route('/stream', methods=['GET'])
+def stream_readings():
+    """
+    Server-Sent Events stream of a user's readings as they are written.
+    Params: user_id
+    Events:
+        reading - one new or changed reading {id, type, value, unit, source, recorded_at, ...}
+        resync  - the client fell behind and {dropped} events were discarded; refetch /latest
+    A `: heartbeat` comment is sent every STREAM_HEARTBEAT_SECONDS while idle.
+    """
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": "user_id required"}), 400
+
+    try:
+        subscription = get_reading_bus().subscribe(user_id)
+    except SubscriberLimitReached:
+        return jsonify({"error": "Too many live connections, please retry later"}), 503
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                events, dropped = subscription.get(STREAM_HEARTBEAT_SECONDS)
+                if dropped:
+                    yield f"event: resync\ndata: {json.dumps({'dropped': dropped})}\n\n"
+                for event in events:
+                    yield f"event: reading\ndata: {json.dumps(event)}\n\n"
+                if not events:
+                    yield ": heartbeat\n\n"
+        finally:
+            subscription.close()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The generator's finally never runs if the client leaves before the first chunk;
+    # closing is idempotent, so release the slot on response close as well
+    response.call_on_close(subscription.close)
+    return response
@@ -0,0 +1,337 @@
+"""
+Database Index Registry
+Declares the indexes each blueprint's queries rely on, applies them idempotently
+and verifies that every registered query shape is served by an index.
+
+Usage:
+    python -m services.db_indexes            # create / update indexes
+    python -m services.db_indexes --check    # explain() every query shape, fail on COLLSCAN
+"""
+import sys
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from bson.objectid import ObjectId
+from database import get_db
+
+
+# Each entry: collection, index keys and extra create_index options.
+# Names are explicit so that re-running is a no-op and the check output is readable.
+INDEXES = [
+    # routes/sensors.py: keyset pages of find({user_id}).sort(recorded_at desc, _id desc)
+    {
+        'collection': 'sensor_readings',
+        'keys': [('user_id', ASCENDING), ('recorded_at', DESCENDING), ('_id', DESCENDING)],
+        'options': {'name': 'user_recorded_at_id'},
+    },
+    # routes/google_fit_sync.py: upserts on (user_id, type, recorded_at) and
+    # _fetch_latest / _fetch_history on (user_id, type, source) sorted by recorded_at
+    {
+        'collection': 'sensor_readings',
+        'keys': [('user_id', ASCENDING), ('type', ASCENDING), ('recorded_at', DESCENDING)],
+        'options': {'name': 'user_type_recorded_at'},
+    },
+    {
+        'collection': 'sensor_readings',
+        'keys': [('user_id', ASCENDING), ('type', ASCENDING), ('source', ASCENDING), ('recorded_at', DESCENDING)],
+        'options': {
+            'name': 'google_fit_user_type_recorded_at',
+            'partialFilterExpression': {'source': 'google_fit'},
+        },
+    },
+    # services/sensor_store.py bucket mode: per-hour bucket documents
+    {
+        'collection': 'sensor_buckets',
+        'keys': [('user_id', ASCENDING), ('bucket_start', DESCENDING)],
+        'options': {'name': 'user_bucket_start'},
+    },
+    {
+        'collection': 'sensor_buckets',
+        'keys': [('user_id', ASCENDING), ('type', ASCENDING), ('source', ASCENDING), ('bucket_start', DESCENDING)],
+        'options': {'name': 'user_type_source_bucket_start'},
+    },
+    # services/sensor_rollups.py: /history served at a rollup resolution
+    {
+        'collection': 'sensor_rollups',
+        'keys': [('user_id', ASCENDING), ('source', ASCENDING), ('resolution', ASCENDING),
+                 ('type', ASCENDING), ('bucket_start', ASCENDING)],
+        'options': {'name': 'user_source_resolution_type_bucket_start'},
+    },
+    # routes/health.py: lookup on (user_id, log_date)
+    {
+        'collection': 'health_logs',
+        'keys': [('user_id', ASCENDING), ('log_date', ASCENDING)],
+        'options': {'name': 'user_log_date'},
+    },
+    # Google Fit sleep upserts key health_logs on (user_id, date)
+    {
+        'collection': 'health_logs',
+        'keys': [('user_id', ASCENDING), ('date', ASCENDING)],
+        'options': {
+            'name': 'user_sleep_date',
+            'partialFilterExpression': {'date': {'$exists': True}},
+        },
+    },
+    # routes/notifications.py: find({user_id}).sort(created_at desc)
+    {
+        'collection': 'notifications',
+        'keys': [('user_id', ASCENDING), ('created_at', DESCENDING)],
+        'options': {'name': 'user_created_at'},
+    },
+    # routes/appointments.py: find({user_id})
+    {
+        'collection': 'appointments',
+        'keys': [('user_id', ASCENDING), ('appointment_date', ASCENDING)],
+        'options': {'name': 'user_appointment_date'},
+    },
+    # services/reminder_scheduler.py: status $in + appointment_date range scans
+    {
+        'collection': 'appointments',
+        'keys': [('status', ASCENDING), ('appointment_date', ASCENDING)],
+        'options': {'name': 'status_appointment_date'},
+    },
+    # services/reminder_scheduler.py: active medications that have a schedule
+    {
+        'collection': 'medications',
+        'keys': [('active', ASCENDING)],
+        'options': {
+            'name': 'active_with_schedule',
+            'partialFilterExpression': {'schedule': {'$exists': True}},
+        },
+    },
+    {
+        'collection': 'medications',
+        'keys': [('user_id', ASCENDING)],
+        'options': {'name': 'user_id'},
+    },
+    # routes/auth.py: login / register by email
+    {
+        'collection': 'users',
+        'keys': [('email', ASCENDING)],
+        'options': {'name': 'email'},
+    },
+    {
+        'collection': 'profiles',
+        'keys': [('user_id', ASCENDING)],
+        'options': {'name': 'user_id'},
+    },
+    {
+        'collection': 'google_fit_tokens',
+        'keys': [('user_id', ASCENDING)],
+        'options': {'name': 'user_id', 'unique': True},
+    },
+    # services/fit_sync_queue.py: users due for a scheduled sync
+    {
+        'collection': 'google_fit_tokens',
+        'keys': [('last_sync', ASCENDING)],
+        'options': {'name': 'last_sync'},
+    },
+    # services/fit_sync_queue.py: claims by (status, run_at), lease recovery
+    # by (status, lease_until), one queued job per user
+    {
+        'collection': 'fit_sync_jobs',
+        'keys': [('status', ASCENDING), ('run_at', ASCENDING)],
+        'options': {'name': 'status_run_at'},
+    },
+    {
+        'collection': 'fit_sync_jobs',
+        'keys': [('status', ASCENDING), ('lease_until', ASCENDING)],
+        'options': {'name': 'status_lease_until'},
+    },
+    {
+        'collection': 'fit_sync_jobs',
+        'keys': [('user_id', ASCENDING)],
+        'options': {
+            'name': 'queued_user_id',
+            'unique': True,
+            'partialFilterExpression': {'status': 'queued'},
+        },
+    },
+    # Finished jobs are kept for a week for inspection
+    {
+        'collection': 'fit_sync_jobs',
+        'keys': [('finished_at', ASCENDING)],
+        'options': {'name': 'finished_at_ttl', 'expireAfterSeconds': 7 * 24 * 3600},
+    },
+    # Concurrency slots are looked up by _id; expired ones (dead workers) are
+    # taken over by claims, the TTL only keeps the collection tidy
+    {
+        'collection': 'fit_sync_slots',
+        'keys': [('lease_until', ASCENDING)],
+        'options': {'name': 'lease_until_ttl', 'expireAfterSeconds': 0},
+    },
+    {
+        'collection': 'email_preferences',
+        'keys': [('user_id', ASCENDING)],
+        'options': {'name': 'user_id'},
+    },
+    # services/reminder_scheduler.py: daily goal reminder scan
+    {
+        'collection': 'email_preferences',
+        'keys': [('daily_goal_reminders.enabled', ASCENDING)],
+        'options': {
+            'name': 'daily_goal_enabled',
+            'partialFilterExpression': {'daily_goal_reminders.enabled': True},
+        },
+    },
+]
+
+
+# Indexes superseded by an entry above; dropped by ensure_indexes() if present.
+RETIRED_INDEXES = [
+    ('sensor_readings', 'user_recorded_at'),
+]
+
+
+def _query_shapes():
+    """
+    Representative query shapes issued by the application, used by check mode.
+    Values are placeholders; only the shape matters to the planner.
+    """
+    now = datetime.utcnow()
+    uid = '__index_check__'
+    return [
+        {'collection': 'sensor_readings', 'filter': {'user_id': uid},
+         'sort': [('recorded_at', DESCENDING), ('_id', DESCENDING)], 'limit': 50},
+        {'collection': 'sensor_readings',
+         'filter': {'user_id': uid, 'recorded_at': {'$lt': now},
+                    '$or': [{'recorded_at': {'$lt': now}}, {'recorded_at': now, '_id': {'$lt': ObjectId()}}]},
+         'sort': [('recorded_at', DESCENDING), ('_id', DESCENDING)], 'limit': 50},
+        {'collection': 'sensor_readings', 'filter': {'user_id': uid, 'type': 'heart_rate', 'recorded_at': now}},
+        {'collection': 'sensor_readings', 'filter': {'user_id': uid, 'type': 'heart_rate', 'source': 'google_fit'},
+         'sort': [('recorded_at', DESCENDING)], 'limit': 1},
+        {'collection': 'sensor_readings',
+         'filter': {'user_id': uid, 'type': 'heart_rate', 'source': 'google_fit',
+                    'recorded_at': {'$gte': now - timedelta(days=30)}},
+         'sort': [('recorded_at', ASCENDING)]},
+        {'collection': 'sensor_buckets', 'filter': {'user_id': uid},
+         'sort': [('bucket_start', DESCENDING)]},
+        {'collection': 'sensor_buckets',
+         'filter': {'user_id': uid, 'type': {'$in': ['heart_rate']}, 'source': 'google_fit',
+                    'bucket_start': {'$gte': now - timedelta(days=30)}},
+         'sort': [('bucket_start', ASCENDING)]},
+        {'collection': 'sensor_rollups',
+         'filter': {'user_id': uid, 'type': {'$in': ['heart_rate', 'steps']}, 'source': 'google_fit',
+                    'resolution': '1h', 'bucket_start': {'$gte': now - timedelta(days=30)}},
+         'sort': [('type', ASCENDING), ('bucket_start', ASCENDING)]},
+        {'collection': 'sensor_readings',
+         'filter': {'user_id': uid, 'type': {'$in': ['heart_rate', 'steps', 'calories', 'weight']},
+                    'source': 'google_fit', 'recorded_at': {'$gte': now - timedelta(days=30)}},
+         'sort': [('type', DESCENDING), ('recorded_at', ASCENDING)]},
+        {'collection': 'health_logs', 'filter': {'user_id': uid, 'log_date': '2024-01-01'}},
+        {'collection': 'health_logs', 'filter': {'user_id': uid}},
+        {'collection': 'health_logs', 'filter': {'user_id': uid, 'date': '2024-01-01'}},
+        {'collection': 'notifications', 'filter': {'user_id': uid}, 'sort': [('created_at', DESCENDING)]},
+        {'collection': 'appointments', 'filter': {'user_id': uid}},
+        {'collection': 'appointments',
+         'filter': {'appointment_date': {'$gte': now, '$lte': now + timedelta(hours=25)},
+                    'status': {'$in': ['scheduled', 'pending']},
+                    'reminder_sent_24h': {'$ne': True}}},
+        {'collection': 'medications', 'filter': {'user_id': uid}},
+        {'collection': 'medications', 'filter': {'schedule': {'$exists': True}, 'active': True}},
+        {'collection': 'users', 'filter': {'email': 'check@example.com'}},
+        {'collection': 'profiles', 'filter': {'user_id': uid}},
+        {'collection': 'google_fit_tokens', 'filter': {'user_id': uid}},
+        {'collection': 'google_fit_tokens',
+         'filter': {'$or': [{'last_sync': {'$lt': now}}, {'last_sync': None}]}},
+        {'collection': 'fit_sync_jobs', 'filter': {'user_id': uid, 'status': 'queued'}},
+        {'collection': 'fit_sync_jobs', 'filter': {'status': 'queued', 'run_at': {'$lte': now}},
+         'sort': [('run_at', ASCENDING)]},
+        {'collection': 'fit_sync_jobs', 'filter': {'status': 'running', 'lease_until': {'$lt': now}}},
+        {'collection': 'email_preferences', 'filter': {'user_id': uid}},
+        {'collection': 'email_preferences', 'filter': {'daily_goal_reminders.enabled': True}},
+    ]
+
+
+def ensure_indexes(db=None):
+    """
+    Create every registered index. create_index is a no-op when an identical
+    index already exists; an index whose options changed is dropped and rebuilt.
+    Returns the list of index names that were created or rebuilt.
+    """
+    db = db if db is not None else get_db()
+    changed = []
+    for collection_name, name in RETIRED_INDEXES:
+        if name in db[collection_name].index_information():
+            db[collection_name].drop_index(name)
+            print(f"🗑️ Dropped retired index {collection_name}.{name}")
+    for spec in INDEXES:
+        collection = db[spec['collection']]
+        options = dict(spec['options'])
+        name = options['name']
+        existing = collection.index_information().get(name)
+        if existing and _matches(existing, spec):
+            continue
+        if existing:
+            collection.drop_index(name)
+        try:
+            collection.create_index(spec['keys'], **options)
+        except OperationFailure as e:
+            print(f"❌ Failed to create index {spec['collection']}.{name}: {e}")
+            continue
+        changed.append(f"{spec['collection']}.{name}")
+        print(f"✅ Index ready: {spec['collection']}.{name}")
+    return changed
+
+
+def _matches(existing, spec):
+    """Compare an index_information() entry with a registry entry."""
+    if [tuple(k) for k in existing.get('key', [])] != [tuple(k) for k in spec['keys']]:
+        return False
+    options = spec['options']
+    for option in ('unique', 'partialFilterExpression', 'expireAfterSeconds'):
+        if existing.get(option) != options.get(option):
+            return False
+    return True
+
+
+def _plan_stages(plan):
+    """Yield stage names from an explain() winning plan tree."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for key in ('inputStage', 'queryPlan', 'winningPlan'):
+            if key in plan:
+                yield from _plan_stages(plan[key])
+        for child in plan.get('inputStages', []):
+            yield from _plan_stages(child)
+
+
+def check_query_plans(db=None):
+    """
+    Run explain() on every registered query shape.
+    Returns a list of (collection, filter, stages) for shapes that fell back to COLLSCAN.
+    """
+    db = db if db is not None else get_db()
+    failures = []
+    for shape in _query_shapes():
+        cursor = db[shape['collection']].find(shape['filter'])
+        if shape.get('sort'):
+            cursor = cursor.sort(shape['sort'])
+        if shape.get('limit'):
+            cursor = cursor.limit(shape['limit'])
+        explain = cursor.explain()
+        stages = list(_plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {})))
+        if 'COLLSCAN' in stages:
+            failures.append((shape['collection'], shape['filter'], stages))
+            print(f"❌ COLLSCAN: {shape['collection']} {shape['filter']}")
+        else:
+            print(f"✅ {shape['collection']}: {' <- '.join(stages)}")
+    return failures
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    db = get_db()
+    ensure_indexes(db)
+    if '--check' in argv:
+        failures = check_query_plans(db)
+        if failures:
+            print(f"❌ {len(failures)} query shape(s) fall back to COLLSCAN")
+            return 1
+        print("✅ All registered query shapes use an index")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Series Downsampling
+Largest-Triangle-Three-Buckets (LTTB) reduction of chart series, so long ranges
+ship a bounded number of points that still keep the visual peaks and troughs.
+"""
+import numpy as np
+
+from services.history_encoding import EPOCH, MILLISECOND
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Indices of the points LTTB keeps out of (x, y), always including the first
+    and last point. Returns every index when the series is already small enough.
+
+    Bucket averages are computed for all buckets at once from cumulative sums and
+    each bucket's triangle areas are evaluated as one vector operation; only the
+    choice of the previously selected point is inherently sequential.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # threshold - 2 buckets over the interior points [1, n - 1)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    sizes = ends - starts
+    bucket_avg_x = (cum_x[ends] - cum_x[starts]) / sizes
+    bucket_avg_y = (cum_y[ends] - cum_y[starts]) / sizes
+    # Each bucket is scored against the average of the next one; the last against the final point
+    next_avg_x = np.append(bucket_avg_x[1:], x[-1])
+    next_avg_y = np.append(bucket_avg_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    anchor = 0
+    for i in range(threshold - 2):
+        start, end = starts[i], ends[i]
+        ax, ay = x[anchor], y[anchor]
+        areas = np.abs(
+            (ax - next_avg_x[i]) * (y[start:end] - ay)
+            - (ax - x[start:end]) * (next_avg_y[i] - ay)
+        )
+        anchor = start + int(np.argmax(areas))
+        selected[i + 1] = anchor
+    return selected
+
+
+def downsample_series(series, max_points):
+    """
+    Reduce a history series (see services/history_encoding.py) to at most
+    max_points points with LTTB on its value column. Every other column is
+    filtered with the same indices, so rollup min/max/count stay aligned.
+    """
+    length = len(series['value'])
+    if length <= max_points:
+        return series
+
+    x = np.fromiter(((dt - EPOCH) // MILLISECOND for dt in series['recorded_at']), dtype=np.float64, count=length)
+    y = np.asarray([np.nan if v is None else v for v in series['value']], dtype=np.float64)
+    y = np.nan_to_num(y, nan=np.nanmean(y) if np.isfinite(y).any() else 0.0)
+    keep = lttb_indices(x, y, max_points).tolist()
+
+    reduced = {'unit': series['unit']}
+    for column, values in series.items():
+        if column != 'unit':
+            reduced[column] = [values[i] for i in keep]
+    return reduced
@@ -0,0 +1,61 @@
+"""
+Chunk Embedding Cache
+On-disk cache of document-chunk embeddings, keyed by the sha256 of the chunk
+text and the embedding model name, used by rag_utils so that editing the
+knowledge base only re-embeds the chunks that changed.
+
+Vectors are stored as float32 blobs in a SQLite file next to the FAISS index.
+"""
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+# SQLite's default limit on host parameters is 999
+LOOKUP_BATCH = 500
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Chunk-hash -> vector for one embedding model."""
+
+    def __init__(self, path, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL,'
+            ' PRIMARY KEY (model, hash))'
+        )
+        self._conn.commit()
+
+    def get_many(self, hashes):
+        """{hash: vector} for the hashes that are cached."""
+        hashes = list(hashes)
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), LOOKUP_BATCH):
+                batch = hashes[start:start + LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [self.model, *batch]
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        """Store (hash, vector) pairs."""
+        rows = [(self.model, key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
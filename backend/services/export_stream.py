@@ -0,0 +1,90 @@
+"""
+Streaming Export Helpers
+Turn a document iterator (usually a Mongo cursor) into a chunked CSV or NDJSON
+response, optionally gzip-compressed on the fly, without materializing the result.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from flask import Response, request, stream_with_context
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows are serialized and flushed to the client this many at a time
+ROWS_PER_CHUNK = 500
+
+
+def _plain(value):
+    """Make a Mongo value JSON / CSV friendly."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return value
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def iter_csv(rows, fields):
+    """Yield CSV text, header first, ROWS_PER_CHUNK rows per chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    pending = 0
+    for row in rows:
+        values = []
+        for field in fields:
+            value = _plain(row.get(field))
+            values.append(json.dumps(value) if isinstance(value, (list, dict)) else value)
+        writer.writerow(values)
+        pending += 1
+        if pending >= ROWS_PER_CHUNK:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows, fields):
+    """Yield NDJSON text, ROWS_PER_CHUNK lines per chunk."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({field: _plain(row.get(field)) for field in fields}))
+        if len(lines) >= ROWS_PER_CHUNK:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_gzip(chunks):
+    """Gzip a stream of text chunks incrementally."""
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(rows, fields, fmt, filename):
+    """
+    Build a streamed download response for `rows` in `fmt` ('csv' or 'ndjson').
+    Compresses with gzip when the client's Accept-Encoding allows it (q > 0).
+    """
+    chunks = iter_csv(rows, fields) if fmt == 'csv' else iter_ndjson(rows, fields)
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}.{fmt}',
+        'Vary': 'Accept-Encoding',
+        'X-Accel-Buffering': 'no',
+    }
+    if request.accept_encodings['gzip'] > 0:
+        chunks = iter_gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt], headers=headers)
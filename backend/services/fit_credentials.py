@@ -0,0 +1,191 @@
+"""
+Google Fit Credential Cache
+Process-wide cache of Google Fit tokens in front of `google_fit_tokens`, so
+concurrent syncs for a user share one access token and one refresh.
+
+- Concurrent refreshes for the same user wait on a per-user lock and share the
+  result of a single token request.
+- A refreshed token is stored with a compare-and-set on the access token it
+  replaces; a process that loses that race adopts the stored token instead.
+- Tokens expiring within FIT_TOKEN_REFRESH_AHEAD_SECONDS are refreshed on a
+  background thread while callers keep using the still-valid token.
+- Entries are re-read from MongoDB after FIT_TOKEN_CACHE_SECONDS, so connects,
+  disconnects and refreshes made by other processes are picked up.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from pymongo import ReturnDocument
+from database import get_db
+
+REFRESH_AHEAD = timedelta(seconds=int(os.getenv('FIT_TOKEN_REFRESH_AHEAD_SECONDS', 900)))
+CACHE_SECONDS = int(os.getenv('FIT_TOKEN_CACHE_SECONDS', 60))
+# Treat tokens this close to expiry as expired; google-auth itself refreshes
+# slightly under 4 minutes early, so a token we hand out is never refreshed again by it
+EXPIRY_MARGIN = timedelta(minutes=5)
+REFRESH_WORKERS = 2
+TOKEN_URI = 'https://oauth2.googleapis.com/token'
+TOKEN_FIELDS = {'_id': 0, 'user_id': 1, 'access_token': 1, 'refresh_token': 1, 'token_expiry': 1}
+
+
+def token_expiry_utc(token):
+    """token_expiry as a naive UTC datetime (what google-auth compares against), or None."""
+    expiry = token.get('token_expiry')
+    if isinstance(expiry, str):
+        try:
+            expiry = datetime.fromisoformat(expiry.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(expiry, datetime):
+        return None
+    if expiry.tzinfo is not None:
+        expiry = expiry.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiry
+
+
+def _expires_within(token, margin):
+    expiry = token_expiry_utc(token)
+    return expiry is not None and expiry - margin <= datetime.utcnow()
+
+
+class FitCredentialCache:
+    """Per-user Google Fit tokens with single-flight refresh."""
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_db()
+        self.tokens = self.db['google_fit_tokens']
+        self._entries = {}  # user_id -> (token document, monotonic time loaded)
+        self._user_locks = {}
+        self._lock = threading.Lock()
+        self._pending = set()  # users with a background refresh queued
+        self._executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS,
+                                            thread_name_prefix='fit-token-refresh')
+
+    def get(self, user_id):
+        """
+        The user's token document with a usable access token, or None if the user
+        has not connected Google Fit. Only blocks on a refresh if the token has expired.
+        """
+        token = self._cached(user_id) or self._load(user_id)
+        if token is None:
+            return None
+        if _expires_within(token, EXPIRY_MARGIN):
+            return self.refresh(user_id, token['access_token'])
+        if _expires_within(token, REFRESH_AHEAD):
+            self._refresh_in_background(user_id, token['access_token'])
+        return token
+
+    def refresh(self, user_id, stale_token):
+        """
+        Replace `stale_token` with a fresh access token and store it. Callers that
+        arrive while a refresh is running wait for it and get its result.
+        Returns the current token document (None if the user disconnected).
+        """
+        with self._user_lock(user_id):
+            token = self._cached(user_id)
+            if token and token['access_token'] != stale_token and not _expires_within(token, EXPIRY_MARGIN):
+                return token
+
+            # Another process may already have refreshed it
+            token = self._load(user_id)
+            if token is None:
+                return None
+            if token['access_token'] != stale_token and not _expires_within(token, EXPIRY_MARGIN):
+                return token
+            if not token.get('refresh_token'):
+                return token
+
+            credentials = Credentials(
+                token=token['access_token'],
+                refresh_token=token['refresh_token'],
+                token_uri=TOKEN_URI,
+                client_id=os.getenv('GOOGLE_FIT_CLIENT_ID'),
+                client_secret=os.getenv('GOOGLE_FIT_CLIENT_SECRET')
+            )
+            try:
+                credentials.refresh(Request())
+            except Exception as e:
+                print(f"⚠️ Token refresh failed for user {user_id}: {e}")
+                return token
+
+            update = {'access_token': credentials.token, 'token_expiry': credentials.expiry}
+            if credentials.refresh_token and credentials.refresh_token != token['refresh_token']:
+                update['refresh_token'] = credentials.refresh_token
+            stored = self.tokens.find_one_and_update(
+                {'user_id': user_id, 'access_token': token['access_token']},
+                {'$set': update},
+                projection=TOKEN_FIELDS,
+                return_document=ReturnDocument.AFTER
+            )
+            if stored is None:
+                # Lost the race to another process (or the user disconnected); its token is as good
+                return self._load(user_id)
+            self._store(user_id, stored)
+            print(f"✅ Google Fit token refreshed for user {user_id}")
+            return stored
+
+    def invalidate(self, user_id):
+        """Forget the cached token, e.g. after the user connects or disconnects."""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _refresh_in_background(self, user_id, stale_token):
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending.add(user_id)
+
+        def _run():
+            try:
+                self.refresh(user_id, stale_token)
+            except Exception as e:
+                print(f"⚠️ Background token refresh error for user {user_id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(user_id)
+
+        self._executor.submit(_run)
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _cached(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry and time.monotonic() - entry[1] < CACHE_SECONDS:
+            return entry[0]
+        return None
+
+    def _load(self, user_id):
+        token = self.tokens.find_one({'user_id': user_id}, TOKEN_FIELDS)
+        if token is None:
+            self.invalidate(user_id)
+        else:
+            self._store(user_id, token)
+        return token
+
+    def _store(self, user_id, token):
+        with self._lock:
+            self._entries[user_id] = (token, time.monotonic())
+
+
+# Global instance
+_credential_cache = None
+_credential_cache_lock = threading.Lock()
+
+
+def get_credential_cache(db=None):
+    """Process-wide credential cache shared by the routes and the sync workers."""
+    global _credential_cache
+    with _credential_cache_lock:
+        if _credential_cache is None:
+            _credential_cache = FitCredentialCache(db)
+        return _credential_cache
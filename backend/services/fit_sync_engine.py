@@ -0,0 +1,491 @@
+"""
+Google Fit Sync Engine
+Shared by POST /api/google-fit/sync and the post-OAuth background sync: fetches
+each metric from Google Fit, turns the points into reading documents and writes
+them through unordered bulk upserts in batches of FIT_SYNC_BATCH_SIZE, so sync
+time grows with the number of batches rather than the number of points.
+
+Metrics are fetched concurrently on a process-wide pool of FIT_FETCH_WORKERS
+threads, at most FIT_FETCH_PER_USER at a time for one user, each bounded by
+FIT_FETCH_TIMEOUT_SECONDS. Points are written as each fetch completes.
+
+Syncs are incremental: google_fit_tokens.sync_watermarks holds, per metric, the
+newest point time successfully stored, and the next sync only asks Google Fit for
+data since that watermark minus FIT_SYNC_OVERLAP_MINUTES (to pick up late-arriving
+points). A full sync ignores the watermarks and fetches the whole `days` window.
+
+Backfills of long ranges split the range into FIT_BACKFILL_WINDOW_DAYS windows,
+fetched newest first with at most FIT_FETCH_PER_USER in flight and written as
+each one arrives, so memory and response sizes are bounded by the window.
+Progress is kept in google_fit_tokens.backfill, so an interrupted backfill
+resumes after the last window completed for each metric.
+"""
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from database import get_db
+from services.sensor_store import get_sensor_store, _write_errors
+
+SYNC_BATCH_SIZE = int(os.getenv('FIT_SYNC_BATCH_SIZE', 1000))
+FETCH_WORKERS = int(os.getenv('FIT_FETCH_WORKERS', 8))
+FETCH_PER_USER = int(os.getenv('FIT_FETCH_PER_USER', 4))
+FETCH_TIMEOUT_SECONDS = float(os.getenv('FIT_FETCH_TIMEOUT_SECONDS', 30))
+SYNC_OVERLAP = timedelta(minutes=int(os.getenv('FIT_SYNC_OVERLAP_MINUTES', 120)))
+BACKFILL_WINDOW = timedelta(days=int(os.getenv('FIT_BACKFILL_WINDOW_DAYS', 7)))
+
+# Google Fit metrics in sync order; each maps to the reading types it produces
+METRICS = {
+    'heart_rate': ('heart_rate',),
+    'sleep': ('sleep',),
+    'activity': ('steps', 'calories'),
+    'body': ('weight',),
+}
+
+# Field of a fetched point whose newest value becomes the metric's watermark
+WATERMARK_FIELDS = {
+    'heart_rate': 'timestamp',
+    'sleep': 'end_time',
+    'activity': 'datetime',
+    'body': 'timestamp',
+}
+
+
+def _heart_rate_readings(user_id, points, synced_at):
+    for reading in points:
+        yield {
+            'user_id': user_id,
+            'type': 'heart_rate',
+            'recorded_at': reading['timestamp'],
+            'value': reading['bpm'],
+            'unit': 'bpm',
+            'source': 'google_fit',
+            'synced_at': synced_at
+        }
+
+
+def _activity_readings(user_id, days, synced_at):
+    for activity in days:
+        # Use the proper datetime object for the recorded_at key (not a date string)
+        recorded_at = activity['datetime']
+        if activity['steps'] > 0:
+            yield {
+                'user_id': user_id,
+                'type': 'steps',
+                'recorded_at': recorded_at,
+                'value': activity['steps'],
+                'unit': 'steps',
+                'source': 'google_fit',
+                'date': activity['date'],
+                'synced_at': synced_at
+            }
+        if activity['calories'] > 0:
+            yield {
+                'user_id': user_id,
+                'type': 'calories',
+                'recorded_at': recorded_at,
+                'value': activity['calories'],
+                'unit': 'kcal',
+                'source': 'google_fit',
+                'date': activity['date'],
+                'synced_at': synced_at
+            }
+
+
+def _body_readings(user_id, measurements, synced_at):
+    for measurement in measurements:
+        yield {
+            'user_id': user_id,
+            'type': 'weight',
+            'recorded_at': measurement['timestamp'],
+            'value': measurement['weight_kg'],
+            'unit': 'kg',
+            'source': 'google_fit',
+            'synced_at': synced_at
+        }
+
+
+READING_BUILDERS = {
+    'heart_rate': _heart_rate_readings,
+    'activity': _activity_readings,
+    'body': _body_readings,
+}
+
+
+def _new_counts():
+    return {'upserted': 0, 'modified': 0, 'errors': 0}
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_fetch_pool = None
+_pool_lock = threading.Lock()
+# Per-user in-flight limits; an entry lives as long as some sync is using it
+_user_limiters = weakref.WeakValueDictionary()
+
+
+def _get_fetch_pool():
+    global _fetch_pool
+    with _pool_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='fit-fetch')
+        return _fetch_pool
+
+
+def _user_limiter(user_id):
+    with _pool_lock:
+        limiter = _user_limiters.get(user_id)
+        if limiter is None:
+            limiter = threading.BoundedSemaphore(FETCH_PER_USER)
+            _user_limiters[user_id] = limiter
+        return limiter
+
+
+def fetch_concurrently(user_id, fetches, timeout=FETCH_TIMEOUT_SECONDS):
+    """
+    Run {metric: (fetch, start_time, end_time)} on the shared pool and yield
+    (metric, points, error) as each finishes. A fetch that has not finished
+    `timeout` seconds after it was submitted is reported as an error; a slot
+    for the user stays taken until the underlying request actually returns.
+    """
+    limiter = _user_limiter(user_id)
+    pending = {}
+    for metric, (fetch, start_time, end_time) in fetches.items():
+        if not limiter.acquire(timeout=timeout):
+            yield metric, None, f"Too many concurrent Google Fit requests for this user (limit {FETCH_PER_USER})"
+            continue
+        try:
+            future = _get_fetch_pool().submit(fetch, start_time, end_time)
+        except Exception:
+            limiter.release()
+            raise
+        future.add_done_callback(lambda _, limiter=limiter: limiter.release())
+        pending[future] = (metric, time.monotonic() + timeout)
+
+    while pending:
+        next_deadline = min(deadline for _, deadline in pending.values())
+        done, _ = wait(pending, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            metric, _ = pending.pop(future)
+            try:
+                yield metric, future.result(), None
+            except Exception as e:
+                yield metric, None, str(e)
+        now = time.monotonic()
+        for future, (metric, deadline) in list(pending.items()):
+            if deadline <= now:
+                del pending[future]
+                future.cancel()
+                yield metric, None, f"Timed out after {timeout:g}s"
+
+
+def fetch_windows(user_id, windows, timeout=FETCH_TIMEOUT_SECONDS):
+    """
+    Run (key, fetch, start_time, end_time) tasks from the `windows` iterable on the
+    shared pool and yield (key, points, error) as each finishes. Tasks are taken
+    from the iterable only as the user's FETCH_PER_USER slots free up, so at most
+    that many windows are in flight or waiting to be consumed at once.
+    """
+    limiter = _user_limiter(user_id)
+    windows = iter(windows)
+    pending = {}
+    exhausted = False
+    while True:
+        while not exhausted:
+            if not limiter.acquire(blocking=False):
+                if pending:
+                    break
+                # Every slot is held by another sync of this user
+                if not limiter.acquire(timeout=timeout):
+                    raise TimeoutError(f"Too many concurrent Google Fit requests for this user "
+                                       f"(limit {FETCH_PER_USER})")
+            task = next(windows, None)
+            if task is None:
+                limiter.release()
+                exhausted = True
+                break
+            key, fetch, start_time, end_time = task
+            try:
+                future = _get_fetch_pool().submit(fetch, start_time, end_time)
+            except Exception:
+                limiter.release()
+                raise
+            future.add_done_callback(lambda _, limiter=limiter: limiter.release())
+            pending[future] = (key, time.monotonic() + timeout)
+        if not pending:
+            return
+
+        next_deadline = min(deadline for _, deadline in pending.values())
+        done, _ = wait(pending, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            key, _ = pending.pop(future)
+            try:
+                yield key, future.result(), None
+            except Exception as e:
+                yield key, None, str(e)
+        now = time.monotonic()
+        for future, (key, deadline) in list(pending.items()):
+            if deadline <= now:
+                del pending[future]
+                future.cancel()
+                yield key, None, f"Timed out after {timeout:g}s"
+
+
+def backfill_windows(since, until, window=BACKFILL_WINDOW):
+    """
+    [start, end) windows covering [since, until), newest first. Window starts fall
+    on local midnight so daily activity buckets are keyed the same as in syncs.
+    """
+    end = until
+    start = (until - window).replace(hour=0, minute=0, second=0, microsecond=0)
+    while end > since:
+        yield max(start, since), end
+        end, start = start, start - window
+
+
+class FitSyncEngine:
+    """Writes Google Fit data for one user in bounded bulk batches."""
+
+    def __init__(self, store=None, db=None, batch_size=SYNC_BATCH_SIZE, fetch_timeout=FETCH_TIMEOUT_SECONDS):
+        self.db = db if db is not None else get_db()
+        self.store = store or get_sensor_store()
+        # The store publishes on this bus, so batched_versions() must wrap the same one
+        self.bus = self.store.bus
+        self.batch_size = batch_size
+        self.fetch_timeout = fetch_timeout
+
+    def sync(self, user_id, fit_service, days=7, metrics=tuple(METRICS), full=False):
+        """
+        Fetch and store `metrics`: since each metric's watermark (minus the overlap),
+        or the last `days` days for a full sync or a metric never synced before.
+        Returns {'summary': points fetched per metric,
+                 'windows': {metric: start of the requested window (ISO 8601)},
+                 'counts': {reading type: {'upserted', 'modified', 'errors'}},
+                 'latest': {reading type: newest reading document stored by this sync},
+                 'errors': {metric: message} for metrics that could not be synced}.
+        Individual rejected writes are counted under 'errors' in `counts`.
+        """
+        fetchers = self._fetchers(fit_service)
+        tokens = self.db['google_fit_tokens']
+        watermarks = {}
+        if not full:
+            token_data = tokens.find_one({'user_id': user_id}, {'sync_watermarks': 1}) or {}
+            watermarks = token_data.get('sync_watermarks') or {}
+
+        end_time = datetime.now()
+        windows = {metric: self._window_start(metric, watermarks.get(metric), end_time, days)
+                   for metric in metrics}
+        summary, counts, errors, advanced, latest = {}, {}, {}, {}, {}
+        synced_at = datetime.utcnow()
+
+        # Refresh once up front so the concurrent fetches don't all race to refresh an expired token
+        fit_service.refresh_token_if_needed()
+        # One data version bump for the whole sync, not one per written batch
+        with self.bus.batched_versions():
+            fetches = {metric: (fetchers[metric], windows[metric], end_time) for metric in metrics}
+            for metric, points, error in fetch_concurrently(user_id, fetches, self.fetch_timeout):
+                if error:
+                    errors[metric] = error
+                    continue
+                try:
+                    summary[metric] = len(points)
+                    metric_counts = self._write_metric(user_id, metric, points, synced_at, latest)
+                    self._merge_counts(counts, metric_counts)
+                except Exception as e:
+                    errors[metric] = str(e)
+                    continue
+                # Only move past data that was stored completely; otherwise retry it next time
+                newest = max((point[WATERMARK_FIELDS[metric]] for point in points), default=None)
+                if newest and not any(c['errors'] for c in metric_counts.values()):
+                    advanced[f'sync_watermarks.{metric}'] = newest
+
+            update = {'$set': {'last_sync': datetime.utcnow()}}
+            if advanced:
+                update['$max'] = advanced
+            tokens.update_one({'user_id': user_id}, update)
+            # last_sync changed even if no reading did
+            self.bus.touch(user_id)
+        return {
+            'summary': summary,
+            'windows': {metric: start.isoformat() for metric, start in windows.items()},
+            'counts': counts,
+            'latest': latest,
+            'errors': errors,
+        }
+
+    def backfill(self, user_id, fit_service, days=365, metrics=tuple(METRICS), window=BACKFILL_WINDOW,
+                 resume=True, on_window=None):
+        """
+        Fetch and store the last `days` days window by window (see backfill_windows()).
+        With `resume`, a previous backfill of the same length that did not finish
+        continues from where each metric stopped instead of starting over.
+        `on_window()`, if given, is called after every window (e.g. to extend a job lease).
+        Returns {'summary': points fetched per metric,
+                 'progress': {metric: oldest time backfilled so far (ISO 8601)},
+                 'counts': {reading type: {'upserted', 'modified', 'errors'}},
+                 'errors': {metric: message for the first window that failed}}.
+        """
+        fetchers = self._fetchers(fit_service)
+        tokens = self.db['google_fit_tokens']
+        state = None
+        if resume:
+            state = (tokens.find_one({'user_id': user_id}, {'backfill': 1}) or {}).get('backfill')
+            if state and state.get('days') != days:
+                state = None
+        if not state:
+            until = datetime.now()
+            state = {'days': days, 'since': until - timedelta(days=days), 'until': until, 'done': {}}
+            tokens.update_one({'user_id': user_id}, {'$set': {'backfill': state}})
+        since, until = state['since'], state['until']
+        # Everything from done[metric] to `until` is stored
+        done = {metric: state.get('done', {}).get(metric, until) for metric in metrics}
+
+        # Newest windows first across metrics, so recent data lands before older history
+        tasks = [((metric, start), fetchers[metric], start, end)
+                 for metric in metrics
+                 for start, end in backfill_windows(since, done[metric], window)]
+        tasks.sort(key=lambda task: task[2], reverse=True)
+        remaining = {metric: [start for (m, start), *_ in tasks if m == metric] for metric in metrics}
+
+        summary, counts, errors = {}, {}, {}
+        completed = {metric: set() for metric in metrics}
+        synced_at = datetime.utcnow()
+
+        fit_service.refresh_token_if_needed()
+        for (metric, start), points, error in fetch_windows(user_id, tasks, self.fetch_timeout):
+            if not error:
+                try:
+                    summary[metric] = summary.get(metric, 0) + len(points)
+                    with self.bus.batched_versions():
+                        metric_counts = self._write_metric(user_id, metric, points, synced_at)
+                    self._merge_counts(counts, metric_counts)
+                    if any(c['errors'] for c in metric_counts.values()):
+                        error = "Some readings could not be written"
+                except Exception as e:
+                    error = str(e)
+            if error:
+                errors.setdefault(metric, f"Window from {start.isoformat()}: {error}")
+            else:
+                completed[metric].add(start)
+                update = {}
+                # Move the resume point past every window completed without a gap
+                while remaining[metric] and remaining[metric][0] in completed[metric]:
+                    done[metric] = remaining[metric].pop(0)
+                    update[f'backfill.done.{metric}'] = done[metric]
+                newest = max((point[WATERMARK_FIELDS[metric]] for point in points), default=None)
+                ops = {}
+                if update:
+                    ops['$set'] = update
+                if newest:
+                    ops['$max'] = {f'sync_watermarks.{metric}': newest}
+                if ops:
+                    tokens.update_one({'user_id': user_id}, ops)
+            if on_window:
+                on_window()
+
+        update = {'$set': {'last_sync': datetime.utcnow()}}
+        if all(done[metric] <= since for metric in metrics):
+            update['$unset'] = {'backfill': ''}
+        tokens.update_one({'user_id': user_id}, update)
+        self.bus.touch(user_id)
+        return {
+            'summary': summary,
+            'progress': {metric: done[metric].isoformat() for metric in metrics},
+            'counts': counts,
+            'errors': errors,
+        }
+
+    @staticmethod
+    def _fetchers(fit_service):
+        return {
+            'heart_rate': fit_service.get_heart_rate_data,
+            'sleep': fit_service.get_sleep_data,
+            'activity': fit_service.get_activity_data,
+            'body': fit_service.get_body_data,
+        }
+
+    def _write_metric(self, user_id, metric, points, synced_at, latest=None):
+        """Store one metric's fetched points. Returns per reading type counts."""
+        if metric == 'sleep':
+            return self.write_sleep(user_id, points, synced_at)
+        readings = READING_BUILDERS[metric](user_id, points, synced_at)
+        return self.write_readings(readings, latest)
+
+    @staticmethod
+    def _window_start(metric, watermark, end_time, days):
+        start = end_time - timedelta(days=days)
+        if watermark:
+            start = watermark - SYNC_OVERLAP
+        if metric == 'activity':
+            # Daily aggregates are bucketed from the window start, so start at midnight
+            # to keep each day's bucket (and its recorded_at key) the same across syncs
+            start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start
+
+    @staticmethod
+    def _merge_counts(counts, batch_counts):
+        for reading_type, batch in batch_counts.items():
+            totals = counts.setdefault(reading_type, _new_counts())
+            for key, value in batch.items():
+                totals[key] += value
+
+    def write_readings(self, readings, latest=None):
+        """
+        Upsert reading documents batch by batch. Returns per-type counts.
+        If `latest` is given, it is updated with the newest stored document of each type.
+        """
+        counts = {}
+        for batch in _batches(readings, self.batch_size):
+            statuses, _ = self.store.upsert_readings(batch)
+            for doc, status in zip(batch, statuses):
+                totals = counts.setdefault(doc['type'], _new_counts())
+                if status == 'error':
+                    totals['errors'] += 1
+                    continue
+                if status != 'unchanged':
+                    totals[status] += 1
+                if latest is not None:
+                    newest = latest.get(doc['type'])
+                    if newest is None or doc['recorded_at'] > newest['recorded_at']:
+                        latest[doc['type']] = doc
+        return counts
+
+    def write_sleep(self, user_id, sessions, synced_at):
+        """Upsert sleep sessions into the matching health_logs days. Returns counts under 'sleep'."""
+        counts = _new_counts()
+        health_logs = self.db['health_logs']
+        for batch in _batches(sessions, self.batch_size):
+            ops = [
+                UpdateOne(
+                    {'user_id': user_id, 'date': session['date']},
+                    {'$set': {
+                        'sleep_hours': session['duration_hours'],
+                        'sleep_source': 'google_fit',
+                        'sleep_synced_at': synced_at
+                    }},
+                    upsert=True
+                )
+                for session in batch
+            ]
+            try:
+                result = health_logs.bulk_write(ops, ordered=False)
+                counts['upserted'] += result.upserted_count
+                counts['modified'] += result.modified_count
+            except BulkWriteError as e:
+                counts['upserted'] += e.details.get('nUpserted', 0)
+                counts['modified'] += e.details.get('nModified', 0)
+                counts['errors'] += len(_write_errors(e))
+        return {'sleep': counts}
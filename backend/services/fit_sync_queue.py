@@ -0,0 +1,352 @@
+"""
+Google Fit Sync Job Queue
+Durable, MongoDB-backed queue of sync jobs in `fit_sync_jobs`, so background
+syncs survive restarts and are bounded under bursts of OAuth connects.
+
+    {_id, user_id, status: queued | running | done | failed | superseded,
+     reason, days, full, backfill, attempts, run_at, lease_until, claimed_by,
+     claim_id, slots, created_at, started_at, finished_at, last_error, result}
+
+- A user has at most one queued job; enqueueing again is a no-op until it starts.
+- Workers claim jobs atomically with find_one_and_update and hold them under a
+  lease; jobs whose lease expired (the worker died) are put back in the queue.
+- Failed jobs are retried with exponential backoff up to FIT_SYNC_MAX_ATTEMPTS.
+- At most FIT_SYNC_MAX_RUNNING jobs run at once across all processes, at most
+  FIT_SYNC_JOBS_PER_USER per user, on FIT_SYNC_WORKERS threads per process.
+  A running job holds one global and one per-user slot in `fit_sync_slots`
+  ({_id: "global:<n>" | "user:<user_id>:<n>", claim_id, lease_until}), taken
+  with an insert or a takeover of an expired lease, so the caps hold under
+  concurrent claims. Slots share the job's lease and free themselves when a
+  worker dies.
+- Every FIT_SYNC_INTERVAL_MINUTES, each connected user whose last sync is older
+  than that gets a scheduled job.
+"""
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from database import get_db
+from services.fit_sync_engine import FitSyncEngine
+from services.google_fit_service import load_fit_service
+
+WORKERS = int(os.getenv('FIT_SYNC_WORKERS', 2))
+MAX_RUNNING = int(os.getenv('FIT_SYNC_MAX_RUNNING', 8))
+# Queued jobs tried per claim() before giving up until the next poll
+CLAIM_CANDIDATES = 10
+JOBS_PER_USER = int(os.getenv('FIT_SYNC_JOBS_PER_USER', 1))
+MAX_ATTEMPTS = int(os.getenv('FIT_SYNC_MAX_ATTEMPTS', 5))
+INTERVAL_MINUTES = int(os.getenv('FIT_SYNC_INTERVAL_MINUTES', 60))
+LEASE = timedelta(seconds=int(os.getenv('FIT_SYNC_LEASE_SECONDS', 600)))
+BACKOFF_BASE = timedelta(seconds=int(os.getenv('FIT_SYNC_BACKOFF_SECONDS', 60)))
+BACKOFF_MAX = timedelta(hours=1)
+POLL_SECONDS = 5
+DEFAULT_DAYS = 7
+
+
+class FitSyncQueue:
+    """Enqueue, claim and finish Google Fit sync jobs."""
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_db()
+        self.jobs = self.db['fit_sync_jobs']
+        self.slots = self.db['fit_sync_slots']
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Wakes idle workers in this process as soon as something is enqueued
+        self.wakeup = threading.Event()
+
+    # --- Producers ---
+
+    def enqueue(self, user_id, reason='manual', days=DEFAULT_DAYS, full=False, run_at=None, backfill=False):
+        """
+        Queue a sync for `user_id` unless one is already waiting.
+        With `backfill`, the job (new or waiting) becomes a windowed backfill of
+        at least `days` days (see FitSyncEngine.backfill()).
+        Returns the queued job's id (the existing one when coalesced).
+        """
+        now = datetime.utcnow()
+        query = {'user_id': user_id, 'status': 'queued'}
+        fields = {
+            'reason': reason,
+            'days': days,
+            'full': full,
+            'attempts': 0,
+            'run_at': run_at or now,
+            'created_at': now,
+        }
+        update = {'$setOnInsert': fields}
+        if backfill:
+            del fields['days']
+            update['$set'] = {'backfill': True}
+            update['$max'] = {'days': days}
+        try:
+            job = self.jobs.find_one_and_update(query, update, projection={'_id': 1}, upsert=True,
+                                                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Lost an upsert race with another enqueue; that job covers this one
+            if backfill:
+                job = self.jobs.find_one_and_update(query, {'$set': update['$set'], '$max': update['$max']},
+                                                    projection={'_id': 1})
+            else:
+                job = self.jobs.find_one(query, {'_id': 1})
+        self.wakeup.set()
+        return job['_id'] if job else None
+
+    def enqueue_due(self, interval=timedelta(minutes=INTERVAL_MINUTES)):
+        """Queue a scheduled sync for every connected user not synced within `interval`."""
+        cutoff = datetime.utcnow() - interval
+        due = self.db['google_fit_tokens'].find(
+            {'$or': [{'last_sync': {'$lt': cutoff}}, {'last_sync': None}]},
+            {'user_id': 1}
+        )
+        count = 0
+        for token in due:
+            self.enqueue(token['user_id'], reason='schedule')
+            count += 1
+        if count:
+            print(f"🔄 Queued scheduled Google Fit sync for {count} user(s)")
+        return count
+
+    # --- Workers ---
+
+    def _acquire_slot(self, prefix, count, claim_id, now):
+        """Take one of `count` slots named `prefix:<n>`. Returns its id, or None if all are held."""
+        for n in range(count):
+            slot_id = f"{prefix}:{n}"
+            try:
+                self.slots.insert_one({'_id': slot_id, 'claim_id': claim_id, 'lease_until': now + LEASE})
+                return slot_id
+            except DuplicateKeyError:
+                # Held, unless its holder's lease ran out
+                taken = self.slots.find_one_and_update(
+                    {'_id': slot_id, 'lease_until': {'$lt': now}},
+                    {'$set': {'claim_id': claim_id, 'lease_until': now + LEASE}},
+                    projection={'_id': 1}
+                )
+                if taken:
+                    return slot_id
+        return None
+
+    def _release_slots(self, slot_ids, claim_id):
+        if slot_ids:
+            self.slots.delete_many({'_id': {'$in': list(slot_ids)}, 'claim_id': claim_id})
+
+    def claim(self):
+        """
+        Take the next due job, or None if nothing can run right now.
+        The global and per-user slots are acquired before the job is marked
+        running, so concurrent workers cannot overshoot MAX_RUNNING or JOBS_PER_USER.
+        """
+        now = datetime.utcnow()
+        claim_id = uuid.uuid4().hex
+        global_slot = self._acquire_slot('global', MAX_RUNNING, claim_id, now)
+        if global_slot is None:
+            return None
+
+        busy = []
+        try:
+            for _ in range(CLAIM_CANDIDATES):
+                query = {'status': 'queued', 'run_at': {'$lte': now}}
+                if busy:
+                    query['user_id'] = {'$nin': busy}
+                candidate = self.jobs.find_one(query, {'user_id': 1}, sort=[('run_at', ASCENDING)])
+                if candidate is None:
+                    break
+                user_id = candidate['user_id']
+                user_slot = self._acquire_slot(f"user:{user_id}", JOBS_PER_USER, claim_id, now)
+                if user_slot is None:
+                    busy.append(user_id)
+                    continue
+                job = self.jobs.find_one_and_update(
+                    {'_id': candidate['_id'], 'status': 'queued'},
+                    {
+                        '$set': {
+                            'status': 'running',
+                            'claimed_by': self.worker_id,
+                            'claim_id': claim_id,
+                            'slots': [global_slot, user_slot],
+                            'started_at': now,
+                            'lease_until': now + LEASE,
+                        },
+                        '$inc': {'attempts': 1},
+                    },
+                    return_document=ReturnDocument.AFTER
+                )
+                if job:
+                    return job
+                # Another worker claimed it first
+                self._release_slots([user_slot], claim_id)
+        except BaseException:
+            self._release_slots([global_slot], claim_id)
+            raise
+        self._release_slots([global_slot], claim_id)
+        return None
+
+    def run(self, job):
+        """Sync the job's user. Returns the engine result; raises when the sync failed."""
+        fit_service, _ = load_fit_service(job['user_id'], self.db)
+        if not fit_service:
+            return {'skipped': 'Google Fit not connected'}
+        engine = FitSyncEngine(db=self.db)
+        if job.get('backfill'):
+            # Resumes where a previous attempt stopped; windows keep the lease alive
+            result = engine.backfill(job['user_id'], fit_service, days=job.get('days', DEFAULT_DAYS),
+                                     on_window=lambda: self.extend_lease(job))
+        else:
+            result = engine.sync(job['user_id'], fit_service,
+                                 days=job.get('days', DEFAULT_DAYS), full=job.get('full', False))
+        if result['errors']:
+            raise RuntimeError('; '.join(f"{metric}: {error}" for metric, error in result['errors'].items()))
+        return result
+
+    def extend_lease(self, job):
+        """Keep a long-running job (and its slots) from being recovered as abandoned."""
+        lease_until = datetime.utcnow() + LEASE
+        self.jobs.update_one(
+            {'_id': job['_id'], 'claimed_by': self.worker_id, 'status': 'running'},
+            {'$set': {'lease_until': lease_until}}
+        )
+        self.slots.update_many({'_id': {'$in': job.get('slots', [])}, 'claim_id': job.get('claim_id')},
+                               {'$set': {'lease_until': lease_until}})
+
+    def complete(self, job, result):
+        self.jobs.update_one(
+            {'_id': job['_id'], 'claimed_by': self.worker_id},
+            {'$set': {'status': 'done', 'finished_at': datetime.utcnow(),
+                      'result': {'summary': result.get('summary'), 'counts': result.get('counts')}},
+             '$unset': {'lease_until': ''}}
+        )
+        self._release_slots(job.get('slots'), job.get('claim_id'))
+
+    def fail(self, job, error):
+        """Schedule a retry with exponential backoff, or give up after MAX_ATTEMPTS."""
+        now = datetime.utcnow()
+        if job['attempts'] >= MAX_ATTEMPTS:
+            self.jobs.update_one(
+                {'_id': job['_id'], 'claimed_by': self.worker_id},
+                {'$set': {'status': 'failed', 'finished_at': now, 'last_error': error},
+                 '$unset': {'lease_until': ''}}
+            )
+            print(f"❌ Google Fit sync for user {job['user_id']} failed after {job['attempts']} attempts: {error}")
+        else:
+            delay = min(BACKOFF_BASE * 2 ** (job['attempts'] - 1), BACKOFF_MAX)
+            self._requeue(job, {'run_at': now + delay, 'last_error': error}, {'claimed_by': self.worker_id})
+        self._release_slots(job.get('slots'), job.get('claim_id'))
+
+    def _requeue(self, job, fields, match=None):
+        """Put a job back in the queue, or retire it if the user already has a queued job."""
+        try:
+            self.jobs.update_one(
+                {'_id': job['_id'], 'status': 'running', **(match or {})},
+                {'$set': {'status': 'queued', **fields}, '$unset': {'lease_until': '', 'claimed_by': ''}}
+            )
+        except DuplicateKeyError:
+            self.jobs.update_one(
+                {'_id': job['_id']},
+                {'$set': {'status': 'superseded', 'finished_at': datetime.utcnow(), **fields},
+                 '$unset': {'lease_until': ''}}
+            )
+
+    def recover_expired(self):
+        """
+        Requeue running jobs whose lease ran out, e.g. after a crash or restart.
+        Their slots expire with the same lease and are taken over by the next claims.
+        """
+        now = datetime.utcnow()
+        expired = list(self.jobs.find({'status': 'running', 'lease_until': {'$lt': now}}, {'_id': 1}))
+        for job in expired:
+            self._requeue(job, {'run_at': now}, {'lease_until': {'$lt': now}})
+        if expired:
+            print(f"🔄 Requeued {len(expired)} Google Fit sync job(s) with expired leases")
+        return len(expired)
+
+    def work_once(self):
+        """Claim and run one job. Returns False when there was nothing to do."""
+        job = self.claim()
+        if not job:
+            return False
+        try:
+            result = self.run(job)
+        except Exception as e:
+            self.fail(job, str(e))
+        else:
+            self.complete(job, result)
+        return True
+
+    def _worker_loop(self, stop):
+        while not stop.is_set():
+            try:
+                if self.work_once():
+                    continue
+            except PyMongoError as e:
+                print(f"❌ Google Fit sync worker error: {e}")
+            self.wakeup.wait(POLL_SECONDS)
+            self.wakeup.clear()
+
+
+class FitSyncScheduler:
+    """Worker threads plus the periodic enqueue and lease-recovery jobs."""
+
+    def __init__(self, queue=None):
+        self.queue = queue or FitSyncQueue()
+        self.scheduler = BackgroundScheduler(timezone=os.getenv('SCHEDULER_TIMEZONE', 'Asia/Kolkata'))
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """Recover in-flight jobs, then start the workers and the periodic jobs."""
+        self.queue.recover_expired()
+        self.queue.enqueue_due()
+
+        self.scheduler.add_job(
+            self.queue.enqueue_due,
+            IntervalTrigger(minutes=INTERVAL_MINUTES),
+            id='fit_sync_enqueue',
+            replace_existing=True
+        )
+        self.scheduler.add_job(
+            self.queue.recover_expired,
+            IntervalTrigger(seconds=max(60, LEASE.total_seconds() // 2)),
+            id='fit_sync_recover',
+            replace_existing=True
+        )
+        self.scheduler.start()
+
+        for i in range(WORKERS):
+            thread = threading.Thread(target=self.queue._worker_loop, args=(self.stop_event,),
+                                      name=f'fit-sync-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"✅ Google Fit sync queue started ({WORKERS} workers, every {INTERVAL_MINUTES} min)")
+
+    def stop(self):
+        self.stop_event.set()
+        self.queue.wakeup.set()
+        self.scheduler.shutdown()
+        print("Google Fit sync queue stopped")
+
+
+# Global instances
+fit_sync_scheduler = None
+_fit_sync_queue = None
+
+
+def get_sync_queue():
+    """Process-wide queue, for producers such as the OAuth callback."""
+    global _fit_sync_queue
+    if _fit_sync_queue is None:
+        _fit_sync_queue = FitSyncQueue()
+    return _fit_sync_queue
+
+
+def init_sync_queue():
+    """Start the sync workers and periodic jobs"""
+    global fit_sync_scheduler
+    if fit_sync_scheduler is None:
+        fit_sync_scheduler = FitSyncScheduler(get_sync_queue())
+        fit_sync_scheduler.start()
+    return fit_sync_scheduler
@@ -1,11 +1,92 @@
 """
 Google Fit Service - Handles API interactions with Google Fit
 """
+import json
 import os
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
+import httplib2
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
+from services.fit_credentials import token_expiry_utc, get_credential_cache
+
+# Override the Fitness API base URL, e.g. to point at benchmarks/fit_api_stub.py
+FITNESS_API_ENDPOINT = os.getenv('GOOGLE_FIT_API_ENDPOINT')
+FITNESS_HTTP_TIMEOUT = int(os.getenv('GOOGLE_FIT_HTTP_TIMEOUT', 60))
+# Fitness clients kept per thread, least recently used evicted first
+FITNESS_CLIENTS_PER_THREAD = int(os.getenv('GOOGLE_FIT_CLIENTS_PER_THREAD', 32))
+
+_discovery_lock = threading.Lock()
+_discovery_document = None
+_thread_state = threading.local()
+
+
+def _fitness_discovery_document():
+    """The Fitness v1 discovery document bundled with google-api-python-client, parsed once."""
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            document = json.loads(get_static_doc('fitness', 'v1'))
+            if FITNESS_API_ENDPOINT:
+                document['rootUrl'] = FITNESS_API_ENDPOINT.rstrip('/') + '/'
+                document['baseUrl'] = document['rootUrl'] + document['servicePath']
+            _discovery_document = document
+        return _discovery_document
+
+
+def _thread_http():
+    """
+    This thread's httplib2.Http. It keeps connections to the API host open between
+    calls; httplib2 is not thread-safe, so every thread gets its own.
+    """
+    http = getattr(_thread_state, 'http', None)
+    if http is None:
+        http = _thread_state.http = httplib2.Http(timeout=FITNESS_HTTP_TIMEOUT)
+    return http
+
+
+def _thread_client(credentials):
+    """
+    This thread's Fitness client for the grant behind `credentials`, built on
+    first use and reused by every later GoogleFitService for the same user.
+    The cached client keeps its own Credentials, updated in place with the
+    caller's current token.
+    """
+    clients = getattr(_thread_state, 'clients', None)
+    if clients is None:
+        clients = _thread_state.clients = OrderedDict()
+    key = (credentials.client_id, credentials.refresh_token or credentials.token)
+    entry = clients.get(key)
+    if entry is None:
+        cached = Credentials(
+            token=credentials.token,
+            refresh_token=credentials.refresh_token,
+            token_uri=credentials.token_uri,
+            client_id=credentials.client_id,
+            client_secret=credentials.client_secret,
+            scopes=credentials.scopes
+        )
+        entry = clients[key] = (cached, build_fitness_client(cached))
+        while len(clients) > FITNESS_CLIENTS_PER_THREAD:
+            clients.popitem(last=False)
+    else:
+        clients.move_to_end(key)
+    cached, client = entry
+    cached.token = credentials.token
+    cached.expiry = credentials.expiry
+    return client
+
+
+def build_fitness_client(credentials):
+    """A Fitness API client on this thread's pooled connection, without fetching discovery."""
+    return build_from_document(
+        _fitness_discovery_document(),
+        http=AuthorizedHttp(credentials, http=_thread_http())
+    )
 
 
 def _parse_expiry(expiry_val):
@@ -34,8 +115,11 @@ class GoogleFitService:
         'https://www.googleapis.com/auth/fitness.location.read'
     ]
 
-    def __init__(self, access_token, refresh_token=None, token_expiry=None):
-        """Initialize with OAuth tokens"""
+    def __init__(self, access_token, refresh_token=None, token_expiry=None, token_source=None):
+        """
+        Initialize with OAuth tokens. `token_source(stale_access_token)`, if given,
+        supplies a refreshed token document instead of refreshing here.
+        """
         expiry = _parse_expiry(token_expiry)
 
         self.credentials = Credentials(
@@ -49,6 +133,7 @@ class GoogleFitService:
 
         if expiry:
             self.credentials.expiry = expiry
+        self.token_source = token_source
 
     def refresh_token_if_needed(self):
         """
@@ -56,7 +141,12 @@ class GoogleFitService:
         Returns updated credentials object.
         """
         try:
-            if self.credentials.expired and self.credentials.refresh_token:
+            if self.credentials.expired and self.token_source:
+                token = self.token_source(self.credentials.token)
+                if token:
+                    self.credentials.token = token['access_token']
+                    self.credentials.expiry = token_expiry_utc(token)
+            elif self.credentials.expired and self.credentials.refresh_token:
                 from google.auth.transport.requests import Request
                 self.credentials.refresh(Request())
                 print("✅ Google Fit token refreshed successfully")
@@ -65,9 +155,8 @@ class GoogleFitService:
         return self.credentials
 
     def get_fitness_service(self):
-        """Build and return Google Fit API service, refreshing token first."""
-        self.refresh_token_if_needed()
-        return build('fitness', 'v1', credentials=self.credentials)
+        """Return this thread's Google Fit API client, refreshing token first."""
+        return _thread_client(self.refresh_token_if_needed())
 
     def get_heart_rate_data(self, start_time=None, end_time=None):
         """
@@ -288,3 +377,24 @@ class GoogleFitService:
         except Exception as e:
             print(f"❌ Unexpected error fetching body: {e}")
             raise
+
+
+def load_fit_service(user_id, db):
+    """
+    GoogleFitService for a connected user, on the shared credential cache: an
+    expired token is refreshed once for all concurrent callers and saved.
+    Returns (service, token document), or (None, None) if the user has not
+    connected Google Fit.
+    """
+    cache = get_credential_cache(db)
+    token_data = cache.get(user_id)
+    if not token_data:
+        return None, None
+
+    fit_service = GoogleFitService(
+        access_token=token_data['access_token'],
+        refresh_token=token_data.get('refresh_token'),
+        token_expiry=token_expiry_utc(token_data),
+        token_source=lambda stale_token: cache.refresh(user_id, stale_token)
+    )
+    return fit_service, token_data
@@ -0,0 +1,159 @@
+"""
+History Wire Encodings
+Serializes per-metric history series for /api/google-fit/history.
+
+A series is a dict of parallel columns:
+    {'unit': 'bpm', 'recorded_at': [datetime, ...], 'value': [float, ...],
+     'date': [str, ...], and for rollups 'min', 'max', 'last', 'count'}
+
+Encodings (chosen by the request's Accept header):
+    application/json                           - list of point objects per metric (default)
+    application/vnd.neurapulse.columnar+json   - one object per metric with delta-encoded
+                                                 epoch-ms timestamps and value arrays
+    application/vnd.neurapulse.columnar        - binary: b'NPC1', uint32 header length,
+                                                 JSON header, then 8-byte aligned little-endian
+                                                 column buffers described by the header
+"""
+import json
+import struct
+from datetime import datetime, timedelta
+import numpy as np
+
+ROWS = 'application/json'
+COLUMNAR_JSON = 'application/vnd.neurapulse.columnar+json'
+COLUMNAR_BINARY = 'application/vnd.neurapulse.columnar'
+
+MEDIA_TYPES = [ROWS, COLUMNAR_JSON, COLUMNAR_BINARY]
+
+BINARY_MAGIC = b'NPC1'
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+# Optional rollup columns and their packed dtypes
+STAT_COLUMNS = {'min': '<f4', 'max': '<f4', 'last': '<f4', 'count': '<u4'}
+
+
+def new_series(unit=None, stats=False):
+    series = {'unit': unit, 'recorded_at': [], 'value': [], 'date': []}
+    if stats:
+        series.update({column: [] for column in STAT_COLUMNS})
+    return series
+
+
+def to_rows(history):
+    """The original JSON shape: {metric: [{value, unit, recorded_at, date, ...}]}."""
+    rows = {}
+    for metric, series in history.items():
+        stats = [column for column in STAT_COLUMNS if column in series]
+        points = []
+        for i, recorded_at in enumerate(series['recorded_at']):
+            point = {
+                'value': series['value'][i],
+                'unit': series['unit'],
+                'recorded_at': recorded_at.isoformat() if recorded_at else None,
+                'date': series['date'][i],
+            }
+            for column in stats:
+                point[column] = series[column][i]
+            points.append(point)
+        rows[metric] = points
+    return rows
+
+
+def _epoch_ms(recorded_at):
+    # Timedelta floor division is several times faster than np.array(..., dtype='datetime64[ms]')
+    return np.fromiter(((dt - EPOCH) // MILLISECOND for dt in recorded_at), dtype=np.int64, count=len(recorded_at))
+
+
+def _deltas(recorded_at):
+    """(first epoch ms, int64 deltas between consecutive points)."""
+    epoch = _epoch_ms(recorded_at)
+    if not len(epoch):
+        return 0, epoch
+    return int(epoch[0]), np.diff(epoch)
+
+
+def to_columnar_json(history):
+    """{metric: {unit, length, t0, dt: [...], value: [...], min?, max?, last?, count?}} as a dict."""
+    out = {}
+    for metric, series in history.items():
+        t0, deltas = _deltas(series['recorded_at'])
+        encoded = {
+            'unit': series['unit'],
+            'length': len(series['value']),
+            't0': t0,
+            'dt': deltas.tolist(),
+            'value': series['value'],
+        }
+        for column in STAT_COLUMNS:
+            if column in series:
+                encoded[column] = series[column]
+        out[metric] = encoded
+    return out
+
+
+def _pack(values, dtype):
+    if dtype == '<u4':
+        return np.asarray(values, dtype=dtype)
+    return np.asarray([np.nan if v is None else v for v in values], dtype=np.float64).astype(dtype)
+
+
+def to_columnar_binary(history):
+    """
+    Pack every series into one buffer. Timestamp deltas use int32 when they fit
+    (gaps under ~24 days), int64 otherwise; values are float32.
+    """
+    header = {'series': []}
+    buffers = []
+    offset = 0
+
+    def add(array):
+        nonlocal offset
+        data = array.tobytes()
+        padding = (-len(data)) % 8
+        buffers.append(data + b'\0' * padding)
+        column = {'dtype': array.dtype.str, 'offset': offset, 'length': len(array)}
+        offset += len(data) + padding
+        return column
+
+    for metric, series in history.items():
+        t0, deltas = _deltas(series['recorded_at'])
+        fits_int32 = not len(deltas) or int(np.abs(deltas).max()) < 2 ** 31
+        columns = {
+            'dt': add(deltas.astype('<i4' if fits_int32 else '<i8')),
+            'value': add(_pack(series['value'], '<f4')),
+        }
+        for column, dtype in STAT_COLUMNS.items():
+            if column in series:
+                columns[column] = add(_pack(series[column], dtype))
+        header['series'].append({
+            'metric': metric,
+            'unit': series['unit'],
+            'length': len(series['value']),
+            't0': t0,
+            'columns': columns,
+        })
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * ((-(len(BINARY_MAGIC) + 4 + len(header_bytes))) % 8)
+    return BINARY_MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes + b''.join(buffers)
+
+
+def decode_columnar_binary(payload):
+    """Inverse of to_columnar_binary(); returns {metric: {'unit', 'epoch_ms', columns...}} of NumPy arrays."""
+    if payload[:4] != BINARY_MAGIC:
+        raise ValueError("Not a columnar history payload")
+    (header_length,) = struct.unpack('<I', payload[4:8])
+    header = json.loads(payload[8:8 + header_length])
+    body = memoryview(payload)[8 + header_length:]
+    history = {}
+    for entry in header['series']:
+        decoded = {'unit': entry['unit']}
+        for name, column in entry['columns'].items():
+            dtype = np.dtype(column['dtype'])
+            decoded[name] = np.frombuffer(body, dtype=dtype, count=column['length'], offset=column['offset'])
+        decoded['epoch_ms'] = entry['t0'] + np.concatenate(([0], np.cumsum(decoded['dt'], dtype=np.int64))) \
+            if entry['length'] else np.array([], dtype=np.int64)
+        history[entry['metric']] = decoded
+    return history
@@ -0,0 +1,138 @@
+"""
+Knowledge Base Ingestion
+Turns a directory tree of .txt, .md and .pdf files into chunks for rag_utils.
+
+- scan() lists the files with their sha256, kept in a manifest so a file is only
+  re-hashed when its size or modification time changed.
+- iter_chunks() yields the chunks of every file in path order. Chunks of a file
+  whose checksum (and splitter settings) were seen before come from the chunk
+  cache; changed files are parsed and split in a process pool, and their chunks
+  are yielded as each file finishes so embedding can start before parsing ends.
+  Files that fail to parse are logged and skipped.
+
+Cached chunks carry only content-derived metadata (the PDF page); `source` is
+attached on read, so renamed or duplicate files get their own path.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+EXTENSIONS = ('.txt', '.md', '.pdf')
+MANIFEST_NAME = 'manifest.json'
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    """Write atomically, so a crash never leaves a truncated manifest or chunk file."""
+    fd, staging = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(staging, path)
+    except BaseException:
+        os.unlink(staging)
+        raise
+
+
+def scan(corpus_dir, state_dir, exclude=()):
+    """
+    [(relative path, absolute path, sha256)] for the corpus files, sorted by path.
+    Directories in `exclude` (e.g. the index directory) are skipped.
+    """
+    manifest_path = os.path.join(state_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    excluded = {os.path.abspath(path) for path in exclude}
+    files, updated = [], {}
+    for root, dirs, names in os.walk(corpus_dir):
+        dirs[:] = sorted(d for d in dirs
+                         if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) not in excluded)
+        for name in sorted(names):
+            if not name.lower().endswith(EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, corpus_dir).replace(os.sep, '/')
+            stat = os.stat(path)
+            entry = manifest.get(relpath)
+            if not entry or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _file_sha256(path)}
+            updated[relpath] = entry
+            files.append((relpath, path, entry['sha256']))
+
+    if updated != manifest:
+        os.makedirs(state_dir, exist_ok=True)
+        _write_json(manifest_path, updated)
+    return files
+
+
+def parse_file(path, chunk_size, chunk_overlap):
+    """[(text, metadata)] chunks of one file; runs in a worker process."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    if path.lower().endswith('.pdf'):
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        pages = [(page.extract_text() or '', {'page': number})
+                 for number, page in enumerate(reader.pages, start=1)]
+    else:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            pages = [(f.read(), {})]
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    documents = splitter.create_documents([text for text, _ in pages], metadatas=[meta for _, meta in pages])
+    return [(doc.page_content, doc.metadata) for doc in documents if doc.page_content.strip()]
+
+
+def iter_chunks(files, cache_dir, chunk_size, chunk_overlap, workers=None):
+    """
+    Yield langchain Documents for `files` (from scan()), reusing cached chunks of
+    unchanged files. Cache entries for files no longer in the corpus are removed.
+    """
+    from langchain_core.documents import Document
+
+    os.makedirs(cache_dir, exist_ok=True)
+    settings = f"{chunk_size}-{chunk_overlap}-v2"
+    cache_paths = [os.path.join(cache_dir, f"{sha256[:32]}-{settings}.json") for _, _, sha256 in files]
+    keep = {os.path.basename(path) for path in cache_paths}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.json') and name not in keep:
+            os.unlink(os.path.join(cache_dir, name))
+
+    stale = {i for i, path in enumerate(cache_paths) if not os.path.exists(path)}
+    pool = None
+    if len(stale) > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        # Submitted up front so later files parse while earlier ones are embedded
+        parsed = {i: pool.submit(parse_file, files[i][1], chunk_size, chunk_overlap)
+                  for i in stale} if pool else {}
+        for i, (relpath, path, _) in enumerate(files):
+            if i in stale:
+                try:
+                    chunks = parsed.pop(i).result() if i in parsed else parse_file(path, chunk_size, chunk_overlap)
+                except Exception as e:
+                    # Not cached, so the file is retried on the next build
+                    print(f"RAG Error: skipping {relpath}, could not parse it: {e}")
+                    continue
+                _write_json(cache_paths[i], chunks)
+            else:
+                with open(cache_paths[i], encoding='utf-8') as f:
+                    chunks = json.load(f)
+            for text, metadata in chunks:
+                yield Document(page_content=text, metadata={'source': relpath, **metadata})
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,45 @@
+"""
+Lexical Index
+TF-IDF index over the RAG chunks, used by rag_utils alongside the FAISS store:
+fused with vector results for hybrid retrieval, and on its own when no
+embedding call can be made (no API key, keyword queries, latency budget missed).
+
+Chunks are identified by their position, the same position they have in the
+FAISS index.
+"""
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# Reciprocal-rank fusion constant from Cormack et al.; damps the weight of the top ranks
+RRF_K = 60
+
+
+class LexicalIndex:
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.vectorizer = TfidfVectorizer(sublinear_tf=True, stop_words='english')
+        try:
+            self.matrix = self.vectorizer.fit_transform(self.texts)
+        except ValueError:
+            # Empty corpus, or nothing but stop words
+            self.matrix = None
+
+    def search(self, query, k):
+        """Positions of up to `k` chunks sharing terms with `query`, best first."""
+        if self.matrix is None:
+            return []
+        scores = (self.matrix @ self.vectorizer.transform([query]).T).toarray().ravel()
+        matching = np.flatnonzero(scores)
+        if not len(matching):
+            return []
+        top = matching[np.argsort(-scores[matching], kind='stable')[:k]]
+        return [int(position) for position in top]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Merge ranked lists of chunk positions: score(d) = sum of 1 / (k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, start=1):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda position: -scores[position])
@@ -0,0 +1,251 @@
+"""
+Sensor Reading Bus
+In-process publish/subscribe for newly written sensor readings. The sensor store
+publishes every reading it adds or changes (device posts, batch ingest, Google Fit
+sync), and /api/sensor-readings/stream relays them to dashboards over SSE.
+The bus also keeps a per-user data version in the `reading_versions` collection,
+    {_id: user_id, epoch, version}
+bumped by the process that publishes a write (or calls touch()), so every
+worker sees it; /api/google-fit/latest uses it as its ETag.
+
+Versions cost one upsert per user on the write path and one _id lookup per
+/latest poll, including polls answered with 304. Writers that publish many
+times for one logical write (a Google Fit sync, a batch upload) wrap it in
+batched_versions(), so the version is bumped once when the block exits.
+
+Backends (READING_BUS_BACKEND):
+    local   - the store publishes directly; subscribers only see writes made by
+              this process (default, fine for a single worker)
+    mongo   - a change stream on the store's collection feeds the bus, so writes
+              from any process reach every subscriber (requires a replica set)
+"""
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from pymongo.errors import PyMongoError
+
+BACKENDS = ('local', 'mongo')
+
+# Events buffered per connection before the oldest are dropped
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv('READING_BUS_QUEUE_SIZE', 256))
+MAX_SUBSCRIBERS = int(os.getenv('READING_BUS_MAX_SUBSCRIBERS', 100))
+CHANGE_STREAM_RETRY_SECONDS = 5
+
+
+class SubscriberLimitReached(Exception):
+    """Raised when MAX_SUBSCRIBERS connections are already open."""
+
+
+def reading_event(doc):
+    """The JSON-friendly payload pushed to subscribers for one reading."""
+    recorded_at = doc.get('recorded_at')
+    synced_at = doc.get('synced_at')
+    return {
+        'id': str(doc.get('_id')) if doc.get('_id') is not None else None,
+        'type': doc.get('type') or doc.get('reading_type'),
+        'value': doc.get('value'),
+        'unit': doc.get('unit'),
+        'source': doc.get('source'),
+        'recorded_at': recorded_at.isoformat() if hasattr(recorded_at, 'isoformat') else recorded_at,
+        'synced_at': synced_at.isoformat() if hasattr(synced_at, 'isoformat') else synced_at,
+        'date': doc.get('date'),
+    }
+
+
+class Subscription:
+    """
+    One subscriber's bounded event queue. A slow consumer never blocks
+    publishers: once the queue is full the oldest events are discarded and
+    counted in `dropped`, so the consumer can tell it should refetch.
+    """
+
+    def __init__(self, bus, user_id, maxlen):
+        self.bus = bus
+        self.user_id = user_id
+        self.events = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """
+        Wait up to `timeout` seconds for events.
+        Returns (events, dropped) and resets both; ([], 0) on timeout.
+        """
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class ReadingBus:
+    """Fan-out of reading events to per-user subscribers."""
+
+    def __init__(self, backend='local', max_subscribers=MAX_SUBSCRIBERS, queue_size=SUBSCRIBER_QUEUE_SIZE,
+                 db=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown READING_BUS_BACKEND '{backend}' (expected one of {', '.join(BACKENDS)})")
+        self.backend = backend
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._relay = None
+        self._db = db
+        # Users whose version bump is deferred by batched_versions(), per thread
+        self._pending = threading.local()
+
+    # --- Subscribers ---
+
+    def subscribe(self, user_id):
+        """Register a subscriber for one user's readings. Raises SubscriberLimitReached."""
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise SubscriberLimitReached(f"{self.max_subscribers} subscribers already connected")
+            subscription = Subscription(self, user_id, self.queue_size)
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+        if self.backend == 'mongo':
+            self._start_relay()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def subscriber_count(self):
+        return self._count
+
+    # --- Data versions ---
+
+    def _versions(self):
+        if self._db is None:
+            from database import get_db
+            self._db = get_db()
+        return self._db['reading_versions']
+
+    def data_version(self, user_id):
+        """
+        Opaque version of a user's readings; it changes whenever one of their
+        readings is published or touch() is called, by any process.
+        """
+        doc = self._versions().find_one({'_id': user_id})
+        return f"{doc['epoch']}-{doc['version']}" if doc else '0'
+
+    def touch(self, user_id):
+        """Bump a user's data version, e.g. when only last_sync changed."""
+        pending = getattr(self._pending, 'users', None)
+        if pending is not None:
+            pending.add(user_id)
+            return
+        # The epoch tells a recreated counter apart from an ETag issued before it
+        self._versions().update_one({'_id': user_id},
+                                    {'$inc': {'version': 1}, '$setOnInsert': {'epoch': uuid.uuid4().hex[:8]}},
+                                    upsert=True)
+
+    @contextmanager
+    def batched_versions(self):
+        """
+        Defer this thread's version bumps (from publish() and touch()) to the end
+        of the block, bumping each user once. Nested blocks join the outer one.
+        """
+        if getattr(self._pending, 'users', None) is not None:
+            yield
+            return
+        self._pending.users = set()
+        try:
+            yield
+        finally:
+            users, self._pending.users = self._pending.users, None
+            self._bump(users)
+
+    def _bump(self, user_ids):
+        try:
+            for user_id in user_ids:
+                self.touch(user_id)
+        except PyMongoError as e:
+            # The write itself succeeded; a stale ETag only costs one extra poll
+            print(f"❌ Reading bus version update error: {e}")
+
+    # --- Publishing ---
+
+    def publish(self, docs):
+        """
+        Called by the sensor store with every added or changed reading. Bumps the
+        writers' data versions (see batched_versions()); with the mongo backend
+        the change stream delivers the events instead.
+        """
+        self._bump({doc.get('user_id') for doc in docs})
+        if self.backend == 'local':
+            self._deliver(docs)
+
+    def _deliver(self, docs):
+        if not self._subscribers:
+            return
+        for doc in docs:
+            with self._lock:
+                subscribers = list(self._subscribers.get(doc.get('user_id'), ()))
+            if subscribers:
+                event = reading_event(doc)
+                for subscription in subscribers:
+                    subscription.put(event)
+
+    # --- Change stream relay ---
+
+    def _start_relay(self):
+        with self._lock:
+            if self._relay is not None:
+                return
+            self._relay = threading.Thread(target=self._run_relay, name='reading-bus-relay', daemon=True)
+        self._relay.start()
+
+    def _run_relay(self):
+        """Follow the store's change stream, resuming after errors where it left off."""
+        from services.sensor_store import get_sensor_store
+
+        store = get_sensor_store()
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        resume_token = None
+        while True:
+            try:
+                with store.collection.watch(pipeline, full_document='updateLookup',
+                                            resume_after=resume_token) as stream:
+                    print(f"📡 Reading bus following {store.collection.name} change stream")
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self._deliver(store.decode_change(change))
+            except PyMongoError as e:
+                print(f"❌ Reading bus change stream error: {e}")
+                time.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+
+_reading_bus = None
+
+
+def get_reading_bus():
+    """Return the process-wide bus for the configured READING_BUS_BACKEND."""
+    global _reading_bus
+    if _reading_bus is None:
+        _reading_bus = ReadingBus(os.getenv('READING_BUS_BACKEND', 'local'))
+    return _reading_bus
@@ -0,0 +1,156 @@
+"""
+Heart-Rate Run Compaction
+Collapses runs of equal (or near-equal) samples into span records, used by the
+`compact` sensor storage mode (see services/sensor_store.py).
+
+A span record is a reading document with two extra fields:
+    {..., value, recorded_at: first sample, end_at: last sample, count}
+Consecutive samples of the same series (user, type, source, unit, device) join
+a span while:
+    - their value is within SENSOR_COMPACT_TOLERANCE of the span's value (its first sample),
+    - they follow the previous sample by at most SENSOR_COMPACT_MAX_GAP_SECONDS,
+    - the span stays shorter than SENSOR_COMPACT_MAX_SPAN_SECONDS.
+Expanding a span yields `count` readings with the span's value, spaced evenly
+from recorded_at to end_at: values are kept to within the tolerance, individual
+timestamps inside a run are not.
+"""
+import os
+from bisect import bisect_right
+from datetime import timedelta
+
+COMPACT_TYPES = tuple(t for t in os.getenv('SENSOR_COMPACT_TYPES', 'heart_rate').split(',') if t)
+TOLERANCE = float(os.getenv('SENSOR_COMPACT_TOLERANCE', 0))
+MAX_GAP = timedelta(seconds=int(os.getenv('SENSOR_COMPACT_MAX_GAP_SECONDS', 120)))
+MAX_SPAN = timedelta(seconds=int(os.getenv('SENSOR_COMPACT_MAX_SPAN_SECONDS', 900)))
+
+# Fields besides user_id / type / source that must match for samples to share a span
+SERIES_FIELDS = ('unit', 'device_name')
+
+
+def series_key(doc, type_field):
+    return (doc['user_id'], type_field, doc[type_field], doc.get('source')) + \
+        tuple(doc.get(field) for field in SERIES_FIELDS)
+
+
+def _within(value, anchor, tolerance):
+    if value == anchor:
+        return True
+    try:
+        return abs(value - anchor) <= tolerance
+    except TypeError:
+        return False
+
+
+class Run:
+    """A span being planned: either a stored record (`stored_id`) or a new one started by `doc`."""
+
+    __slots__ = ('doc', 'stored_id', 'stored_count', 'start', 'end', 'value', 'count', 'added', 'extendable')
+
+    def __init__(self, doc, start, end, value, count, stored_id=None, extendable=True):
+        self.doc = doc
+        self.stored_id = stored_id
+        self.stored_count = count if stored_id is not None else 0
+        self.start = start
+        self.end = end
+        self.value = value
+        self.count = count
+        self.added = []  # indexes of planned samples written into this run
+        self.extendable = extendable
+
+    @classmethod
+    def from_record(cls, record):
+        # Records written before compaction have no count and are only used for de-duplication
+        return cls(None, record['recorded_at'], record.get('end_at', record['recorded_at']),
+                   record.get('value'), record.get('count', 1), stored_id=record['_id'],
+                   extendable='count' in record)
+
+    def covers(self, recorded_at):
+        return self.start <= recorded_at <= self.end
+
+    def accepts(self, value, recorded_at, tolerance, max_gap, max_span):
+        return (self.extendable and self.end <= recorded_at
+                and recorded_at - self.end <= max_gap
+                and recorded_at - self.start < max_span
+                and _within(value, self.value, tolerance))
+
+    def record(self):
+        """The span document for a new run."""
+        return {**self.doc, 'end_at': self.end, 'count': self.count}
+
+
+def plan_runs(samples, stored=(), tolerance=TOLERANCE, max_gap=MAX_GAP, max_span=MAX_SPAN):
+    """
+    Assign one series' samples to spans.
+    `samples` is a list of (index, doc) ordered by recorded_at; `stored` the
+    series' existing records ordered by recorded_at.
+    Returns (runs, covered): runs that are new or received samples, and
+    (index, run) for samples already covered by a stored record or duplicating
+    an earlier sample of the batch (nothing to write, not counted).
+    """
+    stored_runs = [Run.from_record(record) for record in stored]
+    starts = [run.start for run in stored_runs]
+    runs, covered = [], []
+    last_new = None
+    for index, doc in samples:
+        recorded_at, value = doc['recorded_at'], doc.get('value')
+
+        position = bisect_right(starts, recorded_at) - 1
+        previous = stored_runs[position] if position >= 0 else None
+        if previous and previous.covers(recorded_at):
+            if _within(value, previous.value, tolerance):
+                covered.append((index, previous))
+                continue
+            candidate = None  # disagrees with the span around it: keep it as its own record
+        else:
+            candidate = previous
+            if last_new and (candidate is None or last_new.end >= candidate.end):
+                candidate = last_new
+            if last_new and last_new.covers(recorded_at) and _within(value, last_new.value, tolerance):
+                # Duplicate sample within this batch
+                covered.append((index, last_new))
+                continue
+
+        if candidate and candidate.accepts(value, recorded_at, tolerance, max_gap, max_span):
+            candidate.end = recorded_at
+            candidate.count += 1
+            candidate.added.append(index)
+            if candidate.stored_id is not None and len(candidate.added) == 1:
+                runs.append(candidate)
+            continue
+
+        last_new = Run(doc, recorded_at, recorded_at, value, 1)
+        last_new.added.append(index)
+        runs.append(last_new)
+    return runs, covered
+
+
+def compact(docs, type_field='type', **limits):
+    """Span records for `docs` (one or more series, any order); for offline use and benchmarks."""
+    series = {}
+    for index, doc in enumerate(docs):
+        series.setdefault(series_key(doc, type_field), []).append((index, doc))
+    records = []
+    for samples in series.values():
+        samples.sort(key=lambda item: item[1]['recorded_at'])
+        runs, _ = plan_runs(samples, **limits)
+        records.extend(run.record() for run in runs)
+    return records
+
+
+def expand(record):
+    """Yield the readings a stored record stands for, oldest first."""
+    count = record.get('count', 1)
+    if 'end_at' not in record and 'count' not in record:
+        yield record
+        return
+    reading = {k: v for k, v in record.items() if k not in ('end_at', 'count')}
+    if count <= 1:
+        yield reading
+        return
+    start, end = record['recorded_at'], record['end_at']
+    step = (end - start) / (count - 1)
+    for i in range(count):
+        recorded_at = start + step * i
+        yield {**reading,
+               '_id': f"{record['_id']}.{i:06d}",
+               'recorded_at': recorded_at.replace(microsecond=recorded_at.microsecond // 1000 * 1000)}
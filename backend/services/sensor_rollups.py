@@ -0,0 +1,188 @@
+"""
+Sensor Reading Rollups
+Maintains minute, hour and day aggregates (count, sum, min, max, last) per user,
+metric and source in `sensor_rollups`, so long-range charts read one document
+per bucket instead of one per sample.
+
+Rollups are updated incrementally by the sensor store on every write. When a
+reading's value changes, min and max of the buckets holding it are recomputed
+from the stored readings of that day, since the old value may have been one of
+them. Rebuild all rollups from stored readings with:
+    python -m services.sensor_rollups rebuild [--user USER_ID]
+"""
+import sys
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne
+from database import get_db
+
+EPOCH = datetime(1970, 1, 1)
+
+RESOLUTIONS = {
+    '1m': timedelta(minutes=1),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+
+
+def _bucket_start(dt, resolution):
+    step = RESOLUTIONS[resolution]
+    return EPOCH + ((dt - EPOCH) // step) * step
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SensorRollups:
+    """Incrementally maintained aggregates over sensor readings."""
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db['sensor_rollups']
+
+    def record(self, changes, store=None):
+        """
+        Fold written readings into every resolution.
+        `changes` is an iterable of (doc, previous_value): previous_value is None
+        for a new reading, or the value it replaced when an existing reading changed
+        (which adjusts the sum without counting the sample twice).
+        With `store`, buckets holding a changed value get min/max recomputed from it.
+        """
+        from services.sensor_store import _to_datetime, _type_of
+
+        deltas = {}
+        # {(user_id, type, source, day start): {(resolution, bucket start)}} of changed values
+        changed = {}
+        for doc, previous in changes:
+            value = doc.get('value')
+            recorded_at = _to_datetime(doc.get('recorded_at'))
+            if not _is_number(value) or recorded_at is None:
+                continue
+            if previous is not None and not _is_number(previous):
+                previous = None
+            for resolution in RESOLUTIONS:
+                start = _bucket_start(recorded_at, resolution)
+                key = (doc['user_id'], _type_of(doc), doc.get('source'), resolution, start)
+                delta = deltas.setdefault(key, {
+                    'count': 0, 'sum': 0, 'min': value, 'max': value,
+                    'last': value, 'last_at': recorded_at, 'unit': doc.get('unit'),
+                })
+                delta['count'] += 0 if previous is not None else 1
+                delta['sum'] += value - (previous or 0)
+                delta['min'] = min(delta['min'], value)
+                delta['max'] = max(delta['max'], value)
+                if recorded_at >= delta['last_at']:
+                    delta['last'], delta['last_at'] = value, recorded_at
+                if previous is not None and previous != value:
+                    day = (doc['user_id'], _type_of(doc), doc.get('source'), _bucket_start(recorded_at, '1d'))
+                    changed.setdefault(day, set()).add((resolution, start))
+
+        if deltas:
+            self.collection.bulk_write(
+                [self._rollup_op(key, delta) for key, delta in deltas.items()],
+                ordered=False
+            )
+        if changed and store is not None:
+            self._recompute_extremes(store, changed)
+
+    def _recompute_extremes(self, store, changed):
+        """Reset min/max of the changed buckets from the stored readings of their day."""
+        ops = []
+        for (user_id, reading_type, source, day), buckets in changed.items():
+            extremes = {}
+            for doc in store.iter_readings(user_id, types=[reading_type], source=source, since=day,
+                                           until=day + RESOLUTIONS['1d'], fields=['value']):
+                value = doc.get('value')
+                if not _is_number(value):
+                    continue
+                for resolution in RESOLUTIONS:
+                    bucket = (resolution, _bucket_start(doc['recorded_at'], resolution))
+                    if bucket in buckets:
+                        low, high = extremes.get(bucket, (value, value))
+                        extremes[bucket] = (min(low, value), max(high, value))
+            ops.extend(
+                UpdateOne({'_id': self._rollup_id(user_id, reading_type, source, resolution, start)},
+                          {'$set': {'min': low, 'max': high}})
+                for (resolution, start), (low, high) in extremes.items()
+            )
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
+    @staticmethod
+    def _rollup_id(user_id, reading_type, source, resolution, start):
+        return f"{user_id}|{reading_type}|{source}|{resolution}|{start.strftime('%Y%m%d%H%M')}"
+
+    def _rollup_op(self, key, delta):
+        user_id, reading_type, source, resolution, start = key
+        # Pipeline update so `last` only moves forward in time and min/max merge in one round trip
+        return UpdateOne(
+            {'_id': self._rollup_id(*key)},
+            [{'$set': {
+                'user_id': {'$literal': user_id},
+                'type': {'$literal': reading_type},
+                'source': {'$literal': source},
+                'resolution': resolution,
+                'bucket_start': start,
+                'unit': {'$literal': delta['unit']},
+                'count': {'$add': [{'$ifNull': ['$count', 0]}, delta['count']]},
+                'sum': {'$add': [{'$ifNull': ['$sum', 0]}, delta['sum']]},
+                'min': {'$min': [{'$ifNull': ['$min', delta['min']]}, delta['min']]},
+                'max': {'$max': [{'$ifNull': ['$max', delta['max']]}, delta['max']]},
+                'last': {'$cond': [
+                    {'$gte': [delta['last_at'], {'$ifNull': ['$last_at', EPOCH]}]},
+                    delta['last'], '$last'
+                ]},
+                'last_at': {'$max': [{'$ifNull': ['$last_at', delta['last_at']]}, delta['last_at']]},
+            }}],
+            upsert=True
+        )
+
+    def iter_rollups(self, user_id, types, source, resolution, since=None, until=None):
+        """Yield rollup documents for the given types, ordered by type then bucket_start."""
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution '{resolution}'")
+        query = {
+            'user_id': user_id,
+            'type': {'$in': list(types)},
+            'source': source,
+            'resolution': resolution,
+        }
+        time_range = {}
+        if since:
+            time_range['$gte'] = _bucket_start(since, resolution)
+        if until:
+            time_range['$lt'] = until
+        if time_range:
+            query['bucket_start'] = time_range
+        yield from self.collection.find(query).sort([('type', ASCENDING), ('bucket_start', ASCENDING)])
+
+    def rebuild(self, store, user_id=None, batch_size=1000):
+        """Recompute rollups from stored readings for one user or everyone."""
+        user_ids = [user_id] if user_id else store.collection.distinct('user_id')
+        for uid in user_ids:
+            self.collection.delete_many({'user_id': uid})
+            batch = []
+            for doc in store.iter_readings(uid):
+                batch.append((doc, None))
+                if len(batch) >= batch_size:
+                    self.record(batch)
+                    batch = []
+            if batch:
+                self.record(batch)
+            print(f"✅ Rebuilt rollups for user {uid}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != 'rebuild':
+        print(__doc__)
+        return 1
+    from services.sensor_store import get_sensor_store
+    user_id = argv[argv.index('--user') + 1] if '--user' in argv else None
+    store = get_sensor_store()
+    SensorRollups(get_db()).rebuild(store, user_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,941 @@
+"""
+Sensor Reading Storage
+Keeps the physical layout of sensor readings behind one interface so routes and
+sync code read and write "reading documents" regardless of how they are stored.
+
+Modes (SENSOR_STORAGE_MODE):
+    flat    - one document per reading in `sensor_readings` (default)
+    bucket  - readings packed into per-user, per-type, per-source, per-hour
+              documents in `sensor_buckets`
+    compact - flat, except that runs of equal heart-rate samples are stored as
+              one span record (see services/sensor_compaction.py)
+
+A reading document always has the flat shape:
+    {_id, user_id, type | reading_type, value, unit, source, recorded_at,
+     device_name?, date?, synced_at?}
+
+Usage:
+    python -m services.sensor_store migrate [--batch-size N]
+    python -m services.sensor_store backfill-timestamps [--batch-size N]
+"""
+import base64
+import heapq
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from itertools import groupby
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
+from database import get_db
+from services.sensor_rollups import SensorRollups
+from services.reading_bus import get_reading_bus
+from services.sensor_compaction import COMPACT_TYPES, MAX_SPAN, expand, plan_runs, series_key
+
+EPOCH = datetime(1970, 1, 1)
+
+# Fields that identify a bucket; everything else about a reading lives in the sample
+BUCKET_KEY_FIELDS = ('user_id', 'type', 'source')
+
+# Marks a reading with no stored value yet (None is a legitimate stored value)
+_MISSING = object()
+# Tags each row of the latest_by_type() aggregation with the type it was fetched for
+_LATEST_TAG = '_latest_type'
+
+
+def _to_datetime(value):
+    """Coerce a stored recorded_at (datetime or ISO string) to a naive UTC datetime."""
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if parsed.tzinfo:
+            parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+        return parsed
+    return None
+
+
+def _epoch_ms(dt):
+    """Milliseconds since the epoch for a naive UTC datetime (BSON date precision)."""
+    return (dt - EPOCH) // timedelta(milliseconds=1)
+
+
+def _from_epoch_ms(ms):
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def _millis(dt):
+    """Truncate to the millisecond precision BSON dates are stored with."""
+    return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+
+
+def _type_of(doc):
+    """Google Fit readings use `type`, device readings posted by the frontend use `reading_type`."""
+    return doc.get('type') or doc.get('reading_type')
+
+
+def _type_match(types):
+    """Query clause matching readings of `types` under either type field."""
+    types = list(types)
+    return {'$or': [{'type': {'$in': types}}, {'reading_type': {'$in': types}}]}
+
+
+class SensorStore:
+    """One document per reading in `sensor_readings`."""
+
+    mode = 'flat'
+
+    def __init__(self, db, bus=None):
+        self.db = db
+        self.collection = db['sensor_readings']
+        self.rollups = SensorRollups(db)
+        self.bus = bus if bus is not None else get_reading_bus()
+
+    # --- Writes ---
+
+    def insert_reading(self, doc):
+        """Insert a single reading. Returns its id as a string."""
+        errors = self.insert_readings([doc])
+        if errors:
+            raise RuntimeError(errors[0])
+        return str(doc['_id'])
+
+    def insert_readings(self, docs):
+        """
+        Insert readings unordered. Assigns `_id` on every document.
+        Returns {index: error message} for documents that were rejected.
+        """
+        if not docs:
+            return {}
+        errors = {}
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = _write_errors(e)
+        self._after_write([(doc, None) for index, doc in enumerate(docs) if index not in errors])
+        return errors
+
+    def upsert_reading(self, doc):
+        """Insert or update the reading identified by (user_id, type, recorded_at)."""
+        key = {'user_id': doc['user_id'], 'type': doc['type'], 'recorded_at': doc['recorded_at']}
+        fields = {k: v for k, v in doc.items() if k not in key and k != '_id'}
+        before = self.collection.find_one_and_update(
+            key, {'$set': fields}, projection={'value': 1},
+            upsert=True, return_document=ReturnDocument.BEFORE
+        )
+        self._record_upsert(doc, before.get('value') if before else None, before is not None)
+
+    def upsert_readings(self, docs):
+        """
+        Bulk form of upsert_reading(): one unordered bulk_write for all of `docs`.
+        Stored values are read first (one indexed query per user and type) so only
+        new or changed readings reach the write hook.
+        Returns (statuses, errors): a status per document ('upserted', 'modified',
+        'unchanged' or 'error') and {index: error message}.
+        """
+        if not docs:
+            return [], {}
+        times = {}
+        for doc in docs:
+            times.setdefault((doc['user_id'], doc['type']), []).append(doc['recorded_at'])
+        stored = {}
+        for (user_id, reading_type), recorded_at in times.items():
+            rows = self.collection.find(
+                {'user_id': user_id, 'type': reading_type, 'recorded_at': {'$in': recorded_at}},
+                {'recorded_at': 1, 'value': 1}
+            )
+            for row in rows:
+                stored[(user_id, reading_type, _millis(row['recorded_at']))] = row.get('value')
+
+        ops = []
+        for doc in docs:
+            key = {'user_id': doc['user_id'], 'type': doc['type'], 'recorded_at': doc['recorded_at']}
+            fields = {k: v for k, v in doc.items() if k not in key and k != '_id'}
+            ops.append(UpdateOne(key, {'$set': fields}, upsert=True))
+        errors = {}
+        try:
+            self.collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            errors = _write_errors(e)
+
+        return self._diff_upserts(docs, errors, [
+            stored.get((doc['user_id'], doc['type'], _millis(doc['recorded_at'])), _MISSING) for doc in docs
+        ])
+
+    def _diff_upserts(self, docs, errors, previous_values):
+        """Classify bulk-upserted docs against their stored values and run the write hook on the changes."""
+        statuses, changes = [], []
+        for index, (doc, previous) in enumerate(zip(docs, previous_values)):
+            if index in errors:
+                statuses.append('error')
+            elif previous is _MISSING:
+                statuses.append('upserted')
+                changes.append((doc, None))
+            elif previous != doc.get('value'):
+                statuses.append('modified')
+                changes.append((doc, previous))
+            else:
+                statuses.append('unchanged')
+        self._after_write(changes)
+        return statuses, errors
+
+    def _record_upsert(self, doc, previous, existed):
+        """Pass an upserted reading on unless it rewrote an identical value."""
+        if existed and previous == doc.get('value'):
+            return
+        self._after_write([(doc, previous if existed else None)])
+
+    def _after_write(self, changes):
+        """Hook run with (doc, previous_value) pairs for every reading that was added or changed."""
+        if changes:
+            self.rollups.record(changes, store=self)
+            self.bus.publish([doc for doc, _ in changes])
+
+    def decode_change(self, change):
+        """Reading documents carried by a change stream event on this store's collection."""
+        doc = change.get('fullDocument')
+        return [doc] if doc else []
+
+    # --- Reads ---
+
+    def iter_readings(self, user_id, types=None, source=None, since=None, until=None,
+                      descending=False, limit=None, after=None, fields=None, batch_size=None,
+                      expand=True):
+        """
+        Yield reading documents for a user ordered by (recorded_at, _id).
+        `types` matches Google Fit `type` and device `reading_type` alike; `since` is
+        inclusive, `until` exclusive.
+        `after` is a (recorded_at, _id) key from decode_cursor(); iteration resumes past it.
+        `fields` limits the returned fields (recorded_at and _id are always included) and
+        `batch_size` bounds how many documents each round trip to the server returns.
+        With expand=False the compact store yields its span records as stored;
+        the other stores have none.
+        """
+        query = {'user_id': user_id}
+        clauses = []
+        if types:
+            clauses.append(_type_match(types))
+        if source:
+            query['source'] = source
+        time_range = {}
+        if since:
+            time_range['$gte'] = since
+        if until:
+            time_range['$lt'] = until
+        if time_range:
+            query['recorded_at'] = time_range
+        if after:
+            op = '$lt' if descending else '$gt'
+            recorded_at, doc_id = after
+            clauses.append({'$or': [
+                {'recorded_at': {op: recorded_at}},
+                {'recorded_at': recorded_at, '_id': {op: doc_id}},
+            ]})
+        if clauses:
+            query['$and'] = clauses
+
+        direction = DESCENDING if descending else ASCENDING
+        projection = dict.fromkeys(fields, 1) if fields else None
+        if projection:
+            projection['recorded_at'] = 1
+        cursor = self.collection.find(query, projection).sort([('recorded_at', direction), ('_id', direction)])
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        yield from cursor
+
+    def iter_series(self, user_id, types, source=None, since=None, fields=None, batch_size=None):
+        """
+        Yield readings of several types in one query, grouped by type and ordered by
+        recorded_at within each type, so callers can split the stream into per-type series.
+        """
+        query = {'user_id': user_id, 'type': {'$in': list(types)}}
+        if source:
+            query['source'] = source
+        if since:
+            query['recorded_at'] = {'$gte': since}
+        projection = dict.fromkeys(fields, 1) if fields else None
+        if projection:
+            projection.update({'type': 1, 'recorded_at': 1})
+        # (type desc, recorded_at asc) is a backward walk of the (user_id, type, source, recorded_at desc) index
+        cursor = self.collection.find(query, projection).sort([('type', DESCENDING), ('recorded_at', ASCENDING)])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        yield from cursor
+
+    def latest_by_type(self, user_id, types, source=None, union_with=None):
+        """
+        Newest reading of each type in one round trip: a single aggregation whose
+        per-type branches are joined with $unionWith, each an index seek as in
+        latest() (a $sort + $group over the types can walk every matching sample).
+        `union_with` is an optional {coll, pipeline} $unionWith spec appended to
+        the same aggregation, for callers that need one more lookup.
+        Returns ({type: doc}, [union_with documents]).
+        """
+        branches = [self._latest_pipeline(user_id, reading_type, source=source)
+                    + [{'$addFields': {_LATEST_TAG: reading_type}}]
+                    for reading_type in types]
+        if not branches:
+            extra = list(self.db[union_with['coll']].aggregate(union_with.get('pipeline', []))) if union_with else []
+            return {}, extra
+
+        pipeline = branches[0] + [{'$unionWith': {'coll': self.collection.name, 'pipeline': branch}}
+                                  for branch in branches[1:]]
+        if union_with:
+            pipeline.append({'$unionWith': union_with})
+
+        rows, extra = {}, []
+        for row in self.collection.aggregate(pipeline):
+            reading_type = row.pop(_LATEST_TAG, None)
+            if reading_type is None:
+                extra.append(row)
+            else:
+                rows.setdefault(reading_type, []).append(row)
+        latest = {}
+        for reading_type, docs in rows.items():
+            doc = self._latest_reading(docs)
+            if doc is not None:
+                latest[reading_type] = doc
+        return latest, extra
+
+    def _latest_pipeline(self, user_id, reading_type, source=None):
+        """Aggregation stages fetching what latest() reads for one type."""
+        query = {'user_id': user_id, 'type': reading_type}
+        if source:
+            query['source'] = source
+        return [{'$match': query}, {'$sort': {'recorded_at': DESCENDING}}, {'$limit': 1}]
+
+    def _latest_reading(self, docs):
+        """The newest reading among the documents _latest_pipeline() returned."""
+        return docs[0] if docs else None
+
+    def encode_cursor(self, doc):
+        """Opaque pagination cursor for the position of `doc`."""
+        recorded_at = doc['recorded_at']
+        if isinstance(recorded_at, datetime):
+            recorded_at = recorded_at.isoformat()
+        payload = json.dumps([recorded_at, str(doc['_id'])]).encode('utf-8')
+        return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, token):
+        """Inverse of encode_cursor(). Raises ValueError for malformed cursors."""
+        try:
+            padded = token + '=' * (-len(token) % 4)
+            recorded_at, doc_id = json.loads(base64.urlsafe_b64decode(padded))
+            recorded_at = _to_datetime(recorded_at)
+            doc_id = self._cursor_id(doc_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+        if recorded_at is None:
+            raise ValueError("Invalid cursor")
+        return recorded_at, doc_id
+
+    def _cursor_id(self, doc_id):
+        return ObjectId(doc_id)
+
+    def latest(self, user_id, reading_type, source=None):
+        """Return the newest reading of a type, or None."""
+        query = {'user_id': user_id, 'type': reading_type}
+        if source:
+            query['source'] = source
+        return self.collection.find_one(query, sort=[('recorded_at', DESCENDING)])
+
+
+class BucketedSensorStore(SensorStore):
+    """
+    Readings packed into one document per (user_id, type, source, hour) in `sensor_buckets`:
+        {_id: "<user_id>|<type>|<source>|<YYYYmmddHH>", user_id, type, source,
+         bucket_start, first_at, last_at, samples: {"<epoch_ms>": {value, unit, ...}}}
+    Samples are keyed by timestamp, so writing the same reading twice is idempotent
+    and both inserts and Google Fit upserts become a single `$set`.
+    """
+
+    mode = 'bucket'
+
+    def __init__(self, db, bus=None):
+        super().__init__(db, bus=bus)
+        self.collection = db['sensor_buckets']
+
+    @staticmethod
+    def _bucket_id(user_id, reading_type, source, bucket_start):
+        return f"{user_id}|{reading_type}|{source}|{bucket_start.strftime('%Y%m%d%H')}"
+
+    def _bucket_update(self, doc):
+        """
+        Build the (filter, update) pair that stores `doc` in its bucket and set
+        doc['_id'] to the reading id. Raises ValueError for unusable timestamps.
+        """
+        recorded_at = _to_datetime(doc.get('recorded_at'))
+        if recorded_at is None:
+            raise ValueError("recorded_at must be a datetime or ISO 8601 timestamp")
+        reading_type = _type_of(doc)
+        bucket_start = recorded_at.replace(minute=0, second=0, microsecond=0)
+        bucket_id = self._bucket_id(doc['user_id'], reading_type, doc.get('source'), bucket_start)
+        ms = _epoch_ms(recorded_at)
+
+        sample = {k: v for k, v in doc.items()
+                  if k not in BUCKET_KEY_FIELDS and k not in ('_id', 'recorded_at')}
+        doc['_id'] = f"{bucket_id}|{ms}"
+        return (
+            {'_id': bucket_id},
+            {
+                '$set': {f'samples.{ms}': sample},
+                '$setOnInsert': {
+                    'user_id': doc['user_id'],
+                    'type': reading_type,
+                    'source': doc.get('source'),
+                    'bucket_start': bucket_start,
+                },
+                '$min': {'first_at': recorded_at},
+                '$max': {'last_at': recorded_at},
+            }
+        )
+
+    def _bucket_op(self, doc):
+        return UpdateOne(*self._bucket_update(doc), upsert=True)
+
+    def insert_readings(self, docs):
+        errors = {}
+        ops, op_index = [], []
+        for index, doc in enumerate(docs):
+            try:
+                ops.append(self._bucket_op(doc))
+                op_index.append(index)
+            except ValueError as e:
+                errors[index] = str(e)
+        if ops:
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                for position, message in _write_errors(e).items():
+                    errors[op_index[position]] = message
+        self._after_write([(doc, None) for index, doc in enumerate(docs) if index not in errors])
+        return errors
+
+    def upsert_reading(self, doc):
+        doc = dict(doc)
+        bucket_filter, update = self._bucket_update(doc)
+        sample_path = next(iter(update['$set']))
+        before = self.collection.find_one_and_update(
+            bucket_filter, update, projection={sample_path: 1},
+            upsert=True, return_document=ReturnDocument.BEFORE
+        )
+        ms = sample_path.split('.', 1)[1]
+        previous = ((before or {}).get('samples') or {}).get(ms)
+        self._record_upsert(doc, previous.get('value') if previous else None, previous is not None)
+
+    def upsert_readings(self, docs):
+        docs = [dict(doc) for doc in docs]
+        ops, op_index, errors = [], [], {}
+        sample_paths = {}
+        for index, doc in enumerate(docs):
+            try:
+                bucket_filter, update = self._bucket_update(doc)
+            except ValueError as e:
+                errors[index] = str(e)
+                continue
+            ops.append(UpdateOne(bucket_filter, update, upsert=True))
+            op_index.append(index)
+            sample_paths.setdefault(bucket_filter['_id'], set()).update(update['$set'])
+
+        stored = {}
+        if sample_paths:
+            projection = {path: 1 for paths in sample_paths.values() for path in paths}
+            for bucket in self.collection.find({'_id': {'$in': list(sample_paths)}}, projection):
+                for ms, sample in (bucket.get('samples') or {}).items():
+                    stored[f"{bucket['_id']}|{ms}"] = sample.get('value')
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                for position, message in _write_errors(e).items():
+                    errors[op_index[position]] = message
+
+        return self._diff_upserts(docs, errors, [stored.get(doc.get('_id'), _MISSING) for doc in docs])
+
+    def _expand(self, bucket):
+        """Yield the flat reading documents stored in a bucket, oldest first."""
+        for ms in sorted(bucket.get('samples', {}), key=int):
+            sample = bucket['samples'][ms]
+            doc = {
+                '_id': f"{bucket['_id']}|{ms}",
+                'user_id': bucket['user_id'],
+                'source': bucket['source'],
+                'recorded_at': _from_epoch_ms(int(ms)),
+            }
+            if 'reading_type' not in sample:
+                doc['type'] = bucket['type']
+            doc.update(sample)
+            yield doc
+
+    def decode_change(self, change):
+        """Only the samples an event inserted or rewrote, not the whole bucket."""
+        bucket = change.get('fullDocument')
+        if not bucket:
+            return []
+        if change['operationType'] == 'update':
+            updated = change.get('updateDescription', {}).get('updatedFields', {})
+            keys = {field.split('.')[1] for field in updated if field.startswith('samples.')}
+            bucket = dict(bucket, samples={ms: sample for ms, sample in bucket.get('samples', {}).items()
+                                           if ms in keys})
+        return list(self._expand(bucket))
+
+    def iter_readings(self, user_id, types=None, source=None, since=None, until=None,
+                      descending=False, limit=None, after=None, fields=None, batch_size=None,
+                      expand=True):
+        # Samples are stored whole inside a bucket, so `fields` is not pushed down here
+        query = {'user_id': user_id}
+        if types:
+            query['type'] = {'$in': list(types)}
+        if source:
+            query['source'] = source
+        time_range = {}
+        if since:
+            time_range['$gte'] = since.replace(minute=0, second=0, microsecond=0)
+        if until:
+            time_range['$lt'] = until
+        if after:
+            after_hour = after[0].replace(minute=0, second=0, microsecond=0)
+            if descending:
+                time_range['$lte'] = after_hour
+            else:
+                time_range['$gte'] = max(after_hour, time_range.get('$gte', after_hour))
+        if time_range:
+            query['bucket_start'] = time_range
+
+        direction = DESCENDING if descending else ASCENDING
+        cursor = self.collection.find(query).sort('bucket_start', direction)
+        if batch_size:
+            # Each bucket holds up to an hour of samples; fetch proportionally fewer buckets
+            cursor = cursor.batch_size(max(1, batch_size // 60))
+
+        emitted = 0
+        # Buckets of different types/sources can share an hour; merge them per hour
+        for _, hour_buckets in groupby(cursor, key=lambda b: b['bucket_start']):
+            docs = [doc for bucket in hour_buckets for doc in self._expand(bucket)]
+            docs.sort(key=lambda d: (d['recorded_at'], d['_id']), reverse=descending)
+            for doc in docs:
+                if since and doc['recorded_at'] < since:
+                    continue
+                if until and doc['recorded_at'] >= until:
+                    continue
+                if after:
+                    key = (doc['recorded_at'], doc['_id'])
+                    if (key >= after) if descending else (key <= after):
+                        continue
+                yield doc
+                emitted += 1
+                if limit and emitted >= limit:
+                    return
+
+    def _cursor_id(self, doc_id):
+        return str(doc_id)
+
+    def iter_series(self, user_id, types, source=None, since=None, fields=None, batch_size=None):
+        query = {'user_id': user_id, 'type': {'$in': list(types)}}
+        if source:
+            query['source'] = source
+        if since:
+            query['bucket_start'] = {'$gte': since.replace(minute=0, second=0, microsecond=0)}
+        cursor = self.collection.find(query).sort([('type', DESCENDING), ('bucket_start', ASCENDING)])
+        if batch_size:
+            cursor = cursor.batch_size(max(1, batch_size // 60))
+        # Within one type, buckets of the same hour differ only by source
+        for _, hour_buckets in groupby(cursor, key=lambda b: (b['type'], b['bucket_start'])):
+            docs = [doc for bucket in hour_buckets for doc in self._expand(bucket)]
+            docs.sort(key=lambda d: d['recorded_at'])
+            for doc in docs:
+                if since and doc['recorded_at'] < since:
+                    continue
+                yield doc
+
+    def latest(self, user_id, reading_type, source=None):
+        query = {'user_id': user_id, 'type': reading_type}
+        if source:
+            query['source'] = source
+        bucket = self.collection.find_one(query, sort=[('bucket_start', DESCENDING)])
+        if not bucket:
+            return None
+        buckets = [bucket]
+        if not source:
+            # Other sources may have a newer sample in the same hour
+            query['bucket_start'] = bucket['bucket_start']
+            buckets = list(self.collection.find(query))
+        docs = [doc for bucket in buckets for doc in self._expand(bucket)]
+        return max(docs, key=lambda doc: doc['recorded_at']) if docs else None
+
+    def _latest_pipeline(self, user_id, reading_type, source=None):
+        query = {'user_id': user_id, 'type': reading_type}
+        if source:
+            query['source'] = source
+        pipeline = [{'$match': query}, {'$sort': {'bucket_start': DESCENDING}}, {'$limit': 1}]
+        if not source:
+            # Other sources may have a newer sample in the same hour, as in latest()
+            pipeline.append({'$lookup': {
+                'from': self.collection.name,
+                'let': {'hour': '$bucket_start'},
+                'pipeline': [{'$match': {'user_id': user_id, 'type': reading_type,
+                                         '$expr': {'$eq': ['$bucket_start', '$$hour']}}}],
+                'as': 'hour_buckets',
+            }})
+        return pipeline
+
+    def _latest_reading(self, docs):
+        buckets = [bucket for doc in docs for bucket in doc.pop('hour_buckets', None) or [doc]]
+        readings = [doc for bucket in buckets for doc in self._expand(bucket)]
+        return max(readings, key=lambda doc: doc['recorded_at']) if readings else None
+
+    def migrate_from_flat(self, batch_size=1000):
+        """
+        Move documents from `sensor_readings` into buckets, batch_size at a time.
+        Each batch is written before its flat documents are deleted, so the
+        migration can be interrupted and re-run safely.
+        Returns (migrated, skipped).
+        """
+        flat = self.db['sensor_readings']
+        migrated = skipped = 0
+        last_id = None
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            batch = list(flat.find(query).sort('_id', ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+
+            ops, done_ids = [], []
+            for doc in batch:
+                flat_id = doc['_id']
+                try:
+                    ops.append(self._bucket_op(doc))
+                    done_ids.append(flat_id)
+                except ValueError:
+                    skipped += 1
+            if ops:
+                self.collection.bulk_write(ops, ordered=False)
+                flat.delete_many({'_id': {'$in': done_ids}})
+                migrated += len(done_ids)
+            print(f"Migrated {migrated} readings ({skipped} skipped)")
+        return migrated, skipped
+
+
+class _Descending:
+    """Heap key wrapper that reverses the order of `key`."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _reading_key(doc):
+    return (doc['recorded_at'], str(doc['_id']))
+
+
+def _expand_in_order(records, descending=False):
+    """
+    Expand records sorted by recorded_at into readings ordered by (recorded_at, _id).
+    A span's readings lie within MAX_SPAN of its start, so readings are held back
+    only until no later record can still sort before them.
+    """
+    pending, seq = [], 0
+    for record in records:
+        start = record['recorded_at']
+        while pending:
+            doc = pending[0][2]
+            ready = doc['recorded_at'] > start + MAX_SPAN if descending else doc['recorded_at'] < start
+            if not ready:
+                break
+            yield heapq.heappop(pending)[2]
+        for doc in expand(record):
+            key = _reading_key(doc)
+            heapq.heappush(pending, (_Descending(key) if descending else key, seq, doc))
+            seq += 1
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+
+class CompactSensorStore(SensorStore):
+    """
+    One document per reading in `sensor_readings` as in flat mode, except that
+    samples of COMPACT_TYPES (heart rate by default) are stored as span records
+    covering runs of equal values; see services/sensor_compaction.py.
+    Reads expand spans back into readings unless called with expand=False.
+    """
+
+    mode = 'compact'
+
+    # --- Writes ---
+
+    def insert_readings(self, docs):
+        _, errors = self._write(docs, upsert=False)
+        return errors
+
+    def upsert_reading(self, doc):
+        self.upsert_readings([doc])
+
+    def upsert_readings(self, docs):
+        return self._write(docs, upsert=True)
+
+    def _write(self, docs, upsert):
+        """
+        Store plain readings as flat mode does and fold compactable ones into spans.
+        A sample inside a stored span with a value within the tolerance counts as
+        unchanged. Returns (statuses, errors) as upsert_readings() does.
+        """
+        statuses = [None] * len(docs)
+        errors, plain, series = {}, [], {}
+        for index, doc in enumerate(docs):
+            if _type_of(doc) not in COMPACT_TYPES:
+                plain.append(index)
+                continue
+            recorded_at = _to_datetime(doc.get('recorded_at'))
+            if recorded_at is None:
+                errors[index] = "recorded_at must be a datetime or ISO 8601 timestamp"
+                statuses[index] = 'error'
+                continue
+            doc['recorded_at'] = recorded_at
+            type_field = 'type' if doc.get('type') else 'reading_type'
+            series.setdefault(series_key(doc, type_field), []).append((index, doc))
+
+        if plain:
+            plain_docs = [docs[index] for index in plain]
+            if upsert:
+                plain_statuses, plain_errors = super().upsert_readings(plain_docs)
+            else:
+                plain_errors = super().insert_readings(plain_docs)
+                plain_statuses = ['error' if i in plain_errors else 'upserted' for i in range(len(plain))]
+            for position, index in enumerate(plain):
+                statuses[index] = plain_statuses[position]
+                if position in plain_errors:
+                    errors[index] = plain_errors[position]
+
+        ops, op_samples, duplicates = [], [], []
+        for key, samples in series.items():
+            samples.sort(key=lambda item: item[1]['recorded_at'])
+            user_id, type_field, reading_type, source = key[:4]
+            stored = self.collection.find({
+                'user_id': user_id,
+                type_field: reading_type,
+                'source': source,
+                'recorded_at': {'$gte': samples[0][1]['recorded_at'] - MAX_SPAN,
+                                '$lte': samples[-1][1]['recorded_at']},
+            }).sort('recorded_at', ASCENDING)
+            runs, covered = plan_runs(samples, [r for r in stored if series_key(r, type_field) == key])
+
+            run_ids = {}
+            for run in runs:
+                if run.stored_id is None:
+                    record = run.record()
+                    record['_id'] = ObjectId()
+                    ops.append(InsertOne(record))
+                    run_id = record['_id']
+                else:
+                    ops.append(UpdateOne({'_id': run.stored_id}, {
+                        '$max': {'end_at': run.end},
+                        '$inc': {'count': run.count - run.stored_count},
+                    }))
+                    run_id = run.stored_id
+                run_ids[id(run)] = run_id
+                for index in run.added:
+                    docs[index]['_id'] = run_id
+                    statuses[index] = 'upserted'
+                op_samples.append(run.added)
+            for index, run in covered:
+                # Stored spans, or a span this batch is creating for an earlier duplicate
+                docs[index]['_id'] = run.stored_id if run.stored_id is not None else run_ids[id(run)]
+                statuses[index] = 'unchanged'
+                duplicates.append((index, run))
+
+        if ops:
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                for position, message in _write_errors(e).items():
+                    for index in op_samples[position]:
+                        errors[index] = message
+                        statuses[index] = 'error'
+                for index, run in duplicates:
+                    if run.added and run.added[0] in errors:
+                        errors[index] = errors[run.added[0]]
+                        statuses[index] = 'error'
+            # Rollups and the reading bus still see every sample
+            self._after_write([(docs[index], None) for indexes in op_samples for index in indexes
+                               if index not in errors])
+        return statuses, errors
+
+    def decode_change(self, change):
+        """The readings an event added: a whole new record, or the newest sample of an extended span."""
+        record = change.get('fullDocument')
+        if not record:
+            return []
+        docs = list(expand(record))
+        return docs if change['operationType'] == 'insert' else docs[-1:]
+
+    # --- Reads ---
+
+    def iter_readings(self, user_id, types=None, source=None, since=None, until=None,
+                      descending=False, limit=None, after=None, fields=None, batch_size=None,
+                      expand=True):
+        # Spans start up to MAX_SPAN before their readings, so ranges are widened by
+        # that much in the query and applied to the expanded readings
+        query = {'user_id': user_id}
+        if types:
+            query.update(_type_match(types))
+        if source:
+            query['source'] = source
+        time_range = {}
+        if since:
+            time_range['$gte'] = since - MAX_SPAN
+        if until:
+            time_range['$lt'] = until
+        if after:
+            if descending:
+                time_range['$lte'] = after[0]
+            else:
+                time_range['$gte'] = max(after[0] - MAX_SPAN, time_range.get('$gte', after[0] - MAX_SPAN))
+        if time_range:
+            query['recorded_at'] = time_range
+
+        direction = DESCENDING if descending else ASCENDING
+        projection = dict.fromkeys(fields, 1) if fields else None
+        if projection:
+            projection.update({'recorded_at': 1, 'end_at': 1, 'count': 1})
+        cursor = self.collection.find(query, projection).sort([('recorded_at', direction), ('_id', direction)])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+
+        docs = _expand_in_order(cursor, descending) if expand else cursor
+        emitted = 0
+        for doc in docs:
+            if since and doc.get('end_at', doc['recorded_at']) < since:
+                continue
+            if until and doc['recorded_at'] >= until:
+                continue
+            if after:
+                key = _reading_key(doc)
+                if (key >= after) if descending else (key <= after):
+                    continue
+            yield doc
+            emitted += 1
+            if limit and emitted >= limit:
+                return
+
+    def _cursor_id(self, doc_id):
+        return str(doc_id)
+
+    def iter_series(self, user_id, types, source=None, since=None, fields=None, batch_size=None):
+        query = {'user_id': user_id, 'type': {'$in': list(types)}}
+        if source:
+            query['source'] = source
+        if since:
+            query['recorded_at'] = {'$gte': since - MAX_SPAN}
+        projection = dict.fromkeys(fields, 1) if fields else None
+        if projection:
+            projection.update({'type': 1, 'recorded_at': 1, 'end_at': 1, 'count': 1})
+        cursor = self.collection.find(query, projection).sort([('type', DESCENDING), ('recorded_at', ASCENDING)])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        for _, records in groupby(cursor, key=lambda r: r['type']):
+            for doc in _expand_in_order(records):
+                if since and doc['recorded_at'] < since:
+                    continue
+                yield doc
+
+    def latest(self, user_id, reading_type, source=None):
+        doc = super().latest(user_id, reading_type, source=source)
+        return _last_reading(doc) if doc else None
+
+    def _latest_reading(self, docs):
+        return _last_reading(docs[0]) if docs else None
+
+
+def _last_reading(record):
+    """The newest reading a record stands for."""
+    *_, newest = expand(record)
+    return newest
+
+
+def backfill_timestamps(db, batch_size=1000):
+    """
+    Convert string recorded_at values left by older versions of the sensors
+    POST into BSON dates, batch_size documents at a time.
+    Returns (converted, skipped).
+    """
+    collection = db['sensor_readings']
+    converted = skipped = 0
+    last_id = None
+    while True:
+        query = {'recorded_at': {'$type': 'string'}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(collection.find(query, {'recorded_at': 1}).sort('_id', ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+
+        ops = []
+        for doc in batch:
+            recorded_at = _to_datetime(doc['recorded_at'])
+            if recorded_at is None:
+                skipped += 1
+                continue
+            ops.append(UpdateOne({'_id': doc['_id']}, {'$set': {'recorded_at': recorded_at}}))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+            converted += len(ops)
+        print(f"Converted {converted} timestamps ({skipped} skipped)")
+    return converted, skipped
+
+
+def _write_errors(bulk_error):
+    return {err['index']: err.get('errmsg', 'Write failed')
+            for err in bulk_error.details.get('writeErrors', [])}
+
+
+STORES = {
+    'flat': SensorStore,
+    'bucket': BucketedSensorStore,
+    'compact': CompactSensorStore,
+}
+
+_sensor_store = None
+
+
+def get_sensor_store():
+    """Return the process-wide store for the configured SENSOR_STORAGE_MODE."""
+    global _sensor_store
+    if _sensor_store is None:
+        mode = os.getenv('SENSOR_STORAGE_MODE', 'flat')
+        if mode not in STORES:
+            raise ValueError(f"Unknown SENSOR_STORAGE_MODE '{mode}' (expected one of {', '.join(STORES)})")
+        _sensor_store = STORES[mode](get_db())
+    return _sensor_store
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('migrate', 'backfill-timestamps'):
+        print(__doc__)
+        return 1
+    batch_size = 1000
+    if '--batch-size' in argv:
+        batch_size = int(argv[argv.index('--batch-size') + 1])
+    if argv[0] == 'backfill-timestamps':
+        converted, skipped = backfill_timestamps(get_db(), batch_size)
+        print(f"✅ Backfill complete: {converted} timestamps converted, {skipped} skipped")
+        return 0
+    store = BucketedSensorStore(get_db())
+    migrated, skipped = store.migrate_from_flat(batch_size)
+    print(f"✅ Migration complete: {migrated} readings bucketed, {skipped} skipped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-import { useState, useCallback, useEffect } from 'react';
+import { useState, useCallback, useEffect, useRef } from 'react';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card';
 import { Button } from '@/components/ui/button';
 import { Badge } from '@/components/ui/badge';
@@ -52,6 +52,11 @@ interface NavigatorWithBluetooth extends Navigator {
   };
 }
 
+const READING_FLUSH_INTERVAL_MS = 10000;
+const READING_SAMPLE_EVERY = 5;
+// Readings kept for retry while the batch endpoint is unreachable (oldest dropped first)
+const MAX_PENDING_READINGS = 500;
+
 interface HeartRateReading {
   heartRate: number;
   timestamp: Date;
@@ -84,23 +89,49 @@ export const HeartRateMonitor = () => {
     }
   };
 
-  const saveReading = async (heartRate: number, deviceName: string | null) => {
+  // Readings are buffered and sent to the batch endpoint periodically instead of one request per beat
+  const pendingReadings = useRef<Record<string, unknown>[]>([]);
+  const beatCount = useRef(0);
+
+  const saveReading = (heartRate: number, deviceName: string | null) => {
+    const userId = localStorage.getItem("user_id");
+    if (!userId) return;
+
+    pendingReadings.current.push({
+      user_id: userId,
+      reading_type: 'heart_rate',
+      value: heartRate,
+      unit: 'bpm',
+      source: 'web_bluetooth',
+      device_name: deviceName,
+      recorded_at: new Date().toISOString(),
+    });
+    if (pendingReadings.current.length > MAX_PENDING_READINGS) {
+      pendingReadings.current = pendingReadings.current.slice(-MAX_PENDING_READINGS);
+    }
+  };
+
+  const flushReadings = useCallback(async () => {
+    if (pendingReadings.current.length === 0) return;
+    const batch = pendingReadings.current;
+    pendingReadings.current = [];
+
     try {
-      const userId = localStorage.getItem("user_id");
-      if (!userId) return;
-
-      await api.post("/sensor-readings", {
-        user_id: userId,
-        reading_type: 'heart_rate',
-        value: heartRate,
-        unit: 'bpm',
-        source: 'web_bluetooth',
-        device_name: deviceName,
-      });
+      await api.post("/sensor-readings/batch", batch);
     } catch (error) {
-      console.error('Error saving reading:', error);
+      console.error('Error saving readings:', error);
+      // Put the batch back ahead of anything buffered since, to retry on the next flush
+      pendingReadings.current = [...batch, ...pendingReadings.current].slice(-MAX_PENDING_READINGS);
     }
-  };
+  }, []);
+
+  useEffect(() => {
+    const interval = setInterval(flushReadings, READING_FLUSH_INTERVAL_MS);
+    return () => {
+      clearInterval(interval);
+      flushReadings();
+    };
+  }, [flushReadings]);
 
   const [showSOS, setShowSOS] = useState(false);
 
@@ -127,11 +158,11 @@ export const HeartRateMonitor = () => {
       setReadings(prev => [...prev.slice(-29), newReading]); // Keep last 30 readings
 
       // Save every 5th reading to database to avoid too many writes
-      if (readings.length % 5 === 0) {
+      if (beatCount.current++ % READING_SAMPLE_EVERY === 0) {
         saveReading(heartRate, deviceName);
       }
     }
-  }, [deviceName, readings.length, showSOS]);
+  }, [deviceName, showSOS]);
 
   const connectToDevice = async () => {
     if (!isSupported) {
@@ -209,6 +240,7 @@ export const HeartRateMonitor = () => {
   };
 
   const disconnectDevice = async () => {
+    flushReadings();
     if (device?.gatt?.connected) {
       device.gatt.disconnect();
     }
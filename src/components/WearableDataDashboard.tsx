@@ -6,6 +6,8 @@ import { Badge } from "@/components/ui/badge";
 import { Button } from "@/components/ui/button";
 import { useToast } from "@/hooks/use-toast";
 
+const DASHBOARD_TYPES = ["heart_rate", "steps", "calories", "weight"];
+
 interface WearableDataDashboardProps {
     userId: string;
 }
@@ -97,10 +99,32 @@ const WearableDataDashboard: React.FC<WearableDataDashboardProps> = ({ userId })
 
     useEffect(() => {
         fetchLatestData();
-        // Auto-refresh from DB every 5 minutes (does not re-sync from Google Fit)
-        const interval = setInterval(fetchLatestData, 5 * 60 * 1000);
-        return () => clearInterval(interval);
-    }, [fetchLatestData]);
+        // Live updates are pushed by the backend as readings are stored (no polling)
+        const source = new EventSource(`http://localhost:5000/api/sensor-readings/stream?user_id=${userId}`);
+        source.addEventListener("reading", (event) => {
+            const reading = JSON.parse((event as MessageEvent).data);
+            if (reading.source !== "google_fit" || !DASHBOARD_TYPES.includes(reading.type)) return;
+            setLatestData((current: any) => {
+                const previous = current?.[reading.type];
+                if (previous?.recorded_at && reading.recorded_at && reading.recorded_at < previous.recorded_at) {
+                    return current;
+                }
+                return {
+                    ...current,
+                    [reading.type]: {
+                        value: reading.value,
+                        unit: reading.unit,
+                        recorded_at: reading.recorded_at,
+                        synced_at: reading.synced_at,
+                        date: reading.date ?? ""
+                    }
+                };
+            });
+        });
+        // The server dropped events because we fell behind: reload the full snapshot
+        source.addEventListener("resync", () => fetchLatestData());
+        return () => source.close();
+    }, [fetchLatestData, userId]);
 
     const getHeartRateStatus = (bpm: number) => {
         if (bpm < 60) return { status: "Low", color: "text-blue-500", bg: "bg-blue-500/10" };